@@ -10,7 +10,7 @@ import { Label } from "@/components/ui/label"
 import { Card, CardContent, CardDescription, CardFooter, CardHeader, CardTitle } from "@/components/ui/card"
 import { Tabs, TabsContent, TabsList, TabsTrigger } from "@/components/ui/tabs"
 import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from "@/components/ui/select"
-import { calculateRoute, generateEldLogs } from "@/lib/api"
+import { planTrip } from "@/lib/api"
 import { EldLogSheet } from "@/components/eld-log-sheet"
 import { RouteDetails } from "@/components/route-details"
 import { useToast } from "@/components/ui/use-toast"
@@ -80,8 +80,8 @@ export default function TripPlanner() {
     setLoading(true)
 
     try {
-      // Calculate route
-      const routeData = await calculateRoute({
+      // Calculate route and ELD logs in one round trip
+      const { route: routeData, eldLogs: logsData } = await planTrip({
         currentLocation,
         pickupLocation,
         dropoffLocation,
@@ -89,9 +89,6 @@ export default function TripPlanner() {
       })
 
       setRoute(routeData)
-
-      // Generate ELD logs
-      const logsData = await generateEldLogs(routeData)
       setEldLogs(logsData)
 
       setActiveTab("map")
@@ -0,0 +1,273 @@
+# Rolling 70-hour/8-day duty cycle tracking per driver
+import bisect
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import DutyPeriod
+
+CYCLE_LIMIT_HOURS = 70
+CYCLE_DAYS = 8
+RESTART_HOURS = 34  # consecutive off-duty hours that reset the cycle
+# Days of daily totals kept per driver; enough for the window plus planned days ahead
+CYCLE_HISTORY_DAYS = getattr(settings, 'CYCLE_HISTORY_DAYS', 32)
+# Drivers whose cycles each process keeps in memory
+CYCLE_CACHE_DRIVERS = getattr(settings, 'CYCLE_CACHE_DRIVERS', 10000)
+# Django cache holding each driver's cycle version; share it between processes
+CYCLE_CACHE_ALIAS = getattr(settings, 'CYCLE_CACHE_ALIAS', 'default')
+
+
+def epoch_hours(value=None):
+    """
+    Hours since the Unix epoch, the time scale of the shared driver trackers.
+
+    Parameters:
+    - value: datetime, ISO 8601 string, number of hours, or None for now;
+      times without a UTC offset are taken as UTC, not server local time
+    """
+    if value is None:
+        return time.time() / 3600
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp() / 3600
+
+
+def _as_datetime(hours):
+    return datetime.fromtimestamp(hours * 3600, tz=timezone.utc)
+
+
+class DriverCycle:
+    """
+    One driver's on-duty hours per day, in a ring buffer of history_days.
+
+    Times are hours on any fixed scale whose multiples of 24 are midnights.
+    Recording updates the day totals; queries read an 8-day window from a
+    prefix sum over the ring that is rebuilt only after the totals change,
+    so "hours used/available at T" is O(1). The periods themselves are
+    kept too, so on-duty time later on the day of T is not counted at T.
+    An on-duty period that starts 34 or more hours after the previous one
+    ended is a restart: everything before it leaves the cycle.
+    """
+
+    def __init__(self, limit=CYCLE_LIMIT_HOURS, window_days=CYCLE_DAYS,
+                 restart_hours=RESTART_HOURS, history_days=CYCLE_HISTORY_DAYS):
+        self.limit = limit
+        self.window_days = window_days
+        self.restart_hours = restart_hours
+        self.totals = np.zeros(max(history_days, window_days), dtype=np.float64)
+        self.latest_day = None  # newest day with a slot in the ring
+        self.last_on_duty_end = -math.inf
+        self.last_restart = None  # when the last detected restart was completed
+        self._prefix = None
+        self._periods = []  # (start, end) in the ring's days, ordered by start
+        self._longest = 0.0  # longest period in _periods
+
+    @property
+    def oldest_day(self):
+        return self.latest_day - len(self.totals) + 1
+
+    def _advance_to(self, day):
+        """Make day the newest slot, clearing the slots of the days it reuses"""
+        if self.latest_day is None:
+            self.latest_day = day
+            return
+        gap = day - self.latest_day
+        if gap >= len(self.totals):
+            self.totals[:] = 0
+        elif gap > 0:
+            slots = np.arange(self.latest_day + 1, day + 1) % len(self.totals)
+            self.totals[slots] = 0
+        self.latest_day = max(self.latest_day, day)
+
+    def record(self, start, end):
+        """Add an on-duty (driving or not) period from start to end"""
+        if end <= start:
+            return
+        if start - self.last_on_duty_end >= self.restart_hours and self.latest_day is not None:
+            self.totals[:] = 0
+            self._periods, self._longest = [], 0.0
+            self.last_restart = self.last_on_duty_end + self.restart_hours
+        self.last_on_duty_end = max(self.last_on_duty_end, end)
+
+        first_day, last_day = math.floor(start / 24), math.floor(math.nextafter(end, -math.inf) / 24)
+        self._advance_to(last_day)
+        for day in range(max(first_day, self.oldest_day), last_day + 1):
+            hours = min(end, (day + 1) * 24) - max(start, day * 24)
+            self.totals[day % len(self.totals)] += hours
+        self._prefix = None
+
+        bisect.insort(self._periods, (start, end))
+        self._longest = max(self._longest, end - start)
+        # Drop periods that ended before the oldest day in the ring
+        horizon = self.oldest_day * 24
+        if self._periods[0][0] + self._longest < horizon:
+            self._periods = [period for period in self._periods if period[1] > horizon]
+            self._longest = max((e - s for s, e in self._periods), default=0.0)
+
+    def _on_duty_between(self, start, end):
+        """Recorded on-duty hours between start and end"""
+        total = 0.0
+        index = bisect.bisect_left(self._periods, (end,))
+        # Periods are ordered by start, so once one starts more than the
+        # longest period before start, no earlier one reaches it
+        for period_start, period_end in reversed(self._periods[:index]):
+            if period_start + self._longest <= start:
+                break
+            total += max(min(period_end, end) - max(period_start, start), 0.0)
+        return total
+
+    def _window_sum(self, first_day, last_day):
+        if self._prefix is None:
+            # Prefix sum in day order, oldest day first
+            order = np.arange(self.oldest_day, self.latest_day + 1) % len(self.totals)
+            self._prefix = np.concatenate(([0.0], np.cumsum(self.totals[order])))
+        first = min(max(first_day - self.oldest_day, 0), len(self.totals))
+        last = min(max(last_day - self.oldest_day + 1, 0), len(self.totals))
+        return float(self._prefix[last] - self._prefix[first]) if last > first else 0.0
+
+    def hours_used(self, at):
+        """On-duty hours in the 8-day window up to at, or 0 after a restart"""
+        if self.latest_day is None or at - self.last_on_duty_end >= self.restart_hours:
+            return 0.0
+        day = math.floor(at / 24)
+        used = self._window_sum(day - self.window_days + 1, day)
+        # The window's last day only counts up to at
+        if day >= self.oldest_day:
+            used -= self._on_duty_between(at, (day + 1) * 24)
+        return max(used, 0.0)
+
+    def hours_available(self, at):
+        return max(self.limit - self.hours_used(at), 0.0)
+
+
+class CycleRegistry:
+    """
+    Drivers' cycles from the DutyPeriod table, on the epoch_hours time scale.
+
+    The table is the shared history, so nothing is lost on restart. Each
+    process builds a driver's DriverCycle from it once and answers later
+    queries from its day totals, with one cache read for the driver's
+    version. Recording periods bumps that version in the CYCLE_CACHE_ALIAS
+    cache, so every process sharing the cache rebuilds the driver's cycle
+    on its next query. A query for a time before the driver's latest
+    recorded period is answered from a cycle built up to that time.
+    """
+
+    def __init__(self, max_drivers=CYCLE_CACHE_DRIVERS, alias=CYCLE_CACHE_ALIAS):
+        self.max_drivers = max_drivers
+        self.alias = alias
+        self._cycles = OrderedDict()  # driver_id -> (version, DriverCycle, latest period start)
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _version_key(self, driver_id):
+        return f"eldtrip:driver-cycle:{hashlib.sha256(str(driver_id).encode('utf-8')).hexdigest()}"
+
+    def _version(self, driver_id):
+        key = self._version_key(driver_id)
+        version = self.cache.get(key)
+        if version is None:
+            # First use, or the version was evicted: start from the clock so
+            # no cycle built under an earlier version is taken as current
+            self.cache.add(key, time.time_ns(), timeout=None)
+            version = self.cache.get(key)
+        return version
+
+    def record_periods(self, driver_id, periods):
+        """Store on-duty periods, given as (start, end) in any form epoch_hours takes"""
+        DutyPeriod.objects.bulk_create([
+            DutyPeriod(driver_id=driver_id, start=_as_datetime(epoch_hours(start)), end=_as_datetime(epoch_hours(end)))
+            for start, end in periods
+        ], ignore_conflicts=True)
+        key = self._version_key(driver_id)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.add(key, time.time_ns(), timeout=None)
+        with self._lock:
+            self._cycles.pop(driver_id, None)
+
+    def record(self, driver_id, start, end):
+        self.record_periods(driver_id, [(start, end)])
+
+    def cycle(self, driver_id, at=None):
+        """
+        The driver's DriverCycle from the periods that started by at (epoch
+        hours), or from all recorded periods when at is None.
+
+        Returns:
+        - (DriverCycle, start of its latest period or -inf)
+        """
+        periods = DutyPeriod.objects.filter(driver_id=driver_id)
+        horizon = epoch_hours() if at is None else at
+        periods = periods.filter(end__gt=_as_datetime(horizon - CYCLE_HISTORY_DAYS * 24))
+        if at is not None:
+            periods = periods.filter(start__lte=_as_datetime(at))
+        cycle, latest_start = DriverCycle(), -math.inf
+        for start, end in periods.order_by('start').values_list('start', 'end'):
+            latest_start = epoch_hours(start)
+            cycle.record(latest_start, epoch_hours(end))
+        return cycle, latest_start
+
+    def status(self, driver_id, at=None):
+        """
+        A driver's cycle position at a time.
+
+        Returns:
+        - dict with hoursUsed, hoursAvailable and lastRestart (epoch hours or None)
+        """
+        at = epoch_hours(at)
+        version = self._version(driver_id)
+        with self._lock:
+            cached = self._cycles.get(driver_id)
+            if cached is not None and cached[0] == version:
+                self._cycles.move_to_end(driver_id)
+        if cached is None or cached[0] != version:
+            cycle, latest_start = self.cycle(driver_id)
+            cached = (version, cycle, latest_start)
+            with self._lock:
+                self._cycles[driver_id] = cached
+                self._cycles.move_to_end(driver_id)
+                while len(self._cycles) > self.max_drivers:
+                    self._cycles.popitem(last=False)
+
+        _, cycle, latest_start = cached
+        if at < latest_start:
+            # Periods after at would count as a restart or fall in its day
+            cycle, _ = self.cycle(driver_id, at)
+            used = cycle.hours_used(at)
+        else:
+            with self._lock:
+                used = cycle.hours_used(at)
+        return {
+            'hoursUsed': used,
+            'hoursAvailable': max(cycle.limit - used, 0.0),
+            'lastRestart': cycle.last_restart,
+        }
+
+    def hours_used(self, driver_id, at=None):
+        return self.status(driver_id, at)['hoursUsed']
+
+
+def purge_old_duty_periods():
+    """Delete periods that ended before any cycle query can see them, returning the number removed"""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=CYCLE_HISTORY_DAYS)
+    deleted, _ = DutyPeriod.objects.filter(end__lte=cutoff).delete()
+    return deleted
+
+
+driver_cycles = CycleRegistry()
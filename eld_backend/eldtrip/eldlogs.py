@@ -0,0 +1,187 @@
+# ELD daily log generation from minute-resolution duty status arrays
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .cycle import CYCLE_LIMIT_HOURS, DriverCycle
+from .hos import STOP_ON_DUTY_HOURS
+
+# Duty statuses, in the row order of the log grid
+OFF, SB, D, ON = range(4)
+STATUS_NAMES = ('OFF', 'SB', 'D', 'ON')
+
+MINUTES_PER_DAY = 1440
+START_HOUR = 8  # the trip starts at 8 AM on the first day
+SLEEPER_BERTH_MIN_HOURS = 8  # longer rests are logged in the sleeper berth
+
+
+def duty_segments(route_data):
+    """
+    Order the trip's duty periods from the route plan.
+
+    Stops are placed at the driving time where they happen (their distance
+    along the route at the plan's average speed), with driving in between.
+
+    Returns:
+    - list of (status, hours, description)
+    """
+    total_distance = route_data['totalDistance']
+    driving_time = route_data['drivingTime']
+    hours_per_mile = driving_time / total_distance if total_distance > 0 else 0.0
+
+    # (driving hours, order at equal times, status, hours, description)
+    stops = []
+    leg_distances = route_data.get('legDistances')
+    if leg_distances:
+        leg_end = 0.0
+        for leg, distance in enumerate(leg_distances[:-1]):
+            leg_end += distance
+            description = 'On duty - Pickup location' if leg == 0 else 'On duty - Extra stop'
+            stops.append((leg_end * hours_per_mile, 0, ON, STOP_ON_DUTY_HOURS, description))
+    else:
+        # Plans saved before legDistances existed: pickup before the first drive
+        stops.append((0.0, 0, ON, STOP_ON_DUTY_HOURS, 'On duty - Pickup location'))
+    for stop in route_data['restStops']:
+        duration = stop['duration']
+        stops.append((
+            stop['distance'] * hours_per_mile, 1,
+            SB if duration >= SLEEPER_BERTH_MIN_HOURS else OFF,
+            duration, f"{stop['reason']} ({duration} hours)",
+        ))
+    stops.append((driving_time, 2, ON, STOP_ON_DUTY_HOURS, 'On duty - Dropoff location'))
+    stops.sort(key=lambda stop: stop[:2])
+
+    segments = []
+    driven = 0.0
+    for at, _, status, hours, description in stops:
+        at = min(max(at, driven), driving_time)
+        if at > driven:
+            segments.append((D, at - driven, f"Driving ({at - driven:.1f} hours)"))
+            driven = at
+        segments.append((status, hours, description))
+    return segments
+
+
+def status_timeline(segments, start_minute=START_HOUR * 60):
+    """
+    Lay duty segments out as one status per minute, padded with off duty
+    to whole days.
+
+    Segment boundaries are rounded from the cumulative hours, so rounding
+    never drifts however many segments there are.
+
+    Returns:
+    - (uint8 array of shape (days, 1440), minute index where each segment starts)
+    """
+    hours = np.array([segment[1] for segment in segments], dtype=np.float64)
+    boundaries = start_minute + np.rint(np.concatenate(([0.0], np.cumsum(hours))) * 60).astype(np.int64)
+    days = max(1, -(-int(boundaries[-1]) // MINUTES_PER_DAY))
+
+    timeline = np.full(days * MINUTES_PER_DAY, OFF, dtype=np.uint8)
+    codes = np.array([segment[0] for segment in segments], dtype=np.uint8)
+    timeline[start_minute:boundaries[-1]] = np.repeat(codes, np.diff(boundaries))
+    return timeline.reshape(days, MINUTES_PER_DAY), boundaries[:-1]
+
+
+def status_runs(timeline):
+    """
+    Run-length encode a (days, 1440) status array, splitting runs at midnight.
+
+    Returns:
+    - (day, start minute, end minute, status) arrays, one entry per run
+    """
+    flat = timeline.ravel()
+    starts = np.flatnonzero(np.diff(flat)) + 1
+    midnights = np.arange(0, flat.size, MINUTES_PER_DAY)
+    starts = np.union1d(np.concatenate(([0], starts)), midnights)
+    ends = np.append(starts[1:], flat.size)
+    day = starts // MINUTES_PER_DAY
+    return day, starts - day * MINUTES_PER_DAY, ends - day * MINUTES_PER_DAY, flat[starts]
+
+
+def status_totals(timeline):
+    """Hours per day in each status, as a (days, 4) array"""
+    days = timeline.shape[0]
+    keys = (np.arange(days)[:, None] * len(STATUS_NAMES) + timeline).ravel()
+    counts = np.bincount(keys, minlength=days * len(STATUS_NAMES))
+    return counts.reshape(days, len(STATUS_NAMES)) / 60
+
+
+def daily_cycle_hours(day, start, end, status, prior_hours=0):
+    """
+    Rolling 70-hour/8-day cycle use at the end of each day, from the status runs.
+
+    On-duty runs are fed to a DriverCycle day by day, so a 34-hour break
+    during the trip restarts the cycle. prior_hours (the cycle already used
+    when the trip starts) is taken as the on-duty time just before it.
+    """
+    cycle = DriverCycle()
+    cycle.record(-prior_hours, 0)
+    run_start = day * 24 + start / 60
+    run_end = day * 24 + end / 60
+    on_duty = (status == D) | (status == ON)
+
+    days = int(day[-1]) + 1
+    used = np.zeros(days)
+    for today, first, last in zip(range(days), np.searchsorted(day, range(days)),
+                                  np.searchsorted(day, range(1, days + 1))):
+        for run in np.flatnonzero(on_duty[first:last]) + first:
+            cycle.record(float(run_start[run]), float(run_end[run]))
+        used[today] = cycle.hours_used((today + 1) * 24 - 1e-6)
+    return used
+
+
+def generate_eld_logs(route_data, start_date=None):
+    """
+    Generate ELD daily logs for a route plan.
+
+    The whole trip is one minute-resolution status array, so days, blocks
+    and totals come from array operations, and the rolling 70-hour/8-day
+    cycle from its runs; a long trip costs about the same as a short one.
+
+    Parameters:
+    - route_data: calculate_route result
+    - start_date: date of the first day (default: today)
+
+    Returns:
+    - {'days': [day log, ...]} or None without a route
+    """
+    if not route_data:
+        return None
+
+    segments = duty_segments(route_data)
+    timeline, segment_starts = status_timeline(segments)
+    totals = status_totals(timeline)
+    runs = status_runs(timeline)
+    cycle_hours = daily_cycle_hours(*runs, prior_hours=route_data.get('currentCycleHours', 0))
+
+    start_date = start_date or datetime.now()
+    days = [{
+        'date': (start_date + timedelta(days=day)).strftime('%a, %b %d'),
+        'statusBlocks': [],
+        'events': [],
+        'drivingHours': float(totals[day, D]),
+        'onDutyHours': float(totals[day, ON]),
+        'offDutyHours': float(totals[day, OFF] + totals[day, SB]),
+        'sleeperBerthHours': float(totals[day, SB]),
+        'cycleHoursUsed': float(cycle_hours[day]),
+        'cycleHoursAvailable': float(max(CYCLE_LIMIT_HOURS - cycle_hours[day], 0)),
+    } for day in range(timeline.shape[0])]
+
+    for day, start, end, status in zip(*(array.tolist() for array in runs)):
+        days[day]['statusBlocks'].append({
+            'status': STATUS_NAMES[status],
+            'startHour': start / 60,
+            'endHour': end / 60,
+        })
+
+    for (status, hours, description), start in zip(segments, segment_starts.tolist()):
+        day, minute = divmod(start, MINUTES_PER_DAY)
+        days[day]['events'].append({'hour': minute / 60, 'description': description})
+
+    # Off duty for the rest of the day once the trip is over
+    day, minute = divmod(int(segment_starts[-1] + round(segments[-1][1] * 60)), MINUTES_PER_DAY)
+    if day < len(days) and minute < 23 * 60:
+        days[day]['events'].append({'hour': minute / 60, 'description': 'Off duty'})
+
+    return {'days': days}
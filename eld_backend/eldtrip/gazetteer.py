@@ -0,0 +1,206 @@
+# Local offline geocoder backed by an in-memory gazetteer
+import bisect
+import csv
+import re
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from .geocache import normalize_address
+
+# CSV files with name,lat,lng columns and an optional rank column (lower wins
+# ties); city/state/ZIP centroids and our own facility list
+GAZETTEER_PATHS = getattr(settings, 'GAZETTEER_PATHS', [])
+# Minimum trigram similarity (Dice coefficient) for a fuzzy match
+GAZETTEER_FUZZY_THRESHOLD = getattr(settings, 'GAZETTEER_FUZZY_THRESHOLD', 0.6)
+# Shorter queries are never prefix matched ("D" is not Dallas)
+GAZETTEER_MIN_PREFIX_LENGTH = getattr(settings, 'GAZETTEER_MIN_PREFIX_LENGTH', 4)
+
+_ZIP_PATTERN = re.compile(r'\b(\d{5})(?:-\d{4})?\b')
+_COUNTRY_SUFFIXES = (' united states of america', ' united states', ' usa', ' us')
+
+_STATES = {
+    'al': 'alabama', 'ak': 'alaska', 'az': 'arizona', 'ar': 'arkansas', 'ca': 'california',
+    'co': 'colorado', 'ct': 'connecticut', 'de': 'delaware', 'dc': 'district of columbia',
+    'fl': 'florida', 'ga': 'georgia', 'hi': 'hawaii', 'id': 'idaho', 'il': 'illinois',
+    'in': 'indiana', 'ia': 'iowa', 'ks': 'kansas', 'ky': 'kentucky', 'la': 'louisiana',
+    'me': 'maine', 'md': 'maryland', 'ma': 'massachusetts', 'mi': 'michigan', 'mn': 'minnesota',
+    'ms': 'mississippi', 'mo': 'missouri', 'mt': 'montana', 'ne': 'nebraska', 'nv': 'nevada',
+    'nh': 'new hampshire', 'nj': 'new jersey', 'nm': 'new mexico', 'ny': 'new york',
+    'nc': 'north carolina', 'nd': 'north dakota', 'oh': 'ohio', 'ok': 'oklahoma', 'or': 'oregon',
+    'pa': 'pennsylvania', 'ri': 'rhode island', 'sc': 'south carolina', 'sd': 'south dakota',
+    'tn': 'tennessee', 'tx': 'texas', 'ut': 'utah', 'vt': 'vermont', 'va': 'virginia',
+    'wa': 'washington', 'wv': 'west virginia', 'wi': 'wisconsin', 'wy': 'wyoming',
+}
+
+
+def normalize_place(name):
+    """normalize_address without a trailing country name"""
+    name = normalize_address(name)
+    for suffix in _COUNTRY_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)].strip()
+    return name
+
+
+def place_qualifiers(name):
+    """
+    State codes and ZIP codes that pin a place name down.
+    
+    States are read from what follows the first comma ("Portland, ME"),
+    or from the last word when there is no comma ("Denver CO"), so words
+    like "in" or "or" inside a name are not taken for states.
+    """
+    name = str(name)
+    qualifiers = set(_ZIP_PATTERN.findall(name))
+    head, _, tail = name.partition(',')
+    tail = normalize_place(tail) if tail else ' '.join(normalize_place(head).split()[-1:])
+    words = tail.split()
+    qualifiers.update(word for word in words if word in _STATES)
+    padded = f' {tail} '
+    qualifiers.update(code for code, state in _STATES.items() if f' {state} ' in padded)
+    return qualifiers
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class Gazetteer:
+    """
+    In-memory place index with exact, prefix and fuzzy (trigram) lookup.
+    
+    Names are normalized like geocode cache keys. Exact matches use a dict,
+    prefix matches a sorted name list and bisect, and fuzzy matches an
+    inverted trigram index scored with numpy, so lookups stay well under a
+    millisecond for tens of thousands of places.
+    
+    A prefix or fuzzy candidate is only accepted when it has one of the
+    state or ZIP codes the query names (see place_qualifiers), so
+    "Portland, ME" never resolves to Portland, OR; without one the lookup
+    misses and the caller falls back to the online geocoder.
+    """
+
+    def __init__(self, entries=()):
+        names, lats, lngs, ranks, qualifiers = [], [], [], [], []
+        for name, lat, lng, rank in entries:
+            key = normalize_place(name)
+            if key:
+                names.append(key)
+                qualifiers.append(place_qualifiers(name))
+                lats.append(float(lat))
+                lngs.append(float(lng))
+                ranks.append(float(rank))
+
+        self.names = names
+        self.qualifiers = qualifiers
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+        self.ranks = np.asarray(ranks, dtype=np.float64)
+
+        # Exact: the best-ranked entry for each name
+        self._exact = {}
+        for index in np.argsort(self.ranks, kind='stable').tolist():
+            self._exact.setdefault(names[index], index)
+
+        # Prefix: names sorted alphabetically, with their entry ids
+        order = sorted(range(len(names)), key=lambda i: names[i])
+        self._sorted_names = [names[i] for i in order]
+        self._sorted_ids = np.asarray(order, dtype=np.int64)
+
+        # Fuzzy: trigram -> ids of the entries containing it
+        postings = {}
+        self._trigram_counts = np.zeros(len(names), dtype=np.int32)
+        for index, name in enumerate(names):
+            grams = trigrams(name)
+            self._trigram_counts[index] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(index)
+        self._postings = {gram: np.asarray(ids, dtype=np.int32) for gram, ids in postings.items()}
+
+    @classmethod
+    def from_csv(cls, paths):
+        entries = []
+        for path in paths:
+            with open(path, newline='', encoding='utf-8') as f:
+                for row in csv.DictReader(f):
+                    entries.append((row['name'], row['lat'], row['lng'], row.get('rank') or 0))
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _coords(self, index):
+        return {'lat': float(self.lats[index]), 'lng': float(self.lngs[index])}
+
+    def exact(self, name):
+        index = self._exact.get(normalize_place(name))
+        return self._coords(index) if index is not None else None
+
+    def _compatible(self, index, qualifiers):
+        """Whether an entry has one of the query's state/ZIP codes (any entry when there are none)"""
+        return not qualifiers or bool(qualifiers & self.qualifiers[index])
+
+    def prefix(self, name, min_length=GAZETTEER_MIN_PREFIX_LENGTH):
+        """Best-ranked place whose name starts with name and agrees with its state/ZIP"""
+        key = normalize_place(name)
+        if len(key) < min_length:
+            return None
+        start = bisect.bisect_left(self._sorted_names, key)
+        end = bisect.bisect_left(self._sorted_names, key + '\uffff', lo=start)
+        qualifiers = place_qualifiers(name)
+        ids = [index for index in self._sorted_ids[start:end].tolist() if self._compatible(index, qualifiers)]
+        if not ids:
+            return None
+        return self._coords(min(ids, key=lambda index: self.ranks[index]))
+
+    def fuzzy(self, name, threshold=GAZETTEER_FUZZY_THRESHOLD):
+        """Most similar place by trigram Dice coefficient that reaches threshold and agrees with its state/ZIP"""
+        grams = trigrams(normalize_place(name))
+        hits = [self._postings[gram] for gram in grams if gram in self._postings]
+        if not hits or not len(self):
+            return None
+        shared = np.bincount(np.concatenate(hits), minlength=len(self))
+        scores = 2 * shared / (len(grams) + self._trigram_counts)
+        scores = scores - 1e-6 * self.ranks / (self.ranks.max() + 1)
+        candidates = np.flatnonzero(scores >= threshold - 1e-6)
+        qualifiers = place_qualifiers(name)
+        for index in candidates[np.argsort(-scores[candidates], kind='stable')].tolist():
+            if self._compatible(index, qualifiers):
+                return self._coords(index)
+        return None
+
+    def lookup(self, address):
+        """
+        Geocode an address from the gazetteer: exact name, then a ZIP code in
+        the address, then prefix, then fuzzy. Prefix and fuzzy matches must
+        agree with any state or ZIP in the address.
+        
+        Returns:
+        - {'lat', 'lng'} or None
+        """
+        coords = self.exact(address)
+        if coords is None:
+            match = _ZIP_PATTERN.search(str(address))
+            if match:
+                coords = self.exact(match.group(1))
+        if coords is None:
+            coords = self.prefix(address)
+        if coords is None:
+            coords = self.fuzzy(address)
+        return coords
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer():
+    """The gazetteer built from settings.GAZETTEER_PATHS, loaded once per process"""
+    global _gazetteer
+    with _gazetteer_lock:
+        if _gazetteer is None:
+            _gazetteer = Gazetteer.from_csv(GAZETTEER_PATHS)
+        return _gazetteer
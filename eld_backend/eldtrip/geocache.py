@@ -0,0 +1,213 @@
+# Two-tier geocode cache: an in-process LRU in front of a database table
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import OperationalError
+
+from .models import GeocodeCacheEntry
+
+GEOCODE_CACHE_SIZE = getattr(settings, 'GEOCODE_CACHE_SIZE', 1024)
+GEOCODE_CACHE_TTL = getattr(settings, 'GEOCODE_CACHE_TTL', 30 * 24 * 3600)  # 30 days
+GEOCODE_NEGATIVE_CACHE_TTL = getattr(settings, 'GEOCODE_NEGATIVE_CACHE_TTL', 5 * 60)  # 5 minutes
+# Attempts at a table write that finds the database locked (SQLite allows one writer at a time)
+GEOCODE_CACHE_WRITE_ATTEMPTS = getattr(settings, 'GEOCODE_CACHE_WRITE_ATTEMPTS', 4)
+GEOCODE_CACHE_WRITE_BACKOFF = getattr(settings, 'GEOCODE_CACHE_WRITE_BACKOFF', 0.05)  # seconds, doubled per attempt
+
+_NOT_CACHED = object()
+
+
+def normalize_address(address):
+    """Lowercase an address and collapse punctuation and whitespace"""
+    address = re.sub(r'[^\w\s]', ' ', str(address).lower())
+    return re.sub(r'\s+', ' ', address).strip()
+
+
+def address_cache_key(address):
+    """Stable fixed-length key for an address, used by both cache tiers"""
+    return hashlib.sha256(normalize_address(address).encode('utf-8')).hexdigest()
+
+
+class GeocodeCache:
+    """
+    Cache geocoding results in memory and in the GeocodeCacheEntry table.
+
+    Parameters:
+    - fetch: callable taking an address and returning {'lat', 'lng'}, or None
+      when the provider has no result; it raises when the lookup itself
+      fails, which is never cached
+    - max_entries: number of addresses kept in the in-process LRU
+    - ttl: lifetime in seconds of a successful lookup
+    - negative_ttl: lifetime in seconds of a lookup that returned nothing
+    - persistent: False to keep results in memory only, without the table
+    """
+
+    def __init__(self, fetch, max_entries=GEOCODE_CACHE_SIZE,
+                 ttl=GEOCODE_CACHE_TTL, negative_ttl=GEOCODE_NEGATIVE_CACHE_TTL, persistent=True):
+        self.fetch = fetch
+        self.persistent = persistent
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # key -> (coords, expires_at timestamp)
+        self._lock = threading.Lock()
+        self._counters = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'negative_hits': 0,
+                          'fetch_errors': 0, 'write_retries': 0, 'write_errors': 0}
+
+    def get(self, address):
+        """Return cached coordinates for an address, geocoding it on a miss"""
+        key = address_cache_key(address)
+
+        coords = self._memory_get(key)
+        if coords is _NOT_CACHED:
+            coords = self._db_get(key)
+            if coords is _NOT_CACHED:
+                self._count('misses')
+                try:
+                    coords = self.fetch(address)
+                except Exception:
+                    # An outage or throttled request isn't a negative result; the next get tries again
+                    self._count('fetch_errors')
+                    raise
+                self.set(address, coords)
+                return coords
+            self._count('db_hits')
+        else:
+            self._count('memory_hits')
+
+        if coords is None:
+            self._count('negative_hits')
+        return coords
+
+    def set(self, address, coords):
+        """Store a geocoding result (None for a negative result) in both tiers"""
+        key = address_cache_key(address)
+        ttl = self.ttl if coords is not None else self.negative_ttl
+        expires_at = time.time() + ttl
+        self._memory_set(key, coords, expires_at)
+        if not self.persistent:
+            return
+
+        # The result stays in the in-process tier even if the table write fails
+        for attempt in range(GEOCODE_CACHE_WRITE_ATTEMPTS):
+            try:
+                GeocodeCacheEntry.objects.update_or_create(
+                    address_key=key,
+                    defaults={
+                        'address': str(address),
+                        'lat': coords['lat'] if coords else None,
+                        'lng': coords['lng'] if coords else None,
+                        'expires_at': datetime.fromtimestamp(expires_at, tz=timezone.utc),
+                    }
+                )
+                return
+            except OperationalError as e:
+                if 'locked' not in str(e) or attempt == GEOCODE_CACHE_WRITE_ATTEMPTS - 1:
+                    print(f"Error writing geocode cache entry: {e}")
+                    self._count('write_errors')
+                    return
+                self._count('write_retries')
+                time.sleep(GEOCODE_CACHE_WRITE_BACKOFF * 2 ** attempt)
+            except Exception as e:
+                print(f"Error writing geocode cache entry: {e}")
+                self._count('write_errors')
+                return
+
+    def expires_at(self, address):
+        """When the cached result for an address expires, as epoch seconds (None if not cached)"""
+        key = address_cache_key(address)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.time():
+            return entry[1]
+        if not self.persistent:
+            return None
+        try:
+            entry = GeocodeCacheEntry.objects.filter(
+                address_key=key,
+                expires_at__gt=datetime.now(timezone.utc)
+            ).values_list('expires_at', flat=True).first()
+        except Exception as e:
+            print(f"Error reading geocode cache entry: {e}")
+            return None
+        return entry.timestamp() if entry is not None else None
+
+    def clear(self, persistent=False):
+        """
+        Drop the in-process tier and reset counters.
+
+        Parameters:
+        - persistent: also delete every row of the GeocodeCacheEntry table,
+          which other processes share
+        """
+        with self._lock:
+            self._entries.clear()
+            for name in self._counters:
+                self._counters[name] = 0
+        if persistent and self.persistent:
+            GeocodeCacheEntry.objects.all().delete()
+
+    def purge_expired(self):
+        """Delete expired rows from the persistent tier, returning the number removed"""
+        deleted, _ = GeocodeCacheEntry.objects.filter(
+            expires_at__lte=datetime.now(timezone.utc)
+        ).delete()
+        return deleted
+
+    def stats(self):
+        """Hit/miss counters for both tiers"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['memory_entries'] = len(self._entries)
+        lookups = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['memory_hits'] + stats['db_hits']) / lookups if lookups else 0.0
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _memory_get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _NOT_CACHED
+            coords, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return _NOT_CACHED
+            self._entries.move_to_end(key)
+            return coords
+
+    def _memory_set(self, key, coords, expires_at):
+        with self._lock:
+            self._entries[key] = (coords, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _db_get(self, key):
+        if not self.persistent:
+            return _NOT_CACHED
+        try:
+            entry = GeocodeCacheEntry.objects.filter(
+                address_key=key,
+                expires_at__gt=datetime.now(timezone.utc)
+            ).first()
+        except Exception as e:
+            print(f"Error reading geocode cache entry: {e}")
+            return _NOT_CACHED
+
+        if entry is None:
+            return _NOT_CACHED
+
+        coords = None
+        if entry.lat is not None and entry.lng is not None:
+            coords = {'lat': entry.lat, 'lng': entry.lng}
+        # Promote to the in-process tier for the rest of the entry's lifetime
+        self._memory_set(key, coords, entry.expires_at.timestamp())
+        return coords
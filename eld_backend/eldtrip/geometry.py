@@ -0,0 +1,369 @@
+# Batched geometry kernels for route polylines
+import numpy as np
+
+# WGS-84 ellipsoid, the same model geopy's geodesic uses
+WGS84_A_MILES = 6378137.0 / 1609.344
+WGS84_F = 1 / 298.257223563
+# Mean earth radius for the spherical approximation
+EARTH_RADIUS_MILES = 3958.7613
+
+
+def _central_angles(lat1, lng1, lat2, lng2):
+    """Haversine central angle in radians between paired points given in radians"""
+    dlat = lat2 - lat1
+    dlng = lng2 - lng1
+    h = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+def segment_distances(lats, lngs, method='ellipsoidal'):
+    """
+    Distances in miles between consecutive points of a polyline.
+    
+    Parameters:
+    - lats, lngs: array-likes of degrees, one entry per point
+    - method: 'ellipsoidal' (default) or 'haversine'
+    
+    'ellipsoidal' uses Lambert's formula on the WGS-84 ellipsoid and agrees
+    with geopy.distance.geodesic to within 0.001% per segment (well under a
+    foot for typical route vertex spacing). 'haversine'
+    uses a sphere of mean radius and is within 0.5% of geodesic.
+    
+    Returns:
+    - float64 array of length len(lats) - 1
+    """
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lngs = np.radians(np.asarray(lngs, dtype=np.float64))
+    if lats.size < 2:
+        return np.zeros(0, dtype=np.float64)
+
+    if method == 'haversine':
+        return EARTH_RADIUS_MILES * _central_angles(lats[:-1], lngs[:-1], lats[1:], lngs[1:])
+    if method != 'ellipsoidal':
+        raise ValueError(f"Unknown distance method: {method}")
+
+    # Lambert's formula: central angle between reduced latitudes, then an
+    # ellipsoidal correction term
+    reduced = np.arctan((1 - WGS84_F) * np.tan(lats))
+    b1, b2 = reduced[:-1], reduced[1:]
+    sigma = _central_angles(b1, lngs[:-1], b2, lngs[1:])
+
+    p = (b1 + b2) / 2
+    q = (b2 - b1) / 2
+    sin_sigma = np.sin(sigma)
+    cos_half = np.cos(sigma / 2) ** 2
+    sin_half = np.sin(sigma / 2) ** 2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (sigma - sin_sigma) * (np.sin(p) ** 2 * np.cos(q) ** 2) / cos_half
+        y = (sigma + sin_sigma) * (np.cos(p) ** 2 * np.sin(q) ** 2) / sin_half
+    # Coincident points give 0/0 in y; their distance is zero either way
+    correction = np.where(sigma > 0, x + y, 0.0)
+
+    return WGS84_A_MILES * (sigma - WGS84_F / 2 * correction)
+
+
+def cumulative_distances(lats, lngs, method='ellipsoidal'):
+    """
+    Prefix sums of segment_distances: distance in miles from the first point
+    to each point, starting at 0.
+    
+    Returns:
+    - float64 array of length len(lats)
+    """
+    segments = segment_distances(lats, lngs, method=method)
+    cumulative = np.empty(segments.size + 1, dtype=np.float64)
+    cumulative[0] = 0.0
+    np.cumsum(segments, out=cumulative[1:])
+    return cumulative
+
+
+class RouteGeometry:
+    """
+    Compact polyline backed by two float64 arrays of latitudes and longitudes.
+    
+    Slicing returns a RouteGeometry sharing the same buffers, so leg
+    boundaries cost no copies. Indexing a single point returns a
+    {'lat', 'lng'} dict for compatibility with the older list-of-dicts
+    route_points. Conversion to nested lists only happens in tolist(), which
+    DRF's JSON encoder calls when the response is rendered.
+    """
+    __slots__ = ('lats', 'lngs')
+
+    def __init__(self, lats, lngs):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+
+    @classmethod
+    def from_lnglat(cls, coordinates):
+        """Build from GeoJSON-ordered [lng, lat(, elevation)] pairs"""
+        array = np.asarray(coordinates, dtype=np.float64)
+        if array.size == 0:
+            array = array.reshape(0, 2)
+        return cls(array[:, 1], array[:, 0])
+
+    @classmethod
+    def from_points(cls, points):
+        """Build from a list of {'lat', 'lng'} dicts"""
+        count = len(points)
+        lats = np.fromiter((point['lat'] for point in points), dtype=np.float64, count=count)
+        lngs = np.fromiter((point['lng'] for point in points), dtype=np.float64, count=count)
+        return cls(lats, lngs)
+
+    def __len__(self):
+        return self.lats.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RouteGeometry(self.lats[index], self.lngs[index])
+        return {'lat': float(self.lats[index]), 'lng': float(self.lngs[index])}
+
+    def point(self, index):
+        """[lat, lng] of one point, as plain floats"""
+        return [float(self.lats[index]), float(self.lngs[index])]
+
+    def leg(self, start_index, end_index):
+        """Zero-copy view of the points from start_index to end_index inclusive"""
+        return self[start_index:end_index + 1]
+
+    def cumulative_distances(self, method='ellipsoidal'):
+        return cumulative_distances(self.lats, self.lngs, method=method)
+
+    def simplified(self, tolerance, keep=()):
+        """
+        Douglas-Peucker simplified copy of the line.
+        
+        Returns:
+        - (RouteGeometry, kept indices into this geometry)
+        """
+        indices = simplify_indices(self.lats, self.lngs, tolerance, keep=keep)
+        return RouteGeometry(self.lats[indices], self.lngs[indices]), indices
+
+    def encode_polyline(self, precision=5):
+        return encode_polyline(self.lats, self.lngs, precision=precision)
+
+    def tolist(self):
+        """[[lat, lng], ...] for JSON serialization"""
+        return np.column_stack((self.lats, self.lngs)).tolist()
+
+    def __repr__(self):
+        return f"RouteGeometry({len(self)} points)"
+
+
+def zoom_tolerance(zoom):
+    """Simplification tolerance in degrees: about one pixel on a 256px-tile web map at this zoom"""
+    return 360.0 / (256 * 2 ** float(zoom))
+
+
+def simplify_indices(lats, lngs, tolerance, keep=()):
+    """
+    Douglas-Peucker simplification of a polyline.
+    
+    Distances are measured in degrees on a local equirectangular projection,
+    so the tolerance matches zoom_tolerance(). Indices in keep (and both
+    endpoints) always survive; the line is simplified independently between
+    them, so kept points lie exactly on the simplified line.
+    
+    Returns:
+    - sorted int array of the indices of the points to keep
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    count = lats.shape[0]
+    if count <= 2:
+        return np.arange(count)
+
+    # Scale longitudes so a degree means roughly the same distance in both axes
+    x = lngs * np.cos(np.radians(lats.mean()))
+    y = lats
+
+    mask = np.zeros(count, dtype=bool)
+    anchors = sorted({0, count - 1, *(int(i) for i in keep if 0 <= int(i) < count)})
+    mask[anchors] = True
+
+    stack = list(zip(anchors[:-1], anchors[1:]))
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        dx = x[end] - x[start]
+        dy = y[end] - y[start]
+        px = x[start + 1:end] - x[start]
+        py = y[start + 1:end] - y[start]
+        length_sq = dx * dx + dy * dy
+        if length_sq == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(px * dy - py * dx) / np.sqrt(length_sq)
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            mask[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+    return np.flatnonzero(mask)
+
+
+def encode_polyline(lats, lngs, precision=5):
+    """Encode a polyline in Google's encoded polyline algorithm format"""
+    factor = 10 ** precision
+    values = np.empty((len(lats), 2), dtype=np.int64)
+    values[:, 0] = np.round(np.asarray(lats, dtype=np.float64) * factor)
+    values[:, 1] = np.round(np.asarray(lngs, dtype=np.float64) * factor)
+
+    # Each point is stored as the difference from the previous one, zigzag encoded
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    deltas = (deltas << 1) ^ (deltas >> 63)
+
+    chunks = []
+    for value in deltas.tolist():
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+def decode_polyline(encoded, precision=5):
+    """
+    Decode a Google encoded polyline.
+    
+    Returns:
+    - (lats, lngs) float64 arrays
+    """
+    chars = np.frombuffer(encoded.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    if chars.size == 0:
+        return np.zeros(0), np.zeros(0)
+
+    # A chunk below 0x20 ends a value; values are little-endian groups of 5 bits
+    ends = chars < 0x20
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    value_of_chunk = np.cumsum(np.concatenate(([0], ends[:-1].astype(np.int64))))
+    shifts = 5 * (np.arange(chars.size) - starts[value_of_chunk])
+    values = np.add.reduceat((chars & 0x1f) << shifts, starts)
+
+    # Undo the zigzag encoding, then the delta encoding
+    values = (values >> 1) ^ -(values & 1)
+    points = np.cumsum(values.reshape(-1, 2), axis=0) / 10 ** precision
+    return points[:, 0], points[:, 1]
+
+
+MILES_PER_DEGREE_LAT = 69.05
+
+
+def haversine_miles(lat, lng, lats, lngs):
+    """Distance in miles from one point to each of many points"""
+    lat, lng = np.radians(lat), np.radians(lng)
+    return EARTH_RADIUS_MILES * _central_angles(lat, lng, np.radians(lats), np.radians(lngs))
+
+
+class GridIndex:
+    """
+    Uniform latitude/longitude grid over a fixed set of points.
+    
+    Points are sorted by cell, so the index is three arrays (sorted cell
+    keys, their offsets and the point order) rather than a dict of lists.
+    Nearest-neighbour and radius queries only look at the cells in rings
+    around the query point.
+    """
+    __slots__ = ('lats', 'lngs', 'cell_size', '_keys', '_starts', '_order')
+
+    _WIDTH = 1 << 20  # cells per row in the key space; more than enough at any cell size
+
+    def __init__(self, lats, lngs, cell_size=0.1):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+        self.cell_size = float(cell_size)
+
+        keys = self._cell_keys(self._rows(self.lats), self._cols(self.lngs))
+        self._order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[self._order]
+        self._keys, self._starts = np.unique(sorted_keys, return_index=True)
+        self._starts = np.append(self._starts, len(sorted_keys))
+
+    def __len__(self):
+        return self.lats.shape[0]
+
+    def _rows(self, lats):
+        return np.floor(np.asarray(lats) / self.cell_size).astype(np.int64)
+
+    def _cols(self, lngs):
+        return np.floor(np.asarray(lngs) / self.cell_size).astype(np.int64)
+
+    def _cell_keys(self, rows, cols):
+        return (rows + self._WIDTH // 2) * self._WIDTH + (cols + self._WIDTH // 2)
+
+    def _ring_points(self, row, col, ring):
+        """Indices of the points in the cells exactly `ring` cells away from (row, col)"""
+        if ring == 0:
+            rows, cols = np.array([row]), np.array([col])
+        else:
+            span = np.arange(-ring, ring + 1)
+            rows = np.concatenate((np.full(span.size, row - ring), np.full(span.size, row + ring),
+                                   row + span[1:-1], row + span[1:-1]))
+            cols = np.concatenate((col + span, col + span,
+                                   np.full(span.size - 2, col - ring), np.full(span.size - 2, col + ring)))
+        keys = self._cell_keys(rows, cols)
+        positions = np.searchsorted(self._keys, keys)
+        valid = positions < self._keys.size
+        positions, keys = positions[valid], keys[valid]
+        positions = positions[self._keys[positions] == keys]
+        if positions.size == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([self._order[self._starts[p]:self._starts[p + 1]] for p in positions])
+
+    def _ring_clearance(self, lat, ring):
+        """Lower bound in miles on the distance to any point outside the first `ring` rings"""
+        lat_extent = min(abs(lat) + (ring + 1) * self.cell_size, 89.9)
+        return ring * self.cell_size * MILES_PER_DEGREE_LAT * np.cos(np.radians(lat_extent))
+
+    def nearest(self, lat, lng, max_distance=None):
+        """
+        Nearest point to (lat, lng).
+        
+        Returns:
+        - (index, distance in miles), or (None, None) if no point lies within max_distance
+        """
+        if len(self) == 0:
+            return None, None
+
+        row, col = int(self._rows(lat)), int(self._cols(lng))
+        best_index, best_distance = None, np.inf
+        max_ring = int(np.ceil(180 / self.cell_size))
+        for ring in range(max_ring + 1):
+            candidates = self._ring_points(row, col, ring)
+            if candidates.size:
+                distances = haversine_miles(lat, lng, self.lats[candidates], self.lngs[candidates])
+                i = int(np.argmin(distances))
+                if distances[i] < best_distance:
+                    best_index, best_distance = int(candidates[i]), float(distances[i])
+            clearance = self._ring_clearance(lat, ring)
+            if best_distance <= clearance or (max_distance is not None and clearance > max_distance):
+                break
+
+        if best_index is None or (max_distance is not None and best_distance > max_distance):
+            return None, None
+        return best_index, best_distance
+
+    def within(self, lat, lng, radius):
+        """Indices of all points within radius miles of (lat, lng), nearest first"""
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        row, col = int(self._rows(lat)), int(self._cols(lng))
+        found = []
+        ring = 0
+        while True:
+            found.append(self._ring_points(row, col, ring))
+            if self._ring_clearance(lat, ring) > radius or ring * self.cell_size >= 180:
+                break
+            ring += 1
+
+        candidates = np.concatenate(found)
+        distances = haversine_miles(lat, lng, self.lats[candidates], self.lngs[candidates])
+        inside = distances <= radius
+        candidates, distances = candidates[inside], distances[inside]
+        return candidates[np.argsort(distances, kind='stable')]
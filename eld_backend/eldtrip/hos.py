@@ -0,0 +1,228 @@
+# Event-driven hours-of-service (HOS) stop planning over a route's distance/time profile
+import math
+
+import numpy as np
+
+from .cycle import CYCLE_LIMIT_HOURS, RESTART_HOURS
+
+AVERAGE_SPEED_MPH = 55
+MAX_DRIVING_HOURS = 11  # per shift
+MAX_ON_DUTY_WINDOW_HOURS = 14  # per shift, measured from the start of the shift
+BREAK_AFTER_DRIVING_HOURS = 8
+BREAK_DURATION_HOURS = 0.5
+REST_DURATION_HOURS = 10
+FUEL_INTERVAL_MILES = 550
+STOP_ON_DUTY_HOURS = 1  # pickup, dropoff and any extra stop
+
+# Float slack when comparing accumulated hours against a limit
+_EPSILON = 1e-9
+
+
+class _RouteProfile:
+    """Cumulative distance/time along a polyline, with interpolated lookups"""
+
+    def __init__(self, geometry, cumulative_distance, cumulative_time):
+        self.geometry = geometry
+        self.distance = np.asarray(cumulative_distance, dtype=np.float64)
+        self.time = np.asarray(cumulative_time, dtype=np.float64)
+
+    def distance_at_time(self, hours):
+        return float(np.interp(hours, self.time, self.distance))
+
+    def time_at_distance(self, miles):
+        return float(np.interp(miles, self.distance, self.time))
+
+    def locate(self, miles):
+        """
+        Position of a point a given distance along the route.
+
+        Returns:
+        - ([lat, lng], index of the route segment the point lies on)
+        """
+        last_segment = max(len(self.distance) - 2, 0)
+        segment = int(np.searchsorted(self.distance, miles, side='right')) - 1
+        segment = min(max(segment, 0), last_segment)
+
+        if len(self.distance) < 2:
+            return self.geometry.point(0), 0
+
+        start = self.distance[segment]
+        length = self.distance[segment + 1] - start
+        fraction = (miles - start) / length if length > 0 else 0.0
+        fraction = min(max(fraction, 0.0), 1.0)
+
+        lats, lngs = self.geometry.lats, self.geometry.lngs
+        lat = lats[segment] + (lats[segment + 1] - lats[segment]) * fraction
+        lng = lngs[segment] + (lngs[segment + 1] - lngs[segment]) * fraction
+        return [float(lat), float(lng)], segment
+
+
+def plan_hos_stops(geometry, cumulative_distance, leg_end_indices,
+                   current_cycle_hours=0, avg_speed=AVERAGE_SPEED_MPH,
+                   cumulative_time=None, cycle_hours_available=None, snap=None):
+    """
+    Place rest breaks, 10-hour rests and fuel stops along a multi-leg route.
+    
+    Instead of walking every route point, the planner computes how much
+    driving time remains until each upcoming event (30-minute break, 11-hour
+    driving limit, 14-hour window, 70-hour cycle, fuel threshold, end of
+    leg), jumps
+    straight to the earliest one and looks up its exact position on the
+    cumulative profile with a binary search. Work is proportional to the
+    number of stops, not the number of route points.
+    
+    Parameters:
+    - geometry: RouteGeometry of the whole route
+    - cumulative_distance: miles from the start to each route point
+    - leg_end_indices: route point index where each leg ends; every leg end
+      except the last is an on-duty stop (pickup or extra stop)
+    - current_cycle_hours: hours already used in the current shift
+    - avg_speed: mph, used to derive the time profile when none is given
+    - cumulative_time: optional driving hours from the start to each route point
+    - cycle_hours_available: hours left in the driver's 70-hour/8-day cycle
+      (default: 70 - current_cycle_hours); when they run out a 34-hour
+      restart is planned. Hours rolling out of the 8-day window during the
+      trip are not given back, so the estimate errs on the safe side.
+    - snap: optional callable(distance, min_distance, kind) returning the
+      facility to stop at instead ({'distance', 'coordinates', 'facility'},
+      somewhere after min_distance and no later than distance) or None;
+      kind is 'rest', 'fuel' or 'rest_fuel'. The stop then happens there and
+      the HOS counters continue from it.
+    
+    Returns:
+    - (rest_stops, fuel_stops, stop_segments) where stop_segments holds the
+      index of the route segment each stop was interpolated onto
+    """
+    if cumulative_time is None:
+        cumulative_time = np.asarray(cumulative_distance, dtype=np.float64) / avg_speed
+    profile = _RouteProfile(geometry, cumulative_distance, cumulative_time)
+    total_distance = float(profile.distance[-1]) if len(profile.distance) else 0.0
+    leg_end_times = [float(profile.time[index]) for index in leg_end_indices]
+
+    current_cycle_hours = float(current_cycle_hours)
+    shift_driving = min(current_cycle_hours, MAX_DRIVING_HOURS)
+    shift_window = min(current_cycle_hours, MAX_ON_DUTY_WINDOW_HOURS)
+    driving_since_break = min(current_cycle_hours, BREAK_AFTER_DRIVING_HOURS)
+    if cycle_hours_available is None:
+        cycle_hours_available = CYCLE_LIMIT_HOURS - current_cycle_hours
+    cycle_remaining = float(cycle_hours_available)
+
+    rest_stops = []
+    fuel_stops = []
+    stop_segments = []
+
+    hours = 0.0  # driving time position along the profile
+    last_fuel_distance = 0.0
+    leg = 0
+
+    while leg < len(leg_end_times):
+        next_fuel_distance = last_fuel_distance + FUEL_INTERVAL_MILES
+        to_fuel = math.inf
+        if next_fuel_distance < total_distance:
+            to_fuel = profile.time_at_distance(next_fuel_distance) - hours
+
+        step = min(
+            BREAK_AFTER_DRIVING_HOURS - driving_since_break,
+            MAX_DRIVING_HOURS - shift_driving,
+            MAX_ON_DUTY_WINDOW_HOURS - shift_window,
+            cycle_remaining,
+            to_fuel,
+            leg_end_times[leg] - hours,
+        )
+        step = max(step, 0.0)
+        fuel_due = to_fuel - step <= _EPSILON
+
+        hours += step
+        shift_driving += step
+        shift_window += step
+        driving_since_break += step
+        cycle_remaining -= step
+
+        if hours >= leg_end_times[leg] - _EPSILON:
+            hours = leg_end_times[leg]
+            if leg == len(leg_end_times) - 1:
+                break
+            # On duty, not driving, at the pickup or extra stop
+            shift_window += STOP_ON_DUTY_HOURS
+            cycle_remaining -= STOP_ON_DUTY_HOURS
+            leg += 1
+            continue
+
+        driving_limit_reached = shift_driving >= MAX_DRIVING_HOURS - _EPSILON
+        restart_due = cycle_remaining <= _EPSILON
+        rest_due = driving_limit_reached or shift_window >= MAX_ON_DUTY_WINDOW_HOURS - _EPSILON
+        break_due = driving_since_break >= BREAK_AFTER_DRIVING_HOURS - _EPSILON
+
+        distance = profile.distance_at_time(hours)
+        coordinates, segment = profile.locate(distance)
+        location = "En route to pickup" if leg == 0 else "En route to dropoff"
+
+        facility = None
+        if snap is not None and (restart_due or rest_due or break_due or fuel_due):
+            kind = 'fuel' if not (restart_due or rest_due or break_due) else 'rest_fuel' if fuel_due else 'rest'
+            snapped = snap(distance, profile.distance_at_time(hours - step), kind)
+            if snapped is not None:
+                # Stop at the facility instead, before the limit is reached
+                back = max(hours - profile.time_at_distance(snapped['distance']), 0.0)
+                hours -= back
+                shift_driving -= back
+                shift_window -= back
+                driving_since_break -= back
+                cycle_remaining += back
+                distance = snapped['distance']
+                coordinates = snapped['coordinates']
+                segment = profile.locate(distance)[1]
+                facility = snapped['facility']
+
+        if restart_due:
+            rest_stops.append({
+                'coordinates': coordinates,
+                'duration': RESTART_HOURS,
+                'reason': "34-hour restart (70-hour/8-day limit)",
+                'distance': distance,
+                'location': location,
+                'facility': facility
+            })
+            stop_segments.append(segment)
+            shift_driving = 0.0
+            shift_window = 0.0
+            driving_since_break = 0.0
+            cycle_remaining = float(CYCLE_LIMIT_HOURS)
+        elif rest_due:
+            rest_stops.append({
+                'coordinates': coordinates,
+                'duration': REST_DURATION_HOURS,
+                'reason': "10-hour rest (11-hour driving limit)" if driving_limit_reached
+                          else "10-hour rest (14-hour on-duty limit)",
+                'distance': distance,
+                'location': location,
+                'facility': facility
+            })
+            stop_segments.append(segment)
+            shift_driving = 0.0
+            shift_window = 0.0
+            driving_since_break = 0.0
+        elif break_due:
+            rest_stops.append({
+                'coordinates': coordinates,
+                'duration': BREAK_DURATION_HOURS,
+                'reason': "30-minute break (8-hour driving limit)",
+                'distance': distance,
+                'location': location,
+                'facility': facility
+            })
+            stop_segments.append(segment)
+            shift_window += BREAK_DURATION_HOURS
+            driving_since_break = 0.0
+
+        if fuel_due:
+            fuel_stops.append({
+                'coordinates': coordinates,
+                'distance': distance,
+                'location': location,
+                'facility': facility
+            })
+            stop_segments.append(segment)
+            last_fuel_distance = distance
+
+    return rest_stops, fuel_stops, stop_segments
@@ -0,0 +1,221 @@
+# Per-request stage timings, Prometheus metrics and a sampling profiler for slow requests
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Requests slower than this are profiled (None turns the profiler off)
+PROFILE_SLOW_REQUEST_MS = getattr(settings, 'PROFILE_SLOW_REQUEST_MS', None)
+PROFILE_SAMPLE_INTERVAL_MS = getattr(settings, 'PROFILE_SAMPLE_INTERVAL_MS', 5)
+# Where slow request profiles are written as collapsed stacks (default: printed)
+PROFILE_OUTPUT_DIR = getattr(settings, 'PROFILE_OUTPUT_DIR', None)
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+_current_timings = contextvars.ContextVar('eldtrip_request_timings', default=None)
+
+
+class RequestTimings:
+    """Total time and count per span name for one request; safe to add to from worker threads"""
+
+    def __init__(self):
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            total, count = self.spans.get(name, (0.0, 0))
+            self.spans[name] = (total + seconds, count + 1)
+
+    def server_timing(self):
+        """Server-Timing header value, one metric per span name"""
+        with self._lock:
+            spans = list(self.spans.items())
+        return ', '.join(
+            f'{name};dur={total * 1000:.1f}' + (f';desc="{count} calls"' if count > 1 else '')
+            for name, (total, count) in spans
+        )
+
+
+@contextmanager
+def request_timings():
+    """Collect the spans of the current request (and of work it hands to copied contexts)"""
+    timings = RequestTimings()
+    token = _current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _current_timings.reset(token)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+    def __init__(self, name, help_text, labelnames):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in pairs) + '}'
+
+
+class Counter(_Metric):
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.help_text}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f'{self.name}{self._labels(key)} {value}'
+
+
+class Histogram(_Metric):
+    def __init__(self, name, help_text, labelnames=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Per-bucket counts, then +Inf, sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.help_text}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{self._labels(key, [("le", str(bound))])} {cumulative}'
+            yield f'{self.name}_sum{self._labels(key)} {counts[-1]}'
+            yield f'{self.name}_count{self._labels(key)} {cumulative}'
+
+
+stage_seconds = Histogram('eldtrip_stage_seconds', 'Time spent in each planning stage', ['stage'])
+request_seconds = Histogram('eldtrip_request_seconds', 'eldtrip API request latency', ['view', 'method', 'status'])
+response_bytes = Histogram('eldtrip_response_bytes', 'eldtrip API response body size', ['view'], SIZE_BUCKETS)
+provider_request_seconds = Histogram('eldtrip_provider_request_seconds',
+                                     'Latency of each HTTP request to a provider', ['provider', 'status'])
+provider_response_bytes = Histogram('eldtrip_provider_response_bytes',
+                                    'Body size of provider responses', ['provider'], SIZE_BUCKETS)
+# reason is 'throttled' (retried by ProviderClient) or 'transport' (connection errors and
+# RETRY_STATUSES, retried inside the connection pool)
+provider_retries = Counter('eldtrip_provider_retries_total', 'Provider requests retried', ['provider', 'reason'])
+
+METRICS = [stage_seconds, request_seconds, response_bytes,
+           provider_request_seconds, provider_response_bytes, provider_retries]
+_collectors = []
+
+
+def register_collector(collect):
+    """Add a callable yielding extra exposition lines (e.g. gauges read at scrape time)"""
+    _collectors.append(collect)
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.collect())
+    for collect in _collectors:
+        lines.extend(collect())
+    return '\n'.join(lines) + '\n'
+
+
+def record_span(name, seconds):
+    """Record a finished span in the stage histogram and the current request's timings"""
+    stage_seconds.observe(seconds, stage=name)
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def span(name):
+    """Time a block as one span of stage name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+class SamplingProfiler:
+    """
+    Samples one thread's stack every interval seconds from a background
+    thread, counting collapsed stacks ("file:function;..." root first),
+    the input format of flame graph tools.
+    """
+
+    def __init__(self, thread_id=None, interval=PROFILE_SAMPLE_INTERVAL_MS / 1000):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.stacks = _Tally()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='eldtrip-profiler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def report(self, label):
+        """Write the collapsed stacks to PROFILE_OUTPUT_DIR, or print the most sampled ones"""
+        if PROFILE_OUTPUT_DIR:
+            os.makedirs(PROFILE_OUTPUT_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_OUTPUT_DIR, f'{time.strftime("%Y%m%d-%H%M%S")}-{label}.folded')
+            with open(path, 'w') as f:
+                f.writelines(f'{stack} {count}\n' for stack, count in self.stacks.items())
+            print(f"Slow request profile written to {path}")
+        else:
+            print(f"Slow request profile ({label}), most sampled stacks:")
+            for stack, count in self.stacks.most_common(5):
+                print(f"  {count:>5}  {stack}")
@@ -0,0 +1,261 @@
+# Database-backed queue of trip planning jobs, with leases, retries and a local worker pool
+import os
+import socket
+import threading
+from datetime import datetime, timedelta, timezone
+
+import requests
+from django.conf import settings
+from django.db import OperationalError, connection
+from django.db.models import F, Q
+
+from .models import PlanningJob
+from .renderers import dumps
+
+JOB_MAX_ATTEMPTS = getattr(settings, 'JOB_MAX_ATTEMPTS', 3)
+# A running job whose worker stops renewing its lease is picked up again after this
+JOB_LEASE_SECONDS = getattr(settings, 'JOB_LEASE_SECONDS', 120)
+# Delay before the first retry, doubled for each later one
+JOB_RETRY_BACKOFF_SECONDS = getattr(settings, 'JOB_RETRY_BACKOFF_SECONDS', 30)
+JOB_POLL_INTERVAL = getattr(settings, 'JOB_POLL_INTERVAL', 1.0)  # seconds
+JOB_WORKER_CONCURRENCY = getattr(settings, 'JOB_WORKER_CONCURRENCY', 4)
+JOB_RETENTION_DAYS = getattr(settings, 'JOB_RETENTION_DAYS', 7)
+
+# kind -> callable(request) returning the result, or a dict with 'error' (and
+# 'retryable': True for a provider or transport failure worth another attempt)
+_handlers = {}
+
+# Exceptions from a handler that are worth another attempt; any other fails the job
+RETRYABLE_EXCEPTIONS = (requests.RequestException, OperationalError)
+
+
+def register_job_handler(kind, handler):
+    """Make jobs of this kind runnable; handlers are registered where the planning code lives"""
+    _handlers[kind] = handler
+
+
+def job_kinds():
+    return sorted(_handlers)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def submit_job(kind, request):
+    """Queue a job and return its ID"""
+    if kind not in _handlers:
+        raise ValueError(f"Unknown job kind: {kind}")
+    job = PlanningJob.objects.create(
+        kind=kind,
+        request=request,
+        max_attempts=JOB_MAX_ATTEMPTS,
+        run_after=_now(),
+    )
+    return str(job.id)
+
+
+def claim_job(worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Lease the oldest runnable job to worker_id.
+
+    A job is runnable when it is queued and due, or running under an
+    expired lease (its worker died). Claiming is a conditional UPDATE on
+    the row's current state, so two workers never hold the same job, on
+    any database backend.
+
+    Returns:
+    - the claimed PlanningJob, or None when nothing is runnable
+    """
+    now = _now()
+    runnable = (Q(status=PlanningJob.QUEUED, run_after__lte=now)
+                | Q(status=PlanningJob.RUNNING, lease_expires_at__lte=now))
+    for job in PlanningJob.objects.filter(runnable).order_by('run_after').only(
+            'id', 'status', 'attempts', 'max_attempts', 'lease_owner')[:10]:
+        current = PlanningJob.objects.filter(id=job.id, status=job.status, lease_owner=job.lease_owner,
+                                             attempts=job.attempts)
+        if job.attempts >= job.max_attempts:
+            # Its last attempt's worker died
+            current.update(status=PlanningJob.FAILED, lease_owner=None, lease_expires_at=None, finished_at=now,
+                           error=f"Lease expired after {job.attempts} attempts")
+            continue
+        claimed = current.update(
+            status=PlanningJob.RUNNING,
+            attempts=F('attempts') + 1,
+            lease_owner=worker_id,
+            lease_expires_at=now + timedelta(seconds=lease_seconds),
+        )
+        if claimed:
+            return PlanningJob.objects.get(id=job.id)
+    return None
+
+
+def renew_leases(worker_id, job_ids, lease_seconds=JOB_LEASE_SECONDS):
+    """Extend the leases worker_id still holds on job_ids"""
+    return PlanningJob.objects.filter(id__in=job_ids, lease_owner=worker_id, status=PlanningJob.RUNNING).update(
+        lease_expires_at=_now() + timedelta(seconds=lease_seconds)
+    )
+
+
+def _finish(job, worker_id, **fields):
+    """Update a job only while worker_id still holds it; a lost lease drops the outcome"""
+    return PlanningJob.objects.filter(id=job.id, lease_owner=worker_id, status=PlanningJob.RUNNING).update(
+        lease_owner=None, lease_expires_at=None, **fields
+    )
+
+
+def run_job(job, worker_id):
+    """
+    Run a claimed job and record its outcome.
+
+    Provider and transport failures (error results marked retryable, and
+    RETRYABLE_EXCEPTIONS) are retried with exponential backoff until the
+    job has used max_attempts; the last error is kept. Anything else, such
+    as an address that can't be geocoded or an invalid request, fails the
+    job at once.
+
+    Returns:
+    - the job's new status
+    """
+    try:
+        result = _handlers[job.kind](job.request)
+        error = result.get('error') if isinstance(result, dict) else None
+        retryable = error is not None and result.get('retryable') is True
+    except Exception as e:
+        result, error = None, str(e) or type(e).__name__
+        retryable = isinstance(e, RETRYABLE_EXCEPTIONS)
+
+    if error is None:
+        _finish(job, worker_id, status=PlanningJob.SUCCEEDED, result=dumps(result), error='', finished_at=_now())
+        return PlanningJob.SUCCEEDED
+
+    print(f"Planning job {job.id} attempt {job.attempts} failed: {error}")
+    if not retryable or job.attempts >= job.max_attempts:
+        _finish(job, worker_id, status=PlanningJob.FAILED, error=error, finished_at=_now())
+        return PlanningJob.FAILED
+    backoff = JOB_RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1)
+    _finish(job, worker_id, status=PlanningJob.QUEUED, error=error, run_after=_now() + timedelta(seconds=backoff))
+    return PlanningJob.QUEUED
+
+
+def purge_finished_jobs():
+    """Delete finished jobs older than the retention period, returning the number removed"""
+    cutoff = _now() - timedelta(days=JOB_RETENTION_DAYS)
+    deleted, _ = PlanningJob.objects.filter(
+        status__in=(PlanningJob.SUCCEEDED, PlanningJob.FAILED), finished_at__lte=cutoff
+    ).delete()
+    return deleted
+
+
+class JobWorkerPool:
+    """
+    Worker threads that claim and run planning jobs from the database.
+
+    Each thread runs one job at a time under its own worker ID; a
+    heartbeat thread renews the leases of running jobs every third of the
+    lease, so only jobs of a dead process are ever picked up again.
+    """
+
+    def __init__(self, concurrency=JOB_WORKER_CONCURRENCY, poll_interval=JOB_POLL_INTERVAL,
+                 lease_seconds=JOB_LEASE_SECONDS):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.counts = {PlanningJob.SUCCEEDED: 0, PlanningJob.FAILED: 0, PlanningJob.QUEUED: 0}
+        self._running = {}  # worker ID -> job ID
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self, exit_when_idle=False):
+        self._threads = [
+            threading.Thread(target=self._work, args=(f"{self.name}:{n}", exit_when_idle),
+                             name=f'eldtrip-job-worker-{n}', daemon=True)
+            for n in range(self.concurrency)
+        ]
+        self._threads.append(threading.Thread(target=self._heartbeat, name='eldtrip-job-heartbeat', daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stop claiming jobs and wait for the running ones to finish"""
+        self._stop.set()
+        self.join()
+
+    def join(self):
+        for thread in self._threads[:-1]:
+            thread.join()
+        self._stop.set()
+        self._threads[-1].join()
+
+    def _work(self, worker_id, exit_when_idle):
+        try:
+            while not self._stop.is_set():
+                try:
+                    job = claim_job(worker_id, self.lease_seconds)
+                except Exception as e:
+                    print(f"Error claiming planning job: {e}")
+                    job = None
+                if job is None:
+                    if exit_when_idle:
+                        return
+                    self._stop.wait(self.poll_interval)
+                    continue
+
+                with self._lock:
+                    self._running[worker_id] = job.id
+                try:
+                    outcome = run_job(job, worker_id)
+                except Exception as e:
+                    # The lease runs out and another attempt picks the job up
+                    print(f"Error recording planning job {job.id}: {e}")
+                    outcome = None
+                with self._lock:
+                    del self._running[worker_id]
+                    if outcome is not None:
+                        self.counts[outcome] += 1
+        finally:
+            connection.close()
+
+    def _heartbeat(self):
+        try:
+            while not self._stop.wait(self.lease_seconds / 3):
+                with self._lock:
+                    running = list(self._running.items())
+                for worker_id, job_id in running:
+                    try:
+                        renew_leases(worker_id, [job_id], self.lease_seconds)
+                    except Exception as e:
+                        print(f"Error renewing planning job lease: {e}")
+        finally:
+            connection.close()
+
+
+def job_status(job_id):
+    """
+    A job's state for the polling endpoint.
+
+    Returns:
+    - (status dict, rendered result JSON bytes or None), or (None, None) if there is no such job
+    """
+    try:
+        job = PlanningJob.objects.filter(id=job_id).first()
+    except Exception as e:
+        # Malformed IDs raise a ValidationError
+        print(f"Error loading planning job {job_id}: {e}")
+        return None, None
+    if job is None:
+        return None, None
+    status = {
+        'jobId': str(job.id),
+        'kind': job.kind,
+        'status': job.status,
+        'attempts': job.attempts,
+        'createdAt': job.created_at.isoformat(),
+        'finishedAt': job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.error:
+        status['error'] = job.error
+    return status, bytes(job.result) if job.result is not None else None
@@ -0,0 +1,285 @@
+import json
+import os
+import time
+import tracemalloc
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from requests import Response
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+from eldtrip import views
+from eldtrip.geocache import GeocodeCache
+from eldtrip.geometry import RouteGeometry
+from eldtrip.providers import TokenBucket, nominatim, openrouteservice
+from eldtrip.renderers import FastJSONRenderer
+from eldtrip.routecache import MemoryRouteCacheBackend, RouteCache
+
+# name -> (route miles, route vertices)
+SCENARIOS = {
+    'short': (60, 1_000),
+    'regional': (600, 10_000),
+    'cross-country': (2_800, 100_000),
+}
+STAGES = ('geocode', 'route', 'plan', 'eld_logs', 'render', 'total')
+METERS_PER_MILE = 1609.34
+
+
+def synthetic_fixture(miles, vertices, seed=0):
+    """
+    A trip with Nominatim and ORS responses shaped like recorded ones: a
+    wandering line of the given length and vertex count through current,
+    pickup and dropoff locations.
+    """
+    rng = np.random.default_rng(seed)
+    heading = rng.uniform(0, 2 * np.pi)
+    steps = np.full(vertices - 1, miles / (vertices - 1)) * rng.uniform(0.5, 1.5, vertices - 1)
+    steps *= miles / steps.sum()
+    headings = heading + np.cumsum(rng.normal(0, 0.05, vertices - 1))
+    lats = np.concatenate(([37.0], 37.0 + np.cumsum(steps * np.cos(headings)) / 69.0))
+    lngs = np.concatenate(([-95.0], -95.0 + np.cumsum(steps * np.sin(headings)) / 55.0))
+
+    geometry = RouteGeometry(lats, lngs)
+    cumulative = geometry.cumulative_distances()
+    pickup = vertices // 5
+    way_points = [0, pickup, vertices - 1]
+    segments = [{
+        'distance': float(cumulative[end] - cumulative[start]) * METERS_PER_MILE,
+        'duration': float(cumulative[end] - cumulative[start]) / 55 * 3600,
+    } for start, end in zip(way_points, way_points[1:])]
+
+    trip = {'currentLocation': 'Bench Origin', 'pickupLocation': 'Bench Pickup',
+            'dropoffLocation': 'Bench Dropoff', 'currentCycleHours': 12}
+    return {
+        'trip': trip,
+        'geocode': {
+            trip[field]: [{'lat': str(lats[index]), 'lon': str(lngs[index])}]
+            for field, index in zip(('currentLocation', 'pickupLocation', 'dropoffLocation'), way_points)
+        },
+        'directions': {'features': [{
+            'geometry': {'coordinates': np.column_stack([lngs, lats]).tolist()},
+            'properties': {'segments': segments, 'way_points': way_points},
+        }]},
+    }
+
+
+class FixtureAdapter(BaseAdapter):
+    """Transport answering Nominatim searches and ORS directions from a fixture"""
+
+    def __init__(self, fixture):
+        super().__init__()
+        # Encoded once, so the benchmark times decoding but not encoding
+        self.directions = json.dumps(fixture['directions']).encode()
+        self.geocode = {query: json.dumps(body).encode() for query, body in fixture['geocode'].items()}
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        if '/directions/' in url.path:
+            content = self.directions
+        else:
+            content = self.geocode.get(parse_qs(url.query).get('q', [''])[0], b'[]')
+
+        response = Response()
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        response._content = content
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Live transport that keeps the responses in fixture form"""
+
+    def __init__(self, fixture, **kwargs):
+        super().__init__(**kwargs)
+        self.fixture = fixture
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        url = urlsplit(request.url)
+        if '/directions/' in url.path:
+            self.fixture['directions'] = response.json()
+        else:
+            self.fixture['geocode'][parse_qs(url.query).get('q', [''])[0]] = response.json()
+        return response
+
+
+class ProviderTransport:
+    """Mount an adapter on the shared provider sessions, with rate limiting off"""
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+
+    def __enter__(self):
+        self.saved = []
+        for client in (nominatim, openrouteservice):
+            self.saved.append((client, dict(client.session.adapters), client.bucket))
+            client.session.mount('https://', self.adapter)
+            client.session.mount('http://', self.adapter)
+            client.bucket = TokenBucket(None)
+        return self
+
+    def __exit__(self, *exc):
+        for client, adapters, bucket in self.saved:
+            client.session.adapters.clear()
+            client.session.adapters.update(adapters)
+            client.bucket = bucket
+
+
+def run_pipeline(trip, stage_callback):
+    """
+    One cold plan-trip request split into stages, calling
+    stage_callback(stage, func) to run and measure each one.
+
+    Each run gets its own empty in-memory geocode and route caches, so the
+    shared caches (and their tables) of a live process are left alone.
+    """
+    geocode_cache = GeocodeCache(views.geocode_address, persistent=False)
+    route_cache = RouteCache(MemoryRouteCacheBackend())
+    waypoints = stage_callback('geocode', lambda: [views.cached_geocode_address(location, cache=geocode_cache)
+                                                   for location in views.trip_locations(trip)])
+    route = stage_callback('route', lambda: views.get_waypoint_route(waypoints, cache=route_cache))
+    plan = stage_callback('plan', lambda: views.build_route_plan(trip, waypoints, route))
+    if 'error' in plan:
+        raise CommandError(f"Pipeline failed: {plan['error']}")
+    logs = stage_callback('eld_logs', lambda: views.generate_eld_logs(plan))
+    stage_callback('render', lambda: FastJSONRenderer().render({'route': plan, 'eldLogs': logs}))
+
+
+def measure(trip, repeat):
+    """
+    Stage timings over repeat runs, then one run under tracemalloc.
+
+    Returns:
+    - {stage: {'p50', 'p90', 'p99', 'max' (ms), 'peak_kib', 'allocations'}}
+    """
+    timings = {stage: [] for stage in STAGES}
+
+    def timed(stage, func):
+        start = time.perf_counter()
+        result = func()
+        timings[stage].append(time.perf_counter() - start)
+        return result
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run_pipeline(trip, timed)
+        timings['total'].append(time.perf_counter() - start)
+
+    memory = {}
+    peaks = []
+
+    def traced(stage, func):
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        peaks.append(peak)
+        after = tracemalloc.take_snapshot()
+        blocks = sum(max(stat.count_diff, 0) for stat in after.compare_to(before, 'lineno'))
+        memory[stage] = (peak - base, blocks)
+        return result
+
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        run_pipeline(trip, traced)
+        memory['total'] = (max(peaks) - base, sum(blocks for _, blocks in memory.values()))
+    finally:
+        tracemalloc.stop()
+
+    results = {}
+    for stage in STAGES:
+        ms = np.asarray(timings[stage]) * 1000
+        results[stage] = {
+            'p50': float(np.percentile(ms, 50)),
+            'p90': float(np.percentile(ms, 90)),
+            'p99': float(np.percentile(ms, 99)),
+            'max': float(ms.max()),
+            'peak_kib': memory[stage][0] / 1024,
+            'allocations': memory[stage][1],
+        }
+    return results
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the trip planning pipeline per stage against recorded or synthetic "
+            "provider fixtures, optionally comparing with a stored baseline")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                            help='Scenario to run (repeatable, default: all)')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--fixtures', help='Directory of recorded <scenario>.json fixtures')
+        parser.add_argument('--record', metavar='DIR',
+                            help='Plan each fixture trip against the live providers and save the responses to DIR')
+        parser.add_argument('--save-baseline', metavar='PATH', help='Write the results to PATH as JSON')
+        parser.add_argument('--baseline', metavar='PATH', help='Compare p50 latencies with a saved baseline')
+        parser.add_argument('--threshold', type=float, default=10.0,
+                            help='p50 slowdown in percent reported as a regression (default 10)')
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def load_fixture(self, name, directory):
+        if directory:
+            path = os.path.join(directory, f'{name}.json')
+            if os.path.exists(path):
+                with open(path) as f:
+                    return json.load(f)
+        return synthetic_fixture(*SCENARIOS[name])
+
+    def handle(self, *args, **options):
+        names = options['scenario'] or list(SCENARIOS)
+
+        if options['record']:
+            os.makedirs(options['record'], exist_ok=True)
+            for name in names:
+                fixture = {'trip': self.load_fixture(name, options['fixtures'])['trip'],
+                           'geocode': {}, 'directions': None}
+                with ProviderTransport(RecordingAdapter(fixture)):
+                    run_pipeline(fixture['trip'], lambda stage, func: func())
+                with open(os.path.join(options['record'], f'{name}.json'), 'w') as f:
+                    json.dump(fixture, f)
+                self.stdout.write(f"Recorded {name}")
+            return
+
+        baseline = {}
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        results = {}
+        regressions = []
+        for name in names:
+            fixture = self.load_fixture(name, options['fixtures'])
+            vertices = len(fixture['directions']['features'][0]['geometry']['coordinates'])
+            with ProviderTransport(FixtureAdapter(fixture)):
+                results[name] = measure(fixture['trip'], options['repeat'])
+
+            self.stdout.write(f"\n{name} ({vertices} vertices, {options['repeat']} runs)")
+            self.stdout.write(f"{'stage':<10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}"
+                              f"{'peak KiB':>11}{'allocs':>9}{'vs base':>10}")
+            for stage, row in results[name].items():
+                line = (f"{stage:<10}{row['p50']:>8.2f}ms{row['p90']:>8.2f}ms{row['p99']:>8.2f}ms"
+                        f"{row['max']:>8.2f}ms{row['peak_kib']:>11.1f}{row['allocations']:>9}")
+                base = baseline.get(name, {}).get(stage)
+                if base and base['p50'] > 0:
+                    change = (row['p50'] / base['p50'] - 1) * 100
+                    line += f"{change:>+9.1f}%"
+                    if change > options['threshold']:
+                        line += '  REGRESSION'
+                        regressions.append(f"{name}/{stage} {change:+.1f}%")
+                self.stdout.write(line)
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"\nBaseline written to {options['save_baseline']}")
+
+        if regressions and options['fail_on_regression']:
+            raise CommandError(f"p50 regressions over {options['threshold']}%: {', '.join(regressions)}")
@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from eldtrip.geometry import RouteGeometry
+from eldtrip.renderers import FastJSONRenderer, orjson
+
+
+def route_payload(points, as_geometry):
+    """calculate_route-shaped response with a random-walk geometry of the given size"""
+    rng = np.random.default_rng(0)
+    lats = 35 + np.cumsum(rng.normal(0, 0.001, points))
+    lngs = -100 + np.cumsum(rng.normal(0, 0.001, points))
+    geometry = RouteGeometry(lats, lngs)
+    stops = [
+        {'coordinates': geometry.point(i), 'duration': 10, 'reason': '10-hour rest (11-hour driving limit)',
+         'distance': float(i), 'location': 'En route to dropoff'}
+        for i in range(0, points, max(points // 20, 1))
+    ]
+    return {
+        'totalDistance': 2750.5, 'drivingTime': 50.01, 'totalTripTime': 102.5,
+        'restStops': stops, 'fuelStops': stops[::3],
+        'routeCoordinates': geometry if as_geometry else geometry.tolist(),
+    }
+
+
+def logs_payload(days):
+    blocks = [{'status': status, 'startHour': hour, 'endHour': hour + 1.5}
+              for hour, status in zip(range(0, 24, 2), ['OFF', 'SB', 'D', 'ON'] * 3)]
+    return {'days': [{
+        'date': 'Mon, Jan 01', 'statusBlocks': blocks,
+        'events': [{'hour': block['startHour'], 'description': 'Driving (4.0 hours)'} for block in blocks],
+        'drivingHours': 11, 'onDutyHours': 3, 'offDutyHours': 10, 'cycleHoursUsed': 14 * day,
+    } for day in range(days)]}
+
+
+def best_of(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+class Command(BaseCommand):
+    help = "Compare DRF's JSONRenderer with the eldtrip FastJSONRenderer on representative payloads"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        self.stdout.write(f"Fast renderer backend: {'orjson' if orjson is not None else 'json (orjson not installed)'}")
+
+        cases = [
+            (f'route, {points} points', route_payload(points, False), route_payload(points, True))
+            for points in (1_000, 20_000, 100_000)
+        ]
+        cases.append(('ELD logs, 30 days', logs_payload(30), logs_payload(30)))
+
+        self.stdout.write(f"{'payload':<24}{'JSONRenderer':>14}{'FastJSON':>12}{'speedup':>10}{'bytes':>16}")
+        for name, list_payload, fast_payload in cases:
+            drf = JSONRenderer()
+            fast = FastJSONRenderer()
+            drf_time = best_of(lambda: drf.render(list_payload), repeat)
+            fast_time = best_of(lambda: fast.render(fast_payload), repeat)
+            drf_size = len(drf.render(list_payload))
+            fast_size = len(fast.render(fast_payload))
+            self.stdout.write(
+                f"{name:<24}{drf_time * 1000:>12.2f}ms{fast_time * 1000:>10.2f}ms"
+                f"{drf_time / fast_time:>9.1f}x{drf_size:>8}/{fast_size:<8}"
+            )
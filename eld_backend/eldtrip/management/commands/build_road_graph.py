@@ -0,0 +1,94 @@
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from eldtrip.geometry import segment_distances
+from eldtrip.road_graph import METERS_PER_MILE, RoadGraph
+
+# Default speeds in mph for roads a truck would use, by OSM highway tag
+HIGHWAY_SPEEDS_MPH = {
+    'motorway': 65, 'motorway_link': 40,
+    'trunk': 55, 'trunk_link': 35,
+    'primary': 45, 'primary_link': 30,
+    'secondary': 40, 'secondary_link': 25,
+    'tertiary': 35, 'tertiary_link': 25,
+    'unclassified': 30, 'residential': 25, 'service': 15,
+}
+
+
+def parse_maxspeed(value):
+    """OSM maxspeed tag in mph, or None if it isn't a plain number"""
+    match = re.match(r'\s*(\d+(?:\.\d+)?)\s*(mph)?', value or '')
+    if not match:
+        return None
+    speed = float(match.group(1))
+    return speed if match.group(2) else speed / 1.609344
+
+
+class Command(BaseCommand):
+    help = "Build a compact CSR road graph (.npz) for the local routing backend from an OSM XML extract"
+
+    def add_arguments(self, parser):
+        parser.add_argument('osm_file', help="OSM XML extract (.osm)")
+        parser.add_argument('output', help="Output .npz path, used as ROAD_GRAPH_PATH")
+
+    def handle(self, *args, **options):
+        node_coords = {}
+        ways = []
+
+        try:
+            for _, element in ET.iterparse(options['osm_file'], events=('end',)):
+                if element.tag == 'node':
+                    node_coords[int(element.get('id'))] = (float(element.get('lat')), float(element.get('lon')))
+                    element.clear()
+                elif element.tag == 'way':
+                    tags = {tag.get('k'): tag.get('v') for tag in element.findall('tag')}
+                    highway = tags.get('highway')
+                    if highway in HIGHWAY_SPEEDS_MPH:
+                        refs = [int(nd.get('ref')) for nd in element.findall('nd')]
+                        speed = parse_maxspeed(tags.get('maxspeed')) or HIGHWAY_SPEEDS_MPH[highway]
+                        oneway = tags.get('oneway', 'yes' if highway.startswith('motorway') else 'no')
+                        ways.append((refs, speed, oneway))
+                    element.clear()
+        except (OSError, ET.ParseError) as e:
+            raise CommandError(f"Could not read {options['osm_file']}: {e}")
+
+        # Keep only nodes used by routable ways, renumbered densely
+        node_ids = {}
+        sources, targets, speeds = [], [], []
+        for refs, speed, oneway in ways:
+            refs = [ref for ref in refs if ref in node_coords]
+            for a, b in zip(refs, refs[1:]):
+                a = node_ids.setdefault(a, len(node_ids))
+                b = node_ids.setdefault(b, len(node_ids))
+                if oneway == '-1':
+                    a, b = b, a
+                sources.append(a)
+                targets.append(b)
+                speeds.append(speed)
+                if oneway not in ('yes', 'true', '1', '-1'):
+                    sources.append(b)
+                    targets.append(a)
+                    speeds.append(speed)
+
+        if not sources:
+            raise CommandError("No routable ways found in the extract")
+
+        coords = np.empty((len(node_ids), 2), dtype=np.float64)
+        for osm_id, index in node_ids.items():
+            coords[index] = node_coords[osm_id]
+        lats, lngs = coords[:, 0], coords[:, 1]
+
+        sources, targets = np.asarray(sources), np.asarray(targets)
+        # Interleave each edge's endpoints so every other segment is an edge
+        lengths = segment_distances(
+            np.column_stack((lats[sources], lats[targets])).ravel(),
+            np.column_stack((lngs[sources], lngs[targets])).ravel()
+        )[::2] * METERS_PER_MILE
+        travel_times = lengths / (np.asarray(speeds) * METERS_PER_MILE / 3600)
+
+        graph = RoadGraph.from_edges(lats, lngs, sources, targets, travel_times, lengths)
+        graph.save(options['output'])
+        self.stdout.write(f"Wrote {graph.node_count} nodes and {graph.edge_count} edges to {options['output']}")
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from eldtrip.cycle import CYCLE_HISTORY_DAYS, purge_old_duty_periods
+from eldtrip.jobs import JOB_RETENTION_DAYS, purge_finished_jobs
+from eldtrip.routecache import DatabaseRouteCacheBackend
+from eldtrip.trips import TRIP_RETENTION_DAYS, purge_expired_trips
+
+
+class Command(BaseCommand):
+    help = (f"Delete stored trips older than TRIP_RETENTION_DAYS ({TRIP_RETENTION_DAYS} days), "
+            f"finished planning jobs older than JOB_RETENTION_DAYS ({JOB_RETENTION_DAYS} days), "
+            f"driver duty periods older than CYCLE_HISTORY_DAYS ({CYCLE_HISTORY_DAYS} days), "
+            f"and evict expired and surplus route cache rows")
+
+    def handle(self, *args, **options):
+        deleted = purge_expired_trips()
+        self.stdout.write(f"Deleted {deleted} expired trips")
+        deleted = purge_finished_jobs()
+        self.stdout.write(f"Deleted {deleted} finished planning jobs")
+        deleted = purge_old_duty_periods()
+        self.stdout.write(f"Deleted {deleted} old duty periods")
+        deleted = DatabaseRouteCacheBackend().evict()
+        self.stdout.write(f"Deleted {deleted} route cache entries")
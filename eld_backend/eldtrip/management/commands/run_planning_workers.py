@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from eldtrip import views  # noqa: F401  registers the planning job handlers
+from eldtrip.jobs import JOB_LEASE_SECONDS, JOB_POLL_INTERVAL, JOB_WORKER_CONCURRENCY, JobWorkerPool
+
+
+class Command(BaseCommand):
+    help = "Run a pool of worker threads that plan the trips queued through the jobs API"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=JOB_WORKER_CONCURRENCY,
+                            help=f'Jobs run at once (default {JOB_WORKER_CONCURRENCY})')
+        parser.add_argument('--poll-interval', type=float, default=JOB_POLL_INTERVAL,
+                            help=f'Seconds between polls of an empty queue (default {JOB_POLL_INTERVAL})')
+        parser.add_argument('--lease', type=float, default=JOB_LEASE_SECONDS,
+                            help=f'Seconds a job stays leased without a heartbeat (default {JOB_LEASE_SECONDS})')
+        parser.add_argument('--exit-when-idle', action='store_true',
+                            help='Stop once no job is runnable, e.g. to drain the queue from cron')
+
+    def handle(self, *args, **options):
+        pool = JobWorkerPool(options['concurrency'], options['poll_interval'], options['lease'])
+        self.stdout.write(f"Planning workers {pool.name} started with {pool.concurrency} threads")
+        pool.start(exit_when_idle=options['exit_when_idle'])
+        try:
+            pool.join()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping once running jobs finish...")
+            pool.stop()
+        self.stdout.write(f"Succeeded {pool.counts['succeeded']}, failed {pool.counts['failed']}, "
+                          f"requeued {pool.counts['queued']}")
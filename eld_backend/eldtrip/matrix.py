@@ -0,0 +1,160 @@
+# Many-to-many distance/duration matrices from cached legs, ORS and the local road graph
+import numpy as np
+import requests
+from django.conf import settings
+
+from .hos import AVERAGE_SPEED_MPH, STOP_ON_DUTY_HOURS
+from .providers import openrouteservice
+
+# Cells per ORS matrix request (the public API allows 3500)
+ORS_MATRIX_MAX_CELLS = getattr(settings, 'ORS_MATRIX_MAX_CELLS', 3500)
+
+METERS_PER_MILE = 1609.34
+
+
+def empty_matrix(origins, destinations):
+    """(distances, durations) arrays of NaN, one row per origin"""
+    shape = (len(origins), len(destinations))
+    return np.full(shape, np.nan), np.full(shape, np.nan)
+
+
+def cached_matrix(route_cache, origins, destinations, profile):
+    """
+    Fill a matrix from the legs already in the route cache, with one bulk
+    lookup for all cells.
+
+    Returns:
+    - (distances in miles, durations in hours), NaN where the leg isn't cached
+    """
+    distances, durations = empty_matrix(origins, destinations)
+    pairs = [(origin, destination) for origin in origins for destination in destinations]
+    legs = route_cache.get_leg_totals(pairs, profile)
+    for cell, leg in enumerate(legs):
+        if leg is not None:
+            distances.flat[cell], durations.flat[cell] = leg
+    return distances, durations
+
+
+def matrix_blocks(missing, max_cells=ORS_MATRIX_MAX_CELLS):
+    """
+    Split the missing cells into blocks of at most max_cells.
+
+    Only origins with a missing cell, and destinations missing for one of
+    them, are requested; a block may re-request a few cached cells rather
+    than splitting into many small requests.
+
+    Returns:
+    - list of (origin indices, destination indices)
+    """
+    rows = np.flatnonzero(missing.any(axis=1))
+    if not len(rows):
+        return []
+    cols = np.flatnonzero(missing[rows].any(axis=0))
+    col_chunk = min(len(cols), max_cells)
+    row_chunk = max(max_cells // col_chunk, 1)
+    return [
+        (rows[r:r + row_chunk], cols[c:c + col_chunk])
+        for c in range(0, len(cols), col_chunk)
+        for r in range(0, len(rows), row_chunk)
+    ]
+
+
+def fetch_ors_matrix(origins, destinations, api_key, profile):
+    """
+    One ORS matrix request.
+
+    Retries and timeouts are handled by the shared openrouteservice client.
+
+    Returns:
+    - {'distances', 'durations'} arrays in miles and hours, NaN where no
+      route was found, or {'error': message}
+    """
+    try:
+        response = openrouteservice.post(
+            f"/v2/matrix/{profile}",
+            json={
+                "locations": [[point['lng'], point['lat']] for point in [*origins, *destinations]],
+                "sources": list(range(len(origins))),
+                "destinations": list(range(len(origins), len(origins) + len(destinations))),
+                "metrics": ["distance", "duration"],
+            },
+            headers={
+                "Authorization": api_key
+            }
+        )
+        data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        print(f"ORS matrix request failed: {e}")
+        return {"error": f"OpenRouteService matrix request failed: {e}"}
+
+    if not isinstance(data, dict):
+        print(f"Unexpected ORS matrix response: {data!r:.200}")
+        return {"error": "Unexpected OpenRouteService matrix response"}
+    if "error" in data or not response.ok:
+        error = data.get("error", data)
+        if isinstance(error, dict):
+            error_code = error.get("code", response.status_code)
+            error_message = error.get("message")
+        else:
+            error_code, error_message = response.status_code, error
+        print(f"Error {error_code}: {error_message}")
+        return {"error": f"ORS API Error {error_code}: {error_message}"}
+
+    if "distances" not in data or "durations" not in data:
+        print(f"ORS matrix response without distances and durations: {sorted(data)}")
+        return {"error": "OpenRouteService matrix response is missing distances or durations"}
+
+    # Unroutable pairs come back as null
+    try:
+        distances = np.array(data["distances"], dtype=np.float64) / METERS_PER_MILE
+        durations = np.array(data["durations"], dtype=np.float64) / 3600
+    except (TypeError, ValueError) as e:
+        print(f"Malformed ORS matrix: {e}")
+        return {"error": f"Malformed OpenRouteService matrix: {e}"}
+    shape = (len(origins), len(destinations))
+    if distances.shape != shape or durations.shape != shape:
+        return {"error": f"OpenRouteService matrix has shape {distances.shape}, expected {shape}"}
+    return {"distances": distances, "durations": durations}
+
+
+def local_matrix(graph, origins, destinations):
+    """
+    Matrix over the local road graph, one search per origin.
+
+    Returns:
+    - (distances in miles, durations in hours), NaN where a point is too far
+      from the graph or no route exists
+    """
+    distances, durations = empty_matrix(origins, destinations)
+    destination_nodes = [graph.nearest_node(point['lat'], point['lng']) for point in destinations]
+    snapped = [j for j, node in enumerate(destination_nodes) if node is not None]
+    if not snapped:
+        return distances, durations
+
+    targets = [destination_nodes[j] for j in snapped]
+    for i, origin in enumerate(origins):
+        node = graph.nearest_node(origin['lat'], origin['lng'])
+        if node is None:
+            continue
+        seconds, meters = graph.one_to_many(node, targets)
+        reachable = np.isfinite(seconds)
+        durations[i, snapped] = np.where(reachable, seconds / 3600, np.nan)
+        distances[i, snapped] = np.where(reachable, meters / METERS_PER_MILE, np.nan)
+    return distances, durations
+
+
+def hos_feasible(distances, cycle_hours_available, avg_speed=AVERAGE_SPEED_MPH):
+    """
+    Whether each driver (row) can drive to each pickup (column) and spend
+    the on-duty hour there within what is left of their 70-hour/8-day
+    cycle, without a 34-hour restart. Driving time uses the planner's
+    average speed; unroutable cells are never feasible.
+    """
+    available = np.asarray(cycle_hours_available, dtype=np.float64)[:, None]
+    return distances / avg_speed + STOP_ON_DUTY_HOURS <= available + 1e-9
+
+
+def matrix_json(values, decimals):
+    """Dense nested lists, with None for NaN cells"""
+    rounded = np.round(values, decimals)
+    return [[None if np.isnan(value) else value for value in row] for row in rounded.tolist()]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eldtrip', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cache_key', models.CharField(max_length=128, unique=True)),
+                ('distance', models.FloatField()),
+                ('duration', models.FloatField()),
+                ('geometry', models.BinaryField()),
+                ('size_bytes', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:46
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eldtrip', '0002_routecacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Trip',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('summary', models.JSONField()),
+                ('geometry', models.BinaryField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
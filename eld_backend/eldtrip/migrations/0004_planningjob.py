@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:05
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eldtrip', '0003_trip'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlanningJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('kind', models.CharField(max_length=32)),
+                ('request', models.JSONField()),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], db_index=True, default='queued', max_length=16)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('max_attempts', models.PositiveSmallIntegerField()),
+                ('run_after', models.DateTimeField(db_index=True)),
+                ('lease_owner', models.CharField(blank=True, max_length=128, null=True)),
+                ('lease_expires_at', models.DateTimeField(blank=True, db_index=True, null=True)),
+                ('result', models.BinaryField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('eldtrip', '0004_planningjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DutyPeriod',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('driver_id', models.CharField(max_length=64)),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['driver_id', 'end'], name='eldtrip_dut_driver__ffca43_idx')],
+                'constraints': [models.UniqueConstraint(fields=('driver_id', 'start', 'end'), name='unique_duty_period')],
+            },
+        ),
+    ]
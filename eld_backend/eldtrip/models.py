@@ -1,3 +1,92 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+class GeocodeCacheEntry(models.Model):
+    """Persistent tier of the geocode cache, one row per normalized address"""
+    address_key = models.CharField(max_length=64, unique=True)
+    address = models.TextField()
+    # Both coordinates are null for a cached negative result
+    lat = models.FloatField(null=True, blank=True)
+    lng = models.FloatField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.address
+
+
+class RouteCacheEntry(models.Model):
+    """Cached routing result for one leg, used by the 'database' route cache backend"""
+    cache_key = models.CharField(max_length=128, unique=True)
+    distance = models.FloatField()  # miles
+    duration = models.FloatField()  # hours
+    # zlib-compressed encoded polyline of the leg
+    geometry = models.BinaryField()
+    size_bytes = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.cache_key
+
+
+class Trip(models.Model):
+    """A calculated route, stored so later requests can refer to it by ID"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # calculate_route output without the geometry
+    summary = models.JSONField()
+    # zlib-compressed encoded polyline of the route
+    geometry = models.BinaryField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class PlanningJob(models.Model):
+    """A trip planning request queued for the job workers, with its lease and result"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (SUCCEEDED, 'Succeeded'), (FAILED, 'Failed')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=32)  # 'calculate-route' or 'plan-trip'
+    request = models.JSONField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField()
+    # Not claimed before this time, so retries back off
+    run_after = models.DateTimeField(db_index=True)
+    # The worker holding the job, until the lease expires
+    lease_owner = models.CharField(max_length=128, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Rendered JSON of the finished result
+    result = models.BinaryField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.kind} {self.id} ({self.status})"
+
+
+class DutyPeriod(models.Model):
+    """An on-duty period of a driver, for their rolling 70-hour/8-day cycle"""
+    driver_id = models.CharField(max_length=64)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            # Re-sending a period doesn't count it twice
+            models.UniqueConstraint(fields=['driver_id', 'start', 'end'], name='unique_duty_period'),
+        ]
+        indexes = [models.Index(fields=['driver_id', 'end'])]
+
+    def __str__(self):
+        return f"{self.driver_id} {self.start:%Y-%m-%d %H:%M} - {self.end:%Y-%m-%d %H:%M}"
@@ -0,0 +1,156 @@
+# Memoized plan responses keyed by a canonical hash of the planning inputs
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+from django.conf import settings
+
+from .geocache import normalize_address
+from .trips import TRIP_RETENTION_DAYS
+
+# Bump when a change to the planner (HOS rules, stop placement, log layout) changes its output
+PLAN_RULES_VERSION = getattr(settings, 'PLAN_RULES_VERSION', '1')
+PLAN_CACHE_TTL = getattr(settings, 'PLAN_CACHE_TTL', 24 * 3600)  # seconds
+PLAN_CACHE_MAX_ENTRIES = getattr(settings, 'PLAN_CACHE_MAX_ENTRIES', 1000)
+PLAN_CACHE_MAX_BYTES = getattr(settings, 'PLAN_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+
+
+def plan_cache_key(kind, trip_data, excluded=(), context=None):
+    """
+    Canonical hash of everything a plan response depends on.
+
+    Addresses are normalized the way the geocode cache normalizes them and
+    numbers are parsed, so requests that only differ in spelling, spacing
+    or number formatting share a plan. The ELD logs are dated from the day
+    they are generated, so plan-trip keys include today's date.
+
+    Parameters:
+    - kind: 'calculate-route' or 'plan-trip'
+    - trip_data: see views.parse_trip_request
+    - excluded: route fields left out of the response
+    - context: settings that change the result (routing backend, profile, ...)
+
+    Raises ValueError or TypeError for a malformed cycle hours, zoom or
+    extraStops value.
+    """
+    extra_stops = trip_data.get('extraStops') or []
+    if not isinstance(extra_stops, (list, tuple)):
+        raise TypeError(f"extraStops must be a list of addresses, not {type(extra_stops).__name__}")
+    zoom = trip_data.get('simplifyZoom')
+    available = trip_data.get('cycleHoursAvailable')
+    canonical = {
+        'rules': PLAN_RULES_VERSION,
+        'kind': kind,
+        'locations': [normalize_address(location) for location in (
+            trip_data['currentLocation'], trip_data['pickupLocation'],
+            *extra_stops, trip_data['dropoffLocation'],
+        )],
+        'currentCycleHours': float(trip_data.get('currentCycleHours') or 0),
+        'cycleHoursAvailable': float(available) if available is not None else None,
+        'simplifyZoom': float(zoom) if zoom not in (None, '') else None,
+        'geometryFormat': trip_data.get('geometryFormat') or 'coordinates',
+        'exclude': sorted(set(excluded)),
+        'context': context or {},
+    }
+    if kind == 'plan-trip':
+        canonical['date'] = date.today().isoformat()
+    encoded = json.dumps(canonical, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def body_etag(body):
+    """Strong ETag of a rendered response"""
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value names etag (weak comparison, as RFC 9110 asks)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+class PlanCache:
+    """
+    In-process LRU of rendered plan responses, bounded by entry count and bytes.
+
+    Each entry expires with the first of the geocode and route cache
+    entries it was built from, at most ttl seconds after it was stored and
+    never after the stored trip it refers to. Its strong ETag is a hash of
+    the response bytes. Entries also keep the exact location strings the
+    response was rendered with, since requests that spell them differently
+    share the entry.
+    """
+
+    def __init__(self, max_entries=PLAN_CACHE_MAX_ENTRIES, max_bytes=PLAN_CACHE_MAX_BYTES, ttl=PLAN_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = min(ttl, TRIP_RETENTION_DAYS * 24 * 3600)
+        self._entries = OrderedDict()  # key -> (body, etag, expires_at timestamp, locations)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'misses': 0, 'expired': 0}
+
+    def get(self, key):
+        """
+        Returns:
+        - (body bytes, etag, locations), or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] <= time.time():
+                self._remove(key)
+                self._counters['expired'] += 1
+                entry = None
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry[0], entry[1], entry[3]
+
+    def set(self, key, body, expires_at=None, locations=None):
+        """
+        Store a rendered response until expires_at (epoch seconds, capped at the TTL).
+
+        Parameters:
+        - locations: the location strings as they appear in body
+
+        Returns:
+        - its ETag
+        """
+        etag = body_etag(body)
+        expires_at = min(time.time() + self.ttl, expires_at if expires_at is not None else float('inf'))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (body, etag, expires_at, locations)
+            self._bytes += len(body)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+        return etag
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._counters = {'hits': 0, 'misses': 0, 'expired': 0}
+
+    def stats(self):
+        """Hit ratio and storage use"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes_stored'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def _remove(self, key):
+        body = self._entries.pop(key)[0]
+        self._bytes -= len(body)
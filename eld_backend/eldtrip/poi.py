@@ -0,0 +1,138 @@
+# Truck stop / fuel station index for placing planned stops at real facilities
+import csv
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from .geometry import GridIndex, haversine_miles
+
+# CSV with name,lat,lng,kind columns; kind is truck_stop, fuel or rest_area
+POI_DATASET_PATH = getattr(settings, 'POI_DATASET_PATH', None)
+# How far off the route a facility may be
+POI_SNAP_RADIUS_MILES = getattr(settings, 'POI_SNAP_RADIUS_MILES', 2)
+# How far back along the route from where a stop falls due to look for one
+POI_SNAP_WINDOW_MILES = getattr(settings, 'POI_SNAP_WINDOW_MILES', 30)
+
+# Facility kinds that can host each kind of planned stop
+STOP_FACILITY_KINDS = {
+    'rest': ('truck_stop', 'rest_area'),
+    'fuel': ('truck_stop', 'fuel'),
+    'rest_fuel': ('truck_stop',),
+}
+
+
+class FacilityIndex:
+    """
+    Truck stops, fuel stations and rest areas, with one GridIndex per kind.
+
+    Finding the facility for a stop samples the route every snap radius
+    over the window leading up to the stop, nearest the stop first, and
+    asks the grid for facilities of a suitable kind around each sample.
+    Each lookup only touches a few grid cells, however many facilities
+    the dataset has or however long the route is.
+    """
+
+    def __init__(self, facilities, cell_size=0.1):
+        self.facilities = list(facilities)
+        self._indexes = {}
+        kinds = np.array([facility['kind'] for facility in self.facilities], dtype=object)
+        lats = np.array([facility['lat'] for facility in self.facilities], dtype=np.float64)
+        lngs = np.array([facility['lng'] for facility in self.facilities], dtype=np.float64)
+        for kind in set(kinds.tolist()):
+            members = np.flatnonzero(kinds == kind)
+            self._indexes[kind] = (GridIndex(lats[members], lngs[members], cell_size), members)
+
+    @classmethod
+    def from_csv(cls, path):
+        with open(path, newline='', encoding='utf-8') as f:
+            return cls({
+                'name': row['name'],
+                'kind': row['kind'],
+                'lat': float(row['lat']),
+                'lng': float(row['lng']),
+            } for row in csv.DictReader(f))
+
+    def __len__(self):
+        return len(self.facilities)
+
+    def near(self, lat, lng, kinds, radius):
+        """
+        Nearest facility of one of the given kinds within radius miles.
+
+        Returns:
+        - (facility index, miles) or (None, None)
+        """
+        best, best_distance = None, None
+        for kind in kinds:
+            if kind not in self._indexes:
+                continue
+            index, members = self._indexes[kind]
+            found, distance = index.nearest(lat, lng, max_distance=radius)
+            if found is not None and (best_distance is None or distance < best_distance):
+                best, best_distance = int(members[found]), distance
+        return best, best_distance
+
+    def along_route(self, geometry, cumulative_distance, start, end, kinds,
+                    radius=POI_SNAP_RADIUS_MILES):
+        """
+        The facility closest to end among those within radius of the route
+        between start and end miles.
+
+        Returns:
+        - {'distance', 'coordinates', 'facility'} or None
+        """
+        cumulative_distance = np.asarray(cumulative_distance)
+        samples = np.arange(end, start, -radius) if end > start else np.array([end])
+        # Last route vertex at or before each sample, so a stop never moves past end
+        vertices = np.clip(np.searchsorted(cumulative_distance, samples, side='right') - 1,
+                           0, len(cumulative_distance) - 1)
+        for vertex in dict.fromkeys(vertices.tolist()):
+            if cumulative_distance[vertex] <= start:
+                continue
+            lat, lng = geometry.lats[vertex], geometry.lngs[vertex]
+            found, off_route = self.near(lat, lng, kinds, radius)
+            if found is not None:
+                facility = self.facilities[found]
+                # Where the route passes closest to it, within the window
+                first = max(int(np.searchsorted(cumulative_distance, max(cumulative_distance[vertex] - 2 * radius, start),
+                                                side='right')), 0)
+                nearby = slice(first, vertex + 1)
+                closest = first + int(np.argmin(haversine_miles(
+                    facility['lat'], facility['lng'], geometry.lats[nearby], geometry.lngs[nearby])))
+                return {
+                    'distance': float(cumulative_distance[closest]),
+                    'coordinates': [facility['lat'], facility['lng']],
+                    'facility': {
+                        'name': facility['name'],
+                        'kind': facility['kind'],
+                        'offRouteMiles': round(float(off_route), 2),
+                    },
+                }
+        return None
+
+    def stop_snapper(self, geometry, cumulative_distance,
+                     radius=POI_SNAP_RADIUS_MILES, window=POI_SNAP_WINDOW_MILES):
+        """The snap callable plan_hos_stops takes, for one route"""
+        def snap(distance, min_distance, kind):
+            return self.along_route(
+                geometry, cumulative_distance,
+                max(distance - window, min_distance), distance,
+                STOP_FACILITY_KINDS[kind], radius,
+            )
+        return snap
+
+
+_facility_index = None
+_facility_index_lock = threading.Lock()
+
+
+def get_facility_index():
+    """The facility index from settings.POI_DATASET_PATH, or None without a dataset"""
+    global _facility_index
+    if not POI_DATASET_PATH:
+        return None
+    with _facility_index_lock:
+        if _facility_index is None:
+            _facility_index = FacilityIndex.from_csv(POI_DATASET_PATH)
+        return _facility_index
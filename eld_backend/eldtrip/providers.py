@@ -0,0 +1,347 @@
+# Shared HTTP clients for the external providers (Nominatim, OpenRouteService)
+import json
+import threading
+import time
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .instrumentation import (provider_request_seconds, provider_response_bytes, provider_retries,
+                              record_span, register_collector)
+
+PROVIDER_POOL_SIZE = getattr(settings, 'PROVIDER_POOL_SIZE', 10)
+PROVIDER_CONNECT_TIMEOUT = getattr(settings, 'PROVIDER_CONNECT_TIMEOUT', 3.05)  # seconds
+PROVIDER_READ_TIMEOUT = getattr(settings, 'PROVIDER_READ_TIMEOUT', 15)  # seconds
+PROVIDER_MAX_RETRIES = getattr(settings, 'PROVIDER_MAX_RETRIES', 2)
+PROVIDER_BACKOFF_FACTOR = getattr(settings, 'PROVIDER_BACKOFF_FACTOR', 0.25)  # 0.25s, 0.5s, ...
+PROVIDER_BACKOFF_MAX = getattr(settings, 'PROVIDER_BACKOFF_MAX', 2)  # seconds
+# Longest a caller queues for a rate limit slot before giving up
+PROVIDER_MAX_QUEUE_WAIT = getattr(settings, 'PROVIDER_MAX_QUEUE_WAIT', 30)  # seconds
+PROVIDER_RETRY_AFTER_MAX = getattr(settings, 'PROVIDER_RETRY_AFTER_MAX', 60)  # seconds
+
+# Transient upstream failures, retried by the connection pool
+RETRY_STATUSES = (500, 502, 504)
+# Rate limiting: retried by ProviderClient after pausing every caller of the provider
+THROTTLE_STATUSES = (429, 503)
+
+
+class ProviderThrottled(requests.RequestException):
+    """
+    A request could not get a rate limit slot within the allowed wait, or
+    the provider was still throttling it after every retry (the last
+    response is kept as .response)
+    """
+
+
+class CountingRetry(Retry):
+    """urllib3 Retry that calls on_retry() each time it lets a request be retried"""
+
+    def __init__(self, *args, on_retry=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_retry = on_retry
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.on_retry = self.on_retry
+        return retry
+
+    def increment(self, *args, **kwargs):
+        # Raises MaxRetryError instead once the retries are used up
+        retry = super().increment(*args, **kwargs)
+        if self.on_retry is not None:
+            self.on_retry()
+        return retry
+
+
+def retry_after_seconds(response):
+    """Seconds requested by a Retry-After header (delta or HTTP date), or None"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Process-wide token bucket for one provider, kept in its GCRA form.
+
+    Instead of a token count the bucket tracks the theoretical arrival time
+    of the next request. Each caller reserves a slot under the lock and then
+    sleeps outside it, so waiters are released in arrival order at rate per
+    second, with up to burst requests let through back to back. pause()
+    pushes every future slot back, which is how Retry-After is honored.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self.tolerance = (max(1, burst) - 1) * self.interval
+        self.tat = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, max_wait=None):
+        """
+        Reserve the next slot.
+
+        Returns:
+        - seconds to wait before sending, or None if that would exceed max_wait
+          (no slot is taken then)
+        """
+        with self.lock:
+            now = time.monotonic()
+            tat = max(self.tat, now)
+            wait = max(0.0, tat - self.tolerance - now)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tat = tat + self.interval
+            return wait
+
+    def pause(self, seconds):
+        """Hold every caller back for seconds, without a burst when it ends"""
+        with self.lock:
+            self.tat = max(self.tat, time.monotonic() + seconds + self.tolerance)
+
+
+class ProviderClient:
+    """
+    Keep-alive HTTP client for one provider.
+
+    All requests share one requests.Session whose connection pool is bounded
+    to pool_size connections, so concurrent callers reuse TCP/TLS connections
+    instead of opening a new one per call. Connection errors and the statuses
+    in RETRY_STATUSES are retried with capped exponential backoff; the
+    retries counter includes these as well as the throttled ones.
+
+    The client is also the process-wide gateway to the provider: requests
+    are paced by a TokenBucket of rate per second, identical requests that
+    are already in flight share one Future instead of going out twice, and a
+    THROTTLE_STATUSES response pauses the whole bucket for its Retry-After
+    before the request is retried. A request still throttled after
+    max_retries retries raises ProviderThrottled, like one that can't get
+    a slot, so callers report an overloaded provider rather than a failed
+    lookup.
+    """
+
+    def __init__(self, name, base_url, headers=None,
+                 pool_size=PROVIDER_POOL_SIZE,
+                 connect_timeout=PROVIDER_CONNECT_TIMEOUT,
+                 read_timeout=PROVIDER_READ_TIMEOUT,
+                 max_retries=PROVIDER_MAX_RETRIES,
+                 backoff_factor=PROVIDER_BACKOFF_FACTOR,
+                 rate=None, burst=1,
+                 max_queue_wait=PROVIDER_MAX_QUEUE_WAIT):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_queue_wait = max_queue_wait
+        self.bucket = TokenBucket(rate, burst)
+
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._counters = dict.fromkeys(
+            ('requests', 'coalesced', 'throttled', 'retries', 'rejected', 'waiting', 'max_waiting', 'in_flight'), 0)
+        self._wait_seconds = 0.0
+
+        retry = CountingRetry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            backoff_max=PROVIDER_BACKOFF_MAX,
+            status_forcelist=RETRY_STATUSES,
+            # Geocoding and directions requests are safe to repeat
+            allowed_methods=frozenset(['GET', 'POST']),
+            # Retry-After is handled by ProviderClient, so it pauses every caller
+            respect_retry_after_header=False,
+            on_retry=self._count_transport_retry,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=retry,
+        )
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+    def request(self, method, path, **kwargs):
+        """
+        Send a request relative to base_url, applying the default timeouts.
+
+        If an identical request is already in flight, wait for it and return
+        its response instead; callers must treat responses as read-only.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        key = self._coalesce_key(method, path, kwargs)
+        if key is None:
+            return self._send(method, path, kwargs)
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+            else:
+                self._counters['coalesced'] += 1
+        if not leader:
+            return future.result()
+
+        try:
+            response = self._send(method, path, kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(response)
+            return response
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def _coalesce_key(self, method, path, kwargs):
+        """Identity of a request for coalescing, or None if it must go out on its own"""
+        if kwargs.get('stream'):
+            return None
+        try:
+            return json.dumps(
+                [method.upper(), path, kwargs.get('params'), kwargs.get('json'),
+                 kwargs.get('data'), kwargs.get('headers')],
+                sort_keys=True,
+            )
+        except (TypeError, ValueError):
+            return None
+
+    def _acquire(self):
+        """Wait for a rate limit slot, counting the caller as queued meanwhile"""
+        wait = self.bucket.reserve(self.max_queue_wait)
+        with self._lock:
+            if wait is None:
+                self._counters['rejected'] += 1
+            elif wait > 0:
+                self._counters['waiting'] += 1
+                self._counters['max_waiting'] = max(self._counters['max_waiting'], self._counters['waiting'])
+                self._wait_seconds += wait
+        if wait is None:
+            raise ProviderThrottled(f"{self.name}: no rate limit slot within {self.max_queue_wait}s")
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                with self._lock:
+                    self._counters['waiting'] -= 1
+
+    def _send(self, method, path, kwargs):
+        """Send one request through the rate limiter, retrying throttled responses"""
+        url = f"{self.base_url}{path}"
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            with self._lock:
+                self._counters['requests'] += 1
+                self._counters['in_flight'] += 1
+            start = time.perf_counter()
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self._lock:
+                    self._counters['in_flight'] -= 1
+                provider_request_seconds.observe(
+                    elapsed, provider=self.name, status=response.status_code if response is not None else 'error')
+                record_span(self.name, elapsed)
+            provider_response_bytes.observe(len(response.content), provider=self.name)
+
+            if response.status_code not in THROTTLE_STATUSES:
+                return response
+            with self._lock:
+                self._counters['throttled'] += 1
+            if attempt == self.max_retries:
+                raise ProviderThrottled(
+                    f"{self.name}: still throttled (HTTP {response.status_code}) after {attempt + 1} attempts",
+                    response=response)
+
+            delay = retry_after_seconds(response)
+            if delay is None:
+                delay = min(self.backoff_factor * (2 ** attempt), PROVIDER_BACKOFF_MAX)
+            self.bucket.pause(min(delay, PROVIDER_RETRY_AFTER_MAX))
+            with self._lock:
+                self._counters['retries'] += 1
+            provider_retries.inc(provider=self.name, reason='throttled')
+
+    def _count_transport_retry(self):
+        with self._lock:
+            self._counters['retries'] += 1
+        provider_retries.inc(provider=self.name, reason='transport')
+
+    def stats(self):
+        """Request, coalescing, throttling and queue depth counters"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['wait_seconds'] = round(self._wait_seconds, 3)
+        stats['name'] = self.name
+        return stats
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+nominatim = ProviderClient(
+    'nominatim',
+    getattr(settings, 'NOMINATIM_URL', 'https://nominatim.openstreetmap.org'),
+    headers={'User-Agent': 'eldTrip/1.0 (syedarqum1999@gmail.com)'},
+    # The public instance allows at most one request per second
+    rate=getattr(settings, 'NOMINATIM_RATE_LIMIT', 1),
+    burst=getattr(settings, 'NOMINATIM_RATE_BURST', 1),
+)
+
+openrouteservice = ProviderClient(
+    'openrouteservice',
+    getattr(settings, 'OPEN_ROUTE_URL', 'https://api.openrouteservice.org'),
+    headers={'Content-Type': 'application/json'},
+    # Free plan directions quota: 40 requests per minute
+    rate=getattr(settings, 'OPEN_ROUTE_RATE_LIMIT', 40 / 60),
+    burst=getattr(settings, 'OPEN_ROUTE_RATE_BURST', 5),
+)
+
+
+def collect_provider_gauges():
+    """Rate limiter queue and in-flight gauges for the metrics endpoint"""
+    clients = (nominatim, openrouteservice)
+    for metric, key, help_text in (
+        ('eldtrip_provider_queue_depth', 'waiting', 'Requests waiting for a rate limit slot'),
+        ('eldtrip_provider_in_flight', 'in_flight', 'Provider requests currently in flight'),
+    ):
+        yield f'# HELP {metric} {help_text}'
+        yield f'# TYPE {metric} gauge'
+        for client in clients:
+            yield f'{metric}{{provider="{client.name}"}} {client.stats()[key]}'
+    yield '# HELP eldtrip_provider_coalesced_total Requests answered by an identical in-flight request'
+    yield '# TYPE eldtrip_provider_coalesced_total counter'
+    for client in clients:
+        yield f'eldtrip_provider_coalesced_total{{provider="{client.name}"}} {client.stats()["coalesced"]}'
+
+
+register_collector(collect_provider_gauges)
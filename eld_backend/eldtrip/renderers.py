@@ -0,0 +1,78 @@
+# Fast JSON rendering and parsing for the eldtrip API
+import json
+
+import numpy as np
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from .geometry import RouteGeometry
+
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library encoder
+    orjson = None
+
+# Decimal places kept for route coordinates; 6 is about 0.1 m
+COORDINATE_PRECISION = getattr(settings, 'ELDTRIP_COORDINATE_PRECISION', 6)
+
+
+def _coordinate_array(geometry):
+    return np.round(np.column_stack((geometry.lats, geometry.lngs)), COORDINATE_PRECISION)
+
+
+def _orjson_default(obj):
+    if isinstance(obj, RouteGeometry):
+        return _coordinate_array(obj)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    # Decimals, lazy strings, querysets and the rest, as DRF would render them
+    return JSONEncoder().default(obj)
+
+
+class _StdlibEncoder(JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, RouteGeometry):
+            return _coordinate_array(obj).tolist()
+        return super().default(obj)
+
+
+def dumps(data):
+    """Serialize to UTF-8 JSON bytes, with native support for numpy arrays and RouteGeometry"""
+    if orjson is not None:
+        return orjson.dumps(data, default=_orjson_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data, cls=_StdlibEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+class FastJSONRenderer(BaseRenderer):
+    """JSON renderer backed by orjson when it is installed"""
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return dumps(data)
+
+
+class FastJSONParser(BaseParser):
+    """JSON parser backed by orjson when it is installed"""
+    media_type = 'application/json'
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return loads(stream.read())
+        except ValueError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
@@ -0,0 +1,282 @@
+# Offline routing over a prebuilt road graph stored as CSR arrays
+import heapq
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from .geometry import GridIndex, RouteGeometry, segment_distances
+
+ROAD_GRAPH_PATH = getattr(settings, 'ROAD_GRAPH_PATH', None)
+# Waypoints farther than this from any graph node can't be routed
+ROAD_GRAPH_MAX_SNAP_MILES = getattr(settings, 'ROAD_GRAPH_MAX_SNAP_MILES', 5)
+
+METERS_PER_MILE = 1609.34
+
+
+class RoadGraph:
+    """
+    Directed road graph in compressed sparse row (CSR) form.
+    
+    The out-edges of node u are indices[indptr[u]:indptr[u + 1]], with
+    travel_times (seconds) and lengths (meters) in the same positions.
+    A transposed copy is built lazily for the backward half of the
+    bidirectional search, and a GridIndex over the nodes snaps waypoints
+    onto the graph.
+    """
+    __slots__ = ('lats', 'lngs', 'indptr', 'indices', 'travel_times', 'lengths',
+                 '_reverse', '_node_index', '_lock')
+
+    def __init__(self, lats, lngs, indptr, indices, travel_times, lengths):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.travel_times = np.asarray(travel_times, dtype=np.float32)
+        self.lengths = np.asarray(lengths, dtype=np.float32)
+        self._reverse = None
+        self._node_index = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_edges(cls, lats, lngs, sources, targets, travel_times, lengths):
+        """Build the CSR arrays from parallel edge arrays"""
+        sources = np.asarray(sources, dtype=np.int64)
+        order = np.argsort(sources, kind='stable')
+        counts = np.bincount(sources, minlength=len(lats))
+        indptr = np.zeros(len(lats) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        return cls(
+            lats, lngs, indptr,
+            np.asarray(targets)[order],
+            np.asarray(travel_times)[order],
+            np.asarray(lengths)[order],
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['lats'], data['lngs'], data['indptr'], data['indices'],
+                       data['travel_times'], data['lengths'])
+
+    def save(self, path):
+        np.savez_compressed(
+            path, lats=self.lats, lngs=self.lngs, indptr=self.indptr, indices=self.indices,
+            travel_times=self.travel_times, lengths=self.lengths
+        )
+
+    @property
+    def node_count(self):
+        return self.lats.shape[0]
+
+    @property
+    def edge_count(self):
+        return self.indices.shape[0]
+
+    def reverse(self):
+        """The graph with every edge reversed, built on first use"""
+        with self._lock:
+            if self._reverse is None:
+                sources = np.repeat(np.arange(self.node_count), np.diff(self.indptr))
+                self._reverse = RoadGraph.from_edges(
+                    self.lats, self.lngs, self.indices, sources, self.travel_times, self.lengths
+                )
+            return self._reverse
+
+    def nearest_node(self, lat, lng, max_distance=ROAD_GRAPH_MAX_SNAP_MILES):
+        with self._lock:
+            if self._node_index is None:
+                self._node_index = GridIndex(self.lats, self.lngs, cell_size=0.05)
+        node, _ = self._node_index.nearest(lat, lng, max_distance=max_distance)
+        return node
+
+    def shortest_path(self, source, target):
+        """
+        Fastest path between two nodes with bidirectional Dijkstra.
+        
+        Returns:
+        - (list of node indices, travel time in seconds), or (None, inf) if unreachable
+        """
+        if source == target:
+            return [source], 0.0
+
+        graphs = (self, self.reverse())
+        dist = ({source: 0.0}, {target: 0.0})
+        parent = ({source: -1}, {target: -1})
+        settled = (set(), set())
+        heaps = ([(0.0, source)], [(0.0, target)])
+        best, meeting = np.inf, None
+
+        while heaps[0] and heaps[1]:
+            # Stop once no path through an unsettled node can beat the best found
+            if heaps[0][0][0] + heaps[1][0][0] >= best:
+                break
+            side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            graph, d, p, done = graphs[side], dist[side], parent[side], settled[side]
+            other = dist[1 - side]
+
+            cost, u = heapq.heappop(heaps[side])
+            if u in done:
+                continue
+            done.add(u)
+
+            start, end = graph.indptr[u], graph.indptr[u + 1]
+            for v, weight in zip(graph.indices[start:end].tolist(), graph.travel_times[start:end].tolist()):
+                candidate = cost + weight
+                if candidate < d.get(v, np.inf):
+                    d[v] = candidate
+                    p[v] = u
+                    heapq.heappush(heaps[side], (candidate, v))
+                if v in other and candidate + other[v] < best:
+                    best, meeting = candidate + other[v], v
+
+        if meeting is None:
+            return None, np.inf
+
+        path = []
+        node = meeting
+        while node != -1:
+            path.append(node)
+            node = parent[0][node]
+        path.reverse()
+        node = parent[1][meeting]
+        while node != -1:
+            path.append(node)
+            node = parent[1][node]
+        return path, float(best)
+
+    def one_to_many(self, source, targets):
+        """
+        Fastest travel time and its length from one node to several, with a
+        single Dijkstra search that stops once every target is settled.
+
+        Returns:
+        - (seconds, meters) arrays in the order of targets, inf where unreachable
+        """
+        remaining = set(targets)
+        dist = {source: 0.0}
+        length = {source: 0.0}
+        settled = set()
+        heap = [(0.0, source)]
+
+        while heap and remaining:
+            cost, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+            remaining.discard(u)
+
+            start, end = self.indptr[u], self.indptr[u + 1]
+            for v, weight, meters in zip(self.indices[start:end].tolist(),
+                                         self.travel_times[start:end].tolist(),
+                                         self.lengths[start:end].tolist()):
+                candidate = cost + weight
+                if candidate < dist.get(v, np.inf):
+                    dist[v] = candidate
+                    length[v] = length[u] + meters
+                    heapq.heappush(heap, (candidate, v))
+
+        seconds = np.array([dist[t] if t in settled else np.inf for t in targets], dtype=np.float64)
+        meters = np.array([length[t] if t in settled else np.inf for t in targets], dtype=np.float64)
+        return seconds, meters
+
+    def route(self, waypoints):
+        """
+        Route through waypoints on the local graph.
+        
+        Returns:
+        - dict in the same shape as views.get_waypoint_route
+        """
+        nodes = []
+        for point in waypoints:
+            node = self.nearest_node(point['lat'], point['lng'])
+            if node is None:
+                return {
+                    "error": f"No road within {ROAD_GRAPH_MAX_SNAP_MILES} miles of {point['lat']}, {point['lng']}",
+                    "is_road_based": False
+                }
+            nodes.append(node)
+
+        path_nodes, legs = [nodes[0]], []
+        for source, target in zip(nodes, nodes[1:]):
+            path, seconds = self.shortest_path(source, target)
+            if path is None:
+                return {
+                    "error": "No road route between waypoints in the local road graph",
+                    "is_road_based": False
+                }
+            start_index = len(path_nodes) - 1
+            path_nodes.extend(path[1:])
+            legs.append({
+                "distance": float(self.path_length(path)) / METERS_PER_MILE,
+                "duration": seconds / 3600,
+                "start_index": start_index,
+                "end_index": len(path_nodes) - 1,
+            })
+
+        path_nodes = np.asarray(path_nodes, dtype=np.int64)
+        return {
+            "route_points": RouteGeometry(self.lats[path_nodes], self.lngs[path_nodes]),
+            "distance": sum(leg["distance"] for leg in legs),
+            "duration": sum(leg["duration"] for leg in legs),
+            "legs": legs,
+            "is_road_based": True,
+            "endpoint_used": "LocalRoadGraph"
+        }
+
+    def path_length(self, path):
+        """Length in meters of a node path, from the edge lengths"""
+        total = 0.0
+        for u, v in zip(path, path[1:]):
+            start, end = self.indptr[u], self.indptr[u + 1]
+            targets = self.indices[start:end]
+            matches = np.flatnonzero(targets == v)
+            # Parallel edges: the search used the fastest one
+            edge = start + matches[np.argmin(self.travel_times[start + matches])]
+            total += float(self.lengths[edge])
+        return total
+
+
+def synthetic_grid_graph(rows=20, cols=20, origin=(35.0, -100.0), spacing=0.01, speed_mph=55):
+    """
+    Small two-way grid of roads, for tests and local development without an OSM extract.
+    
+    Every other row is a faster highway so fastest and shortest paths differ.
+    """
+    lat_grid, lng_grid = np.meshgrid(
+        origin[0] + spacing * np.arange(rows), origin[1] + spacing * np.arange(cols), indexing='ij'
+    )
+    lats, lngs = lat_grid.ravel(), lng_grid.ravel()
+    node = np.arange(rows * cols).reshape(rows, cols)
+
+    pairs = [(node[:, :-1].ravel(), node[:, 1:].ravel(), np.repeat(np.arange(rows) % 2 == 0, cols - 1)),
+             (node[:-1, :].ravel(), node[1:, :].ravel(), np.zeros((rows - 1) * cols, dtype=bool))]
+    sources, targets, highway = [], [], []
+    for a, b, fast in pairs:
+        sources += [a, b]
+        targets += [b, a]
+        highway += [fast, fast]
+    sources, targets, highway = np.concatenate(sources), np.concatenate(targets), np.concatenate(highway)
+
+    # Interleave each edge's endpoints so every other segment is an edge
+    lengths = segment_distances(
+        np.column_stack((lats[sources], lats[targets])).ravel(),
+        np.column_stack((lngs[sources], lngs[targets])).ravel()
+    )[::2] * METERS_PER_MILE
+    speeds = np.where(highway, speed_mph * 1.2, speed_mph * 0.6) * METERS_PER_MILE / 3600  # m/s
+    return RoadGraph.from_edges(lats, lngs, sources, targets, lengths / speeds, lengths)
+
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def get_road_graph():
+    """The road graph at settings.ROAD_GRAPH_PATH, loaded once per process"""
+    global _graph
+    with _graph_lock:
+        if _graph is None:
+            if not ROAD_GRAPH_PATH:
+                raise RuntimeError("ROAD_GRAPH_PATH must be set to use the local routing backend")
+            _graph = RoadGraph.load(ROAD_GRAPH_PATH)
+        return _graph
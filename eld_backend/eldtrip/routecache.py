@@ -0,0 +1,386 @@
+# Cache of routed legs keyed by snapped origin/destination coordinates and routing profile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Sum
+
+from .geometry import RouteGeometry, decode_polyline, encode_polyline
+from .models import RouteCacheEntry
+
+ROUTE_CACHE_BACKEND = getattr(settings, 'ROUTE_CACHE_BACKEND', 'memory')  # 'memory', 'database' or 'django'
+ROUTE_CACHE_PRECISION = getattr(settings, 'ROUTE_CACHE_PRECISION', 4)  # decimal places, about 11 m
+ROUTE_CACHE_TTL = getattr(settings, 'ROUTE_CACHE_TTL', 7 * 24 * 3600)  # 7 days
+ROUTE_CACHE_MAX_ENTRIES = getattr(settings, 'ROUTE_CACHE_MAX_ENTRIES', 5000)
+ROUTE_CACHE_MAX_BYTES = getattr(settings, 'ROUTE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+ROUTE_CACHE_ALIAS = getattr(settings, 'ROUTE_CACHE_ALIAS', 'default')
+# The database backend evicts once per this many writes; purge_trips evicts too
+ROUTE_CACHE_EVICT_EVERY = getattr(settings, 'ROUTE_CACHE_EVICT_EVERY', 100)
+
+# Polyline precision used for stored geometry (6 decimals, about 0.1 m)
+_GEOMETRY_PRECISION = 6
+# Keys per query in DatabaseRouteCacheBackend.get_many, well under SQLite's bound parameter limit
+_KEYS_PER_QUERY = 500
+
+
+def compress_geometry(geometry):
+    return zlib.compress(encode_polyline(geometry.lats, geometry.lngs, precision=_GEOMETRY_PRECISION).encode('ascii'))
+
+
+def decompress_geometry(data):
+    lats, lngs = decode_polyline(zlib.decompress(bytes(data)).decode('ascii'), precision=_GEOMETRY_PRECISION)
+    return RouteGeometry(lats, lngs)
+
+
+class MemoryRouteCacheBackend:
+    """Process-local LRU bounded by entry count and stored bytes"""
+
+    def __init__(self, max_entries=ROUTE_CACHE_MAX_ENTRIES, max_bytes=ROUTE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (entry, expires_at timestamp)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            entry, expires_at = item
+            if expires_at <= time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def get_many(self, keys, geometry=True):
+        """Entries for the keys that are cached, by key"""
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                item = self._entries.get(key)
+                if item is None:
+                    continue
+                if item[1] <= now:
+                    self._remove(key)
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = item[0]
+        return found
+
+    def set(self, key, entry, ttl):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (entry, time.time() + ttl)
+            self._bytes += len(entry['geometry'])
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes_stored': self._bytes}
+
+    def _remove(self, key):
+        entry, _ = self._entries.pop(key)
+        self._bytes -= len(entry['geometry'])
+
+
+class DatabaseRouteCacheBackend:
+    """
+    RouteCacheEntry table; the oldest rows are evicted past max_entries.
+
+    Eviction runs every evict_every writes rather than on each one, so the
+    table can briefly hold that many rows too many.
+    """
+
+    def __init__(self, max_entries=ROUTE_CACHE_MAX_ENTRIES, evict_every=ROUTE_CACHE_EVICT_EVERY):
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = RouteCacheEntry.objects.filter(
+            cache_key=key,
+            expires_at__gt=datetime.now(timezone.utc)
+        ).first()
+        if entry is None:
+            return None
+        return {'distance': entry.distance, 'duration': entry.duration, 'geometry': bytes(entry.geometry),
+                'expires_at': entry.expires_at.timestamp()}
+
+    def get_many(self, keys, geometry=True):
+        """
+        Entries for the keys that are cached, by key, in one query per
+        _KEYS_PER_QUERY keys. With geometry=False the geometry column isn't
+        read and the entries have no 'geometry'.
+        """
+        keys = list(dict.fromkeys(keys))
+        fields = ['cache_key', 'distance', 'duration', 'expires_at'] + (['geometry'] if geometry else [])
+        now = datetime.now(timezone.utc)
+        found = {}
+        for start in range(0, len(keys), _KEYS_PER_QUERY):
+            for row in RouteCacheEntry.objects.filter(
+                cache_key__in=keys[start:start + _KEYS_PER_QUERY],
+                expires_at__gt=now
+            ).values(*fields):
+                entry = {'distance': row['distance'], 'duration': row['duration'],
+                         'expires_at': row['expires_at'].timestamp()}
+                if geometry:
+                    entry['geometry'] = bytes(row['geometry'])
+                found[row['cache_key']] = entry
+        return found
+
+    def set(self, key, entry, ttl):
+        RouteCacheEntry.objects.update_or_create(
+            cache_key=key,
+            defaults={
+                'distance': entry['distance'],
+                'duration': entry['duration'],
+                'geometry': entry['geometry'],
+                'size_bytes': len(entry['geometry']),
+                'expires_at': datetime.fromtimestamp(time.time() + ttl, tz=timezone.utc),
+            }
+        )
+        with self._lock:
+            self._writes += 1
+            due = self._writes % self.evict_every == 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        """Delete expired rows and the oldest rows beyond max_entries, returning the number removed"""
+        deleted, _ = RouteCacheEntry.objects.filter(expires_at__lte=datetime.now(timezone.utc)).delete()
+        overflow = RouteCacheEntry.objects.count() - self.max_entries
+        if overflow > 0:
+            oldest = RouteCacheEntry.objects.order_by('created_at').values_list('pk', flat=True)[:overflow]
+            deleted += RouteCacheEntry.objects.filter(pk__in=list(oldest)).delete()[0]
+        return deleted
+
+    def clear(self):
+        RouteCacheEntry.objects.all().delete()
+
+    def stats(self):
+        totals = RouteCacheEntry.objects.aggregate(bytes_stored=Sum('size_bytes'))
+        return {'entries': RouteCacheEntry.objects.count(), 'bytes_stored': totals['bytes_stored'] or 0}
+
+
+class DjangoCacheRouteCacheBackend:
+    """
+    Any configured Django cache (memcached, Redis, ...), possibly shared
+    with other data. Size-bounded eviction is left to the cache itself, so
+    bytes_stored only counts what this process has written.
+
+    Entries are stored under a cache key version read from a generation
+    counter in the same cache; clear() bumps the counter, which orphans
+    every route entry (they expire with their TTL) without touching
+    anything else in the cache.
+    """
+    generation_key = 'eldtrip:route-cache:generation'
+
+    def __init__(self, alias=ROUTE_CACHE_ALIAS):
+        self.alias = alias
+        self._written = {'entries': 0, 'bytes_stored': 0}
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _version(self):
+        generation = self.cache.get(self.generation_key)
+        if generation is None:
+            # First use, or the counter was evicted. Starting from the clock
+            # never reuses a generation cleared earlier; add() keeps a
+            # concurrent writer's value
+            self.cache.add(self.generation_key, int(time.time()), timeout=None)
+            generation = self.cache.get(self.generation_key, int(time.time()))
+        return generation
+
+    def get(self, key):
+        return self.cache.get(key, version=self._version())
+
+    def get_many(self, keys, geometry=True):
+        """Entries for the keys that are cached, by key, in one cache round trip"""
+        return self.cache.get_many(keys, version=self._version())
+
+    def set(self, key, entry, ttl):
+        self.cache.set(key, entry, timeout=ttl, version=self._version())
+        with self._lock:
+            self._written['entries'] += 1
+            self._written['bytes_stored'] += len(entry['geometry'])
+
+    def clear(self):
+        try:
+            self.cache.incr(self.generation_key)
+        except ValueError:
+            # No counter, so any entries left are from an older generation
+            self.cache.add(self.generation_key, int(time.time()), timeout=None)
+        with self._lock:
+            self._written = {'entries': 0, 'bytes_stored': 0}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._written)
+
+
+ROUTE_CACHE_BACKENDS = {
+    'memory': MemoryRouteCacheBackend,
+    'database': DatabaseRouteCacheBackend,
+    'django': DjangoCacheRouteCacheBackend,
+}
+
+
+class RouteCache:
+    """
+    Cache routed legs so repeated lanes skip the routing provider.
+    
+    Each leg is keyed by its origin and destination snapped to `precision`
+    decimal places plus the routing profile, and stores distance, duration
+    and compressed geometry. A multi-waypoint route is served from the cache
+    only when every one of its legs is cached.
+    """
+
+    def __init__(self, backend=None, precision=ROUTE_CACHE_PRECISION, ttl=ROUTE_CACHE_TTL):
+        self.backend = backend if backend is not None else ROUTE_CACHE_BACKENDS[ROUTE_CACHE_BACKEND]()
+        self.precision = precision
+        self.ttl = ttl
+        self._counters = {'hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+
+    def leg_key(self, origin, destination, profile):
+        p = self.precision
+        return (f"route:{profile}:{origin['lat']:.{p}f},{origin['lng']:.{p}f}:"
+                f"{destination['lat']:.{p}f},{destination['lng']:.{p}f}")
+
+    def get_route(self, waypoints, profile):
+        """
+        Assemble a route from cached legs.
+        
+        Returns:
+        - route dict in the get_waypoint_route shape, or None unless every leg is cached
+        """
+        entries = self._get_legs(waypoints, profile)
+        if entries is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+
+        # Consecutive legs share their junction point
+        lats, lngs, legs = [], [], []
+        offset = 0
+        for i, entry in enumerate(entries):
+            geometry = decompress_geometry(entry['geometry'])
+            skip = 1 if i > 0 else 0
+            lats.append(geometry.lats[skip:])
+            lngs.append(geometry.lngs[skip:])
+            start_index = offset
+            offset += len(geometry) - 1
+            legs.append({
+                "distance": entry['distance'],
+                "duration": entry['duration'],
+                "start_index": start_index,
+                "end_index": offset,
+            })
+
+        return {
+            "route_points": RouteGeometry(np.concatenate(lats), np.concatenate(lngs)),
+            "distance": sum(leg["distance"] for leg in legs),
+            "duration": sum(leg["duration"] for leg in legs),
+            "legs": legs,
+            "is_road_based": True,
+            "endpoint_used": "RouteCache"
+        }
+
+    def get_leg_totals(self, pairs, profile):
+        """
+        Distance and duration of many legs, without their geometry, in one
+        backend lookup.
+
+        Parameters:
+        - pairs: list of (origin, destination) points
+
+        Returns:
+        - list of (miles, hours), or None where the leg isn't cached, in the order of pairs
+        """
+        keys = [self.leg_key(origin, destination, profile) for origin, destination in pairs]
+        try:
+            entries = self.backend.get_many(keys, geometry=False)
+        except Exception as e:
+            print(f"Error reading route cache entries: {e}")
+            entries = {}
+        return [(entries[key]['distance'], entries[key]['duration']) if key in entries else None for key in keys]
+
+    def expires_at(self, waypoints, profile):
+        """
+        When the first of a route's cached legs expires.
+        
+        Returns:
+        - epoch seconds, or None unless every leg is cached
+        """
+        entries = self._get_legs(waypoints, profile, geometry=False)
+        if not entries:
+            return None
+        # Entries written before expiry was recorded count as expiring now
+        return min(entry.get('expires_at', time.time()) for entry in entries)
+
+    def store_route(self, waypoints, profile, route):
+        """Store each leg of a successful get_waypoint_route result"""
+        for origin, destination, leg in zip(waypoints, waypoints[1:], route["legs"]):
+            entry = {
+                'distance': leg["distance"],
+                'duration': leg["duration"],
+                'geometry': compress_geometry(route["route_points"].leg(leg["start_index"], leg["end_index"])),
+                'expires_at': time.time() + self.ttl,
+            }
+            try:
+                self.backend.set(self.leg_key(origin, destination, profile), entry, self.ttl)
+            except Exception as e:
+                print(f"Error writing route cache entry: {e}")
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self._counters = {'hits': 0, 'misses': 0}
+
+    def stats(self):
+        """Hit ratio and storage use"""
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        stats['backend'] = type(self.backend).__name__
+        try:
+            stats.update(self.backend.stats())
+        except Exception as e:
+            print(f"Error reading route cache stats: {e}")
+        return stats
+
+    def _get_legs(self, waypoints, profile, geometry=True):
+        """The cached entries of a route's legs in order, or None unless every leg is cached"""
+        keys = [self.leg_key(origin, destination, profile) for origin, destination in zip(waypoints, waypoints[1:])]
+        try:
+            entries = self.backend.get_many(keys, geometry=geometry)
+        except Exception as e:
+            print(f"Error reading route cache entries: {e}")
+            return None
+        if not all(key in entries for key in keys):
+            return None
+        return [entries[key] for key in keys]
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
@@ -1,3 +1,1043 @@
-from django.test import TestCase
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import requests
+from django.core.cache import cache
+from django.db import OperationalError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from geopy.distance import geodesic
+
+from . import views
+from .cycle import CycleRegistry, DriverCycle, epoch_hours, purge_old_duty_periods
+from .eldlogs import generate_eld_logs
+from .gazetteer import Gazetteer
+from .geocache import GeocodeCache
+from .geometry import (RouteGeometry, cumulative_distances, decode_polyline, encode_polyline, segment_distances,
+                       simplify_indices)
+from .hos import plan_hos_stops
+from .management.commands.benchmark_pipeline import FixtureAdapter, ProviderTransport, synthetic_fixture
+from .jobs import claim_job, register_job_handler, run_job, submit_job
+from .matrix import fetch_ors_matrix, hos_feasible, local_matrix, matrix_blocks
+from .models import DutyPeriod, GeocodeCacheEntry, PlanningJob, RouteCacheEntry
+from .plancache import PlanCache, etag_matches, plan_cache_key
+from .poi import FacilityIndex
+from .providers import ProviderClient, ProviderThrottled, TokenBucket
+from .renderers import FastJSONRenderer, dumps, loads
+from .road_graph import RoadGraph, synthetic_grid_graph
+from .routecache import DatabaseRouteCacheBackend, DjangoCacheRouteCacheBackend, RouteCache
+from .trips import load_trip, save_trip
+from .views import parse_trip_request, stream_route_json
+
+
+def dijkstra_time(graph, source, target):
+    """Plain one-directional Dijkstra, as a reference for the bidirectional search"""
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    while heap:
+        cost, u = heapq.heappop(heap)
+        if u == target:
+            return cost
+        if cost > dist[u]:
+            continue
+        for i in range(graph.indptr[u], graph.indptr[u + 1]):
+            v, candidate = int(graph.indices[i]), cost + float(graph.travel_times[i])
+            if candidate < dist.get(v, float('inf')):
+                dist[v] = candidate
+                heapq.heappush(heap, (candidate, v))
+    return float('inf')
+
+
+class ScriptedProvider:
+    """
+    Local HTTP server answering each request with the next (status, headers, body)
+    in a script, after delay seconds
+    """
+
+    def __init__(self, script, delay=0):
+        self.script = list(script)
+        self.requests = []
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                provider.requests.append(self.path)
+                time.sleep(delay)
+                status, headers, body = provider.script.pop(0) if provider.script else (200, {}, b'{}')
+                self.send_response(status)
+                for name, value in {**headers, 'Content-Length': str(len(body))}.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RendererTests(SimpleTestCase):
+    def test_orjson_and_stdlib_paths_render_the_same_document(self):
+        data = {
+            'routeCoordinates': RouteGeometry(np.array([30.12345678, 30.2]), np.array([-97.0, -97.87654321])),
+            'distance': np.float64(12.5),
+            'count': np.int64(3),
+            'array': np.arange(3),
+            'name': 'Añasco',
+        }
+        fast = dumps(data)
+        with mock.patch('eldtrip.renderers.orjson', None):
+            stdlib = dumps(data)
+            self.assertEqual(loads(stdlib), loads(fast))
+        self.assertEqual(loads(fast)['routeCoordinates'], [[30.123457, -97.0], [30.2, -97.876543]])
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+
+
+class ProviderClientTests(SimpleTestCase):
+    def serve(self, script, delay=0):
+        provider = ScriptedProvider(script, delay)
+        self.addCleanup(provider.close)
+        client = ProviderClient('test', provider.url, backoff_factor=0.01)
+        self.addCleanup(client.close)
+        return provider, client
+
+    def test_transport_retries_are_counted(self):
+        provider, client = self.serve([(502, {}, b''), (502, {}, b'')])
+        self.assertEqual(client.get('/search').status_code, 200)
+        self.assertEqual((len(provider.requests), client.stats()['retries']), (3, 2))
+
+    def test_identical_requests_in_flight_are_coalesced(self):
+        provider, client = self.serve([(200, {}, b'{"lat": 1}')], delay=0.2)
+        with ThreadPoolExecutor(5) as pool:
+            responses = list(pool.map(lambda _: client.get('/search', params={'q': 'austin'}), range(5)))
+        self.assertEqual([response.json() for response in responses], [{'lat': 1}] * 5)
+        self.assertEqual((len(provider.requests), client.stats()['coalesced']), (1, 4))
+        client.get('/search', params={'q': 'austin'})
+        self.assertEqual(len(provider.requests), 2)
+
+    def test_token_bucket_paces_after_the_burst(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        waits = [bucket.reserve() for _ in range(4)]
+        for wait, expected in zip(waits, [0, 0, 0.1, 0.2]):
+            self.assertAlmostEqual(wait, expected, delta=0.02)
+        self.assertIsNone(bucket.reserve(max_wait=0.1))
+        self.assertAlmostEqual(bucket.reserve(), 0.3, delta=0.02)
+        bucket.pause(1)
+        self.assertAlmostEqual(bucket.reserve(), 1.0, delta=0.02)
+        self.assertEqual(TokenBucket(None).reserve(), 0)
+
+    def test_retry_after_pauses_the_provider(self):
+        provider, client = self.serve([(429, {'Retry-After': '0.3'}, b'')])
+        start = time.monotonic()
+        self.assertEqual(client.get('/search').status_code, 200)
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        stats = client.stats()
+        self.assertEqual((len(provider.requests), stats['throttled'], stats['retries']), (2, 1, 1))
+
+    def test_still_throttled_after_retries_raises(self):
+        provider, client = self.serve([(503, {'Retry-After': '0'}, b'')] * 3)
+        with self.assertRaises(ProviderThrottled) as raised:
+            client.get('/search')
+        self.assertEqual(raised.exception.response.status_code, 503)
+        self.assertEqual((len(provider.requests), client.stats()['throttled']), (3, 3))
+
+
+class GeocodeCacheTests(TestCase):
+    def setUp(self):
+        self.fetched = []
+
+    def fetch(self, address):
+        self.fetched.append(address)
+        return {'lat': 30.0, 'lng': -97.0} if address != 'nowhere' else None
+
+    def test_expired_entries_are_fetched_again(self):
+        geocode_cache = GeocodeCache(self.fetch, ttl=0)
+        geocode_cache.get('Austin, TX')
+        geocode_cache.get('Austin, TX')
+        self.assertEqual(len(self.fetched), 2)
+
+    def test_least_recently_used_address_is_evicted(self):
+        geocode_cache = GeocodeCache(self.fetch, max_entries=2, persistent=False)
+        for address in ('Austin, TX', 'Waco, TX', 'Austin, TX', 'Dallas, TX', 'Austin, TX', 'Waco, TX'):
+            geocode_cache.get(address)
+        self.assertEqual(self.fetched, ['Austin, TX', 'Waco, TX', 'Dallas, TX', 'Waco, TX'])
+        self.assertEqual(geocode_cache.stats()['memory_entries'], 2)
+
+    def test_failed_lookups_are_cached_for_the_negative_ttl(self):
+        geocode_cache = GeocodeCache(self.fetch)
+        self.assertIsNone(geocode_cache.get('nowhere'))
+        self.assertIsNone(geocode_cache.get('Nowhere!'))
+        self.assertEqual((self.fetched, geocode_cache.stats()['negative_hits']), (['nowhere'], 1))
+
+        geocode_cache = GeocodeCache(self.fetch, negative_ttl=0, persistent=False)
+        geocode_cache.get('nowhere')
+        geocode_cache.get('nowhere')
+        self.assertEqual(len(self.fetched), 3)
+
+    def test_table_hits_are_promoted_to_memory(self):
+        GeocodeCache(self.fetch).get('Austin, TX')
+        geocode_cache = GeocodeCache(self.fetch)
+        self.assertEqual(geocode_cache.get('austin tx'), {'lat': 30.0, 'lng': -97.0})
+        geocode_cache.get('Austin, TX')
+        stats = geocode_cache.stats()
+        self.assertEqual((stats['db_hits'], stats['memory_hits'], stats['misses']), (1, 1, 0))
+        self.assertEqual(len(self.fetched), 1)
+
+    def test_clear_keeps_table_unless_persistent(self):
+        geocode_cache = GeocodeCache(self.fetch)
+        geocode_cache.get('Austin, TX')
+        geocode_cache.clear()
+        self.assertEqual(GeocodeCacheEntry.objects.count(), 1)
+        geocode_cache.clear(persistent=True)
+        self.assertEqual(GeocodeCacheEntry.objects.count(), 0)
+        geocode_cache.get('Austin, TX')
+        self.assertEqual(len(self.fetched), 2)
+
+    def test_provider_failures_are_not_cached(self):
+        geocode_cache = GeocodeCache(mock.Mock(side_effect=requests.ConnectionError('connection refused')))
+        with self.assertRaises(requests.ConnectionError):
+            geocode_cache.get('Austin, TX')
+        self.assertEqual(GeocodeCacheEntry.objects.count(), 0)
+        geocode_cache.fetch = self.fetch
+        self.assertEqual(geocode_cache.get('Austin, TX'), {'lat': 30.0, 'lng': -97.0})
+        self.assertEqual((geocode_cache.stats()['fetch_errors'], geocode_cache.stats()['misses']), (1, 2))
+
+    @mock.patch('eldtrip.geocache.GEOCODE_CACHE_WRITE_BACKOFF', 0)
+    def test_locked_database_write_is_retried(self):
+        geocode_cache = GeocodeCache(self.fetch)
+        write = GeocodeCacheEntry.objects.update_or_create
+        attempts = []
+
+        def locked_once(**kwargs):
+            attempts.append(kwargs)
+            if len(attempts) == 1:
+                raise OperationalError('database is locked')
+            return write(**kwargs)
+        with mock.patch.object(GeocodeCacheEntry.objects, 'update_or_create', side_effect=locked_once):
+            geocode_cache.get('Austin, TX')
+        self.assertEqual(GeocodeCacheEntry.objects.count(), 1)
+        self.assertEqual((geocode_cache.stats()['write_retries'], geocode_cache.stats()['write_errors']), (1, 0))
+
+
+class ProviderDeadlineTests(SimpleTestCase):
+    trip = {'currentLocation': 'Origin', 'pickupLocation': 'Slow Pickup', 'dropoffLocation': 'Destination'}
+
+    def setUp(self):
+        # Slow calls block until the test ends, so they never outlive it on the shared pool
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def slow_geocode(self, address):
+        if address.startswith('Slow'):
+            self.release.wait(5)
+        return {'lat': 35.0, 'lng': -100.0}
+
+    @mock.patch.object(views, 'PLAN_DEADLINE', 0.2)
+    def test_slow_geocode_is_a_retryable_error_for_its_location(self):
+        with mock.patch.object(views, 'cached_geocode_address', self.slow_geocode):
+            started = time.monotonic()
+            result = views.calculate_route(self.trip)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(result, {'error': 'Timed out geocoding location: Slow Pickup', 'retryable': True})
+
+    @mock.patch.object(views, 'PLAN_DEADLINE', 0.2)
+    def test_geocode_failure_is_reported_before_timeouts(self):
+        def geocode(address):
+            return None if address == 'Destination' else self.slow_geocode(address)
+        with mock.patch.object(views, 'cached_geocode_address', geocode):
+            result = views.calculate_route(self.trip)
+        self.assertEqual(result, {'error': 'Could not geocode location: Destination'})
+
+    @mock.patch.object(views, 'PLAN_DEADLINE', 0.2)
+    def test_routing_gets_what_is_left_of_the_deadline(self):
+        def slow_route(waypoints):
+            self.release.wait(5)
+        with mock.patch.object(views, 'cached_geocode_address', self.slow_geocode), \
+                mock.patch.object(views, 'get_waypoint_route', slow_route):
+            started = time.monotonic()
+            result = views.calculate_route({**self.trip, 'pickupLocation': 'Pickup'})
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertTrue(result['retryable'])
+        self.assertTrue(result['error'].endswith('Error: Request timed out'))
+
+
+class SegmentDistanceTests(SimpleTestCase):
+    def test_kernels_agree_with_geodesic(self):
+        rng = np.random.default_rng(1)
+        lats = np.concatenate((rng.uniform(25, 49, 50), [40.0, 40.0]))
+        lngs = np.concatenate((rng.uniform(-124, -67, 50), [-100.0, -100.0]))
+        expected = np.array([geodesic((lats[i], lngs[i]), (lats[i + 1], lngs[i + 1])).miles
+                             for i in range(len(lats) - 1)])
+        np.testing.assert_allclose(segment_distances(lats, lngs), expected, rtol=1e-5, atol=1e-9)
+        np.testing.assert_allclose(segment_distances(lats, lngs, method='haversine'), expected, rtol=5e-3)
+        self.assertEqual(segment_distances(lats, lngs)[-1], 0.0)
+        np.testing.assert_allclose(cumulative_distances(lats, lngs)[1:], np.cumsum(expected), rtol=1e-5)
+        self.assertEqual(cumulative_distances([30.0], [-97.0]).tolist(), [0.0])
+
+
+class RouteGeometryTests(SimpleTestCase):
+    def test_slices_share_the_point_buffers(self):
+        geometry = RouteGeometry.from_lnglat([[-97.0, 30.0], [-97.1, 30.1], [-97.2, 30.2], [-97.3, 30.3]])
+        leg = geometry.leg(1, 2)
+        self.assertEqual(leg.tolist(), [[30.1, -97.1], [30.2, -97.2]])
+        self.assertTrue(np.shares_memory(leg.lats, geometry.lats))
+        self.assertEqual(geometry[-1], {'lat': 30.3, 'lng': -97.3})
+        self.assertEqual(len(geometry[1:]), 3)
+        self.assertEqual(RouteGeometry.from_points([geometry[0], geometry[3]]).tolist(), [[30.0, -97.0], [30.3, -97.3]])
+
+
+class SimplificationTests(SimpleTestCase):
+    def test_simplify_keeps_endpoints_corners_and_kept_indices(self):
+        # Straight north for 50 points, then straight east for 50
+        lats = np.concatenate((np.linspace(30, 31, 50), np.full(50, 31.0)))
+        lngs = np.concatenate((np.full(50, -97.0), np.linspace(-97.0, -96.0, 50)))
+        self.assertEqual(simplify_indices(lats, lngs, 0.001).tolist(), [0, 49, 99])
+        self.assertEqual(simplify_indices(lats, lngs, 0.001, keep=[20, 75]).tolist(), [0, 20, 49, 75, 99])
+        # A tolerance wider than the corner's offset drops it
+        self.assertEqual(simplify_indices(lats, lngs, 1.0).tolist(), [0, 99])
+        self.assertEqual(simplify_indices(lats[:2], lngs[:2], 1.0).tolist(), [0, 1])
+
+    def test_polyline_round_trip(self):
+        # The example from Google's encoded polyline algorithm documentation
+        self.assertEqual(encode_polyline([38.5, 40.7, 43.252], [-120.2, -120.95, -126.453]),
+                         '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+        rng = np.random.default_rng(0)
+        lats, lngs = rng.uniform(-89, 89, 200), rng.uniform(-179, 179, 200)
+        for precision in (5, 6):
+            decoded_lats, decoded_lngs = decode_polyline(encode_polyline(lats, lngs, precision), precision)
+            np.testing.assert_allclose(decoded_lats, lats, atol=0.51 / 10 ** precision)
+            np.testing.assert_allclose(decoded_lngs, lngs, atol=0.51 / 10 ** precision)
+        self.assertEqual(len(decode_polyline('')[0]), 0)
+
+
+class RoadGraphTests(SimpleTestCase):
+    def setUp(self):
+        self.graph = synthetic_grid_graph(rows=12, cols=15)
+
+    def test_bidirectional_search_matches_dijkstra(self):
+        for source, target in [(0, 179), (17, 160), (95, 3), (44, 44)]:
+            path, seconds = self.graph.shortest_path(source, target)
+            self.assertEqual(path[0], source)
+            self.assertEqual(path[-1], target)
+            self.assertAlmostEqual(seconds, dijkstra_time(self.graph, source, target), places=2)
+
+    def test_route_matches_waypoint_route_shape(self):
+        lats, lngs = self.graph.lats, self.graph.lngs
+        waypoints = [{'lat': lats[i], 'lng': lngs[i]} for i in (0, 100, 179)]
+        route = self.graph.route(waypoints)
+
+        self.assertTrue(route['is_road_based'])
+        self.assertEqual(len(route['legs']), 2)
+        self.assertEqual(route['legs'][0]['start_index'], 0)
+        self.assertEqual(route['legs'][0]['end_index'], route['legs'][1]['start_index'])
+        self.assertEqual(route['legs'][1]['end_index'], len(route['route_points']) - 1)
+        self.assertEqual(route['route_points'][route['legs'][0]['end_index']], {'lat': lats[100], 'lng': lngs[100]})
+        self.assertAlmostEqual(route['distance'], sum(leg['distance'] for leg in route['legs']))
+
+    def test_waypoint_far_from_graph_is_an_error(self):
+        route = self.graph.route([{'lat': 0.0, 'lng': 0.0}, {'lat': 35.0, 'lng': -100.0}])
+        self.assertFalse(route['is_road_based'])
+
+    def test_save_and_load_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'graph.npz')
+            self.graph.save(path)
+            loaded = RoadGraph.load(path)
+        self.assertEqual(loaded.edge_count, self.graph.edge_count)
+        self.assertEqual(loaded.shortest_path(0, 179), self.graph.shortest_path(0, 179))
+
+
+class MatrixTests(SimpleTestCase):
+    def test_local_matrix_matches_pairwise_routes(self):
+        graph = synthetic_grid_graph(rows=12, cols=15)
+        points = [{'lat': graph.lats[i], 'lng': graph.lngs[i]} for i in (0, 44, 100, 179)]
+        far = {'lat': 0.0, 'lng': 0.0}
+        distances, durations = local_matrix(graph, points[:2] + [far], points[2:])
+
+        for i in range(2):
+            for j in range(2):
+                route = graph.route([points[i], points[2 + j]])
+                self.assertAlmostEqual(distances[i, j], route['distance'], places=6)
+                self.assertAlmostEqual(durations[i, j], route['duration'], places=6)
+        self.assertTrue(np.isnan(distances[2]).all())
+
+    def test_blocks_cover_missing_cells_within_limit(self):
+        missing = np.zeros((40, 30), dtype=bool)
+        missing[5:35, 3:28] = True
+        missing[0, 0] = True
+        covered = np.zeros_like(missing)
+        for rows, cols in matrix_blocks(missing, max_cells=100):
+            self.assertLessEqual(len(rows) * len(cols), 100)
+            covered[np.ix_(rows, cols)] = True
+        self.assertTrue(covered[missing].all())
+        self.assertEqual(matrix_blocks(np.zeros((3, 3), dtype=bool)), [])
+
+    def test_unexpected_ors_matrix_bodies_are_errors(self):
+        points = [{'lat': 30.0, 'lng': -97.0}, {'lat': 31.0, 'lng': -97.0}]
+        for body in ([1, 2], {'distances': [[1609.34]]}, {'distances': [[1]], 'durations': [[1, 2]]}):
+            response = mock.Mock(ok=True, status_code=200)
+            response.json.return_value = body
+            with mock.patch('eldtrip.matrix.openrouteservice') as client:
+                client.post.return_value = response
+                self.assertIn('error', fetch_ors_matrix(points[:1], points[1:], 'key', 'driving-hgv'))
+
+        response.json.return_value = {'distances': [[1609.34]], 'durations': [[3600]]}
+        with mock.patch('eldtrip.matrix.openrouteservice') as client:
+            client.post.return_value = response
+            result = fetch_ors_matrix(points[:1], points[1:], 'key', 'driving-hgv')
+        self.assertEqual((result['distances'].tolist(), result['durations'].tolist()), ([[1.0]], [[1.0]]))
+
+    def test_hos_feasibility_uses_each_drivers_cycle(self):
+        distances = np.array([[110.0, 550.0, np.nan], [110.0, 550.0, 5.0]])
+        feasible = hos_feasible(distances, [3.0, 11.0])
+        self.assertEqual(feasible.tolist(), [[True, False, False], [True, True, True]])
+
+
+class RouteCacheTests(SimpleTestCase):
+    def route(self):
+        geometry = RouteGeometry(np.array([30.0, 30.1, 30.2, 30.3]), np.array([-97.0, -97.0, -97.1, -97.2]))
+        return {'route_points': geometry, 'legs': [
+            {'distance': 7.0, 'duration': 0.2, 'start_index': 0, 'end_index': 1},
+            {'distance': 13.0, 'duration': 0.3, 'start_index': 1, 'end_index': 3},
+        ]}
+
+    def test_round_trip_stitches_legs_at_their_junctions(self):
+        waypoints = [{'lat': 30.0, 'lng': -97.0}, {'lat': 30.1, 'lng': -97.0}, {'lat': 30.3, 'lng': -97.2}]
+        route_cache = RouteCache()
+        self.assertIsNone(route_cache.get_route(waypoints, 'driving-hgv'))
+        route = self.route()
+        route_cache.store_route(waypoints, 'driving-hgv', route)
+
+        cached = route_cache.get_route(waypoints, 'driving-hgv')
+        np.testing.assert_allclose(cached['route_points'].tolist(), route['route_points'].tolist(), atol=1e-6)
+        self.assertEqual([(leg['start_index'], leg['end_index']) for leg in cached['legs']], [(0, 1), (1, 3)])
+        self.assertEqual((cached['distance'], cached['duration']), (20.0, 0.5))
+        # Each leg is reusable on its own, but not a route with an uncached leg
+        self.assertEqual(len(route_cache.get_route(waypoints[1:], 'driving-hgv')['route_points']), 3)
+        self.assertIsNone(route_cache.get_route(waypoints, 'driving-car'))
+        self.assertIsNone(route_cache.get_route([*waypoints, waypoints[0]], 'driving-hgv'))
+        stats = route_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 3, 2))
+
+    def test_leg_totals_in_one_lookup(self):
+        waypoints = [{'lat': 30.0, 'lng': -97.0}, {'lat': 30.1, 'lng': -97.0}, {'lat': 30.3, 'lng': -97.2}]
+        route_cache = RouteCache()
+        route_cache.store_route(waypoints, 'driving-hgv', self.route())
+        with mock.patch.object(route_cache.backend, 'get', side_effect=AssertionError):
+            legs = route_cache.get_leg_totals(
+                [(waypoints[0], waypoints[1]), (waypoints[1], waypoints[0]), (waypoints[1], waypoints[2])], 'driving-hgv'
+            )
+        self.assertEqual(legs, [(7.0, 0.2), None, (13.0, 0.3)])
+
+    def test_django_cache_clear_only_drops_route_entries(self):
+        waypoints = [{'lat': 30.0, 'lng': -97.0}, {'lat': 30.1, 'lng': -97.0}, {'lat': 30.3, 'lng': -97.2}]
+        route_cache = RouteCache(DjangoCacheRouteCacheBackend())
+        cache.set('unrelated', 'kept')
+        route_cache.store_route(waypoints, 'driving-hgv', self.route())
+        self.assertIsNotNone(route_cache.get_route(waypoints, 'driving-hgv'))
+
+        route_cache.clear()
+        self.assertIsNone(route_cache.get_route(waypoints, 'driving-hgv'))
+        self.assertEqual(cache.get('unrelated'), 'kept')
+        route_cache.store_route(waypoints, 'driving-hgv', self.route())
+        self.assertIsNotNone(route_cache.get_route(waypoints, 'driving-hgv'))
+
+
+class DatabaseRouteCacheTests(TestCase):
+    def test_eviction_runs_every_n_writes(self):
+        backend = DatabaseRouteCacheBackend(max_entries=2, evict_every=3)
+        entry = {'distance': 1.0, 'duration': 0.1, 'geometry': b'x'}
+        for n in range(5):
+            backend.set(f'route:{n}', entry, ttl=60)
+        # Evicted down to 2 on the third write, then two more
+        self.assertEqual(RouteCacheEntry.objects.count(), 4)
+        self.assertIsNone(backend.get('route:0'))
+        self.assertEqual(backend.evict(), 2)
+        found = backend.get_many(['route:3', 'route:4', 'route:9'], geometry=False)
+        self.assertEqual(sorted(found), ['route:3', 'route:4'])
+        self.assertNotIn('geometry', found['route:3'])
+        self.assertEqual(sorted(RouteCacheEntry.objects.values_list('cache_key', flat=True)), ['route:3', 'route:4'])
+
+
+class TripRequestTests(SimpleTestCase):
+    trip = {'currentLocation': 'Dallas, TX', 'pickupLocation': 'Tulsa, OK', 'dropoffLocation': 'Denver, CO'}
+
+    def test_extra_stops_must_be_a_list_of_addresses(self):
+        trip_data, error = parse_trip_request({**self.trip, 'extraStops': ['Wichita, KS']})
+        self.assertEqual((trip_data['extraStops'], error), (['Wichita, KS'], None))
+        self.assertEqual(parse_trip_request(self.trip)[0]['extraStops'], [])
+        for extra_stops in ('Austin, TX', ['Austin, TX', ''], [{'location': 'Austin, TX'}], {'a': 1}):
+            self.assertEqual(parse_trip_request({**self.trip, 'extraStops': extra_stops}),
+                             (None, 'extraStops must be a list of addresses'))
+        response = self.client.post('/api/calculate-route/', {**self.trip, 'extraStops': 'Austin, TX'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        with self.assertRaises(TypeError):
+            plan_cache_key('calculate-route', {**self.trip, 'extraStops': 'Austin, TX'})
+
+    def test_ors_segments_become_legs(self):
+        body = {'features': [{
+            'geometry': {'coordinates': [[-97.0, 30.0 + 0.1 * i] for i in range(5)]},
+            'properties': {
+                'segments': [{'distance': 16093.4, 'duration': 600}, {'distance': 32186.8, 'duration': 1800}],
+                'way_points': [0, 3, 4],
+            },
+        }]}
+        response = mock.Mock(ok=True, status_code=200, **{'json.return_value': body})
+        with mock.patch.object(views.openrouteservice, 'post', return_value=response) as post:
+            route = views.fetch_waypoint_route([{'lat': 30.0, 'lng': -97.0}, {'lat': 30.3, 'lng': -97.0},
+                                                {'lat': 30.4, 'lng': -97.0}], api_key='key')
+        self.assertEqual(post.call_args.kwargs['json'], {'coordinates': [[-97.0, 30.0], [-97.0, 30.3], [-97.0, 30.4]]})
+        self.assertTrue(route['is_road_based'])
+        self.assertEqual(len(route['route_points']), 5)
+        self.assertEqual([(leg['start_index'], leg['end_index']) for leg in route['legs']], [(0, 3), (3, 4)])
+        for leg, miles, hours in zip(route['legs'], (10, 20), (1 / 6, 0.5)):
+            self.assertAlmostEqual(leg['distance'], miles)
+            self.assertAlmostEqual(leg['duration'], hours)
+        self.assertAlmostEqual(route['distance'], 30)
+        self.assertAlmostEqual(route['duration'], 2 / 3)
+
+
+class PlanCacheTests(SimpleTestCase):
+    trip = {'currentLocation': 'Dallas, TX', 'pickupLocation': 'Tulsa, OK',
+            'dropoffLocation': 'Denver, CO', 'currentCycleHours': 12}
+
+    def test_key_ignores_spelling_and_number_format(self):
+        key = plan_cache_key('plan-trip', self.trip)
+        same = {**self.trip, 'currentLocation': ' dallas  TX. ', 'currentCycleHours': '12.0', 'extraStops': []}
+        self.assertEqual(plan_cache_key('plan-trip', same), key)
+        self.assertNotEqual(plan_cache_key('plan-trip', {**self.trip, 'currentCycleHours': 13}), key)
+        self.assertNotEqual(plan_cache_key('calculate-route', self.trip), key)
+        self.assertNotEqual(plan_cache_key('plan-trip', self.trip, excluded=['routeCoordinates']), key)
+
+    def test_entries_expire_with_their_dependencies(self):
+        cache = PlanCache()
+        etag = cache.set('a', b'{"plan":1}', expires_at=time.time() + 60)
+        self.assertEqual(cache.get('a'), (b'{"plan":1}', etag, None))
+        self.assertTrue(etag_matches(f'"other", W/{etag}', etag))
+        self.assertFalse(etag_matches('"other"', etag))
+
+        cache.set('b', b'{"plan":2}', expires_at=time.time() - 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['expired'], 1)
+
+
+class GazetteerTests(SimpleTestCase):
+    def setUp(self):
+        self.gazetteer = Gazetteer([
+            ('Dallas, TX', 32.7767, -96.7970, 1),
+            ('Dallas, GA', 33.9237, -84.8408, 5),
+            ('Denver, CO', 39.7392, -104.9903, 1),
+            ('75201', 32.7876, -96.7994, 0),
+            ('Pilot Travel Center Amarillo', 35.1900, -101.7500, 0),
+        ])
+
+    def test_exact_match_ignores_case_punctuation_and_country(self):
+        self.assertEqual(self.gazetteer.lookup('dallas tx, USA'), {'lat': 32.7767, 'lng': -96.7970})
+
+    def test_zip_in_street_address(self):
+        self.assertEqual(self.gazetteer.lookup('1500 Main St, Dallas, TX 75201'), {'lat': 32.7876, 'lng': -96.7994})
+
+    def test_prefix_prefers_best_rank(self):
+        self.assertEqual(self.gazetteer.lookup('Dallas'), {'lat': 32.7767, 'lng': -96.7970})
+
+    def test_fuzzy_match_and_miss(self):
+        self.assertEqual(self.gazetteer.lookup('Denvr CO'), {'lat': 39.7392, 'lng': -104.9903})
+        self.assertEqual(self.gazetteer.lookup('Pilot Travel Centre Amarilo'), {'lat': 35.19, 'lng': -101.75})
+        self.assertIsNone(self.gazetteer.lookup('Boise, ID'))
+
+    def test_state_or_zip_in_query_must_agree(self):
+        gazetteer = Gazetteer([
+            ('Portland, OR', 45.5152, -122.6784, 1),
+            ('Dallas, TX', 32.7767, -96.7970, 1),
+            ('Springfield, IL', 39.7817, -89.6501, 1),
+            ('Columbus, OH', 39.9612, -82.9988, 1),
+            ('Columbus, Georgia', 32.4610, -84.9877, 2),
+        ])
+        for address in ('Portland, ME', 'Dallas, OR', 'Springfield, MO', 'Springfield MO 65806', 'D', 'Dal'):
+            self.assertIsNone(gazetteer.lookup(address), address)
+        self.assertEqual(gazetteer.lookup('Columbus, GA'), {'lat': 32.4610, 'lng': -84.9877})
+        self.assertEqual(gazetteer.lookup('Portlnd, OR'), {'lat': 45.5152, 'lng': -122.6784})
+        self.assertEqual(gazetteer.lookup('Springfeld'), {'lat': 39.7817, 'lng': -89.6501})
+
+
+class EldLogTests(SimpleTestCase):
+    def route_plan(self, rest_stops, driving_time=20.0):
+        return {
+            'totalDistance': driving_time * 55,
+            'drivingTime': driving_time,
+            'legDistances': [55.0, driving_time * 55 - 55.0],
+            'restStops': rest_stops,
+            'currentCycleHours': 65,
+        }
+
+    def test_days_split_at_midnight_and_cover_every_minute(self):
+        rest = {'distance': 11 * 55, 'duration': 10, 'reason': '10-hour rest'}
+        logs = generate_eld_logs(self.route_plan([rest]))['days']
+        self.assertEqual(len(logs), 2)
+        for day in logs:
+            blocks = day['statusBlocks']
+            self.assertEqual(blocks[0]['startHour'], 0)
+            self.assertEqual(blocks[-1]['endHour'], 24)
+            for previous, block in zip(blocks, blocks[1:]):
+                self.assertEqual(previous['endHour'], block['startHour'])
+        self.assertEqual(logs[0]['statusBlocks'][-1], {'status': 'SB', 'startHour': 20.0, 'endHour': 24.0})
+        self.assertAlmostEqual(sum(day['drivingHours'] for day in logs), 20.0)
+
+    def test_many_duty_changes_and_rolling_cycle(self):
+        breaks = [{'distance': hour * 55, 'duration': 0.5, 'reason': 'Break'} for hour in range(1, 20)]
+        logs = generate_eld_logs(self.route_plan(breaks))['days']
+        breaks_logged = [event for day in logs for event in day['events'] if event['description'].startswith('Break')]
+        self.assertEqual(len(breaks_logged), 19)
+        self.assertAlmostEqual(sum(day['offDutyHours'] for day in logs), 48 - 20 - 2)
+        self.assertAlmostEqual(logs[0]['cycleHoursUsed'], 65 + logs[0]['drivingHours'] + logs[0]['onDutyHours'])
+        self.assertEqual(logs[0]['cycleHoursAvailable'], 0)
+
+
+class FixtureProviderTestCase(TransactionTestCase):
+    """
+    Nominatim and ORS answered from a synthetic benchmark fixture, with the
+    shared caches emptied. Planning writes from worker threads, outside a
+    test transaction, so the tables are flushed after each test instead.
+    """
+
+    def setUp(self):
+        self.fixture = synthetic_fixture(300, 2000)
+        transport = ProviderTransport(FixtureAdapter(self.fixture))
+        transport.__enter__()
+        self.addCleanup(transport.__exit__, None, None, None)
+        for shared in (views.geocode_cache, views.route_cache, views.plan_cache):
+            shared.clear()
+
+
+class BatchTests(FixtureProviderTestCase):
+    def test_each_line_reports_its_own_result_or_error(self):
+        trips = [
+            {**self.fixture['trip'], 'id': 'ok'},
+            {'currentLocation': 'Bench Origin', 'id': 'incomplete'},
+            {**self.fixture['trip'], 'pickupLocation': 'Nowhere', 'id': 'ungeocodable'},
+            'not a trip',
+        ]
+        response = self.client.post('/api/calculate-route/batch/', trips, content_type='application/json')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = {line['index']: line for line in map(json.loads, b''.join(response.streaming_content).splitlines())}
+        self.assertEqual(sorted(lines), [0, 1, 2, 3])
+        self.assertEqual(lines[0]['id'], 'ok')
+        segments = self.fixture['directions']['features'][0]['properties']['segments']
+        self.assertAlmostEqual(lines[0]['result']['totalDistance'],
+                               sum(segment['distance'] for segment in segments) / 1609.34, places=6)
+        self.assertEqual(lines[1], {'index': 1, 'id': 'incomplete', 'error': 'Missing required field: pickupLocation'})
+        self.assertIn('Nowhere', lines[2]['error'])
+        self.assertEqual(lines[3], {'index': 3, 'id': None, 'error': 'Trip must be an object'})
+
+        empty = self.client.post('/api/calculate-route/batch/', [], content_type='application/json')
+        self.assertEqual(empty.status_code, 400)
+
+
+class StreamedRouteTests(FixtureProviderTestCase):
+    def test_streamed_body_matches_the_rendered_one(self):
+        route_data = {'totalDistance': 12.5, 'restStops': [], 'tripId': 'abc',
+                      'routeCoordinates': RouteGeometry(np.linspace(30, 31, 7), np.linspace(-97, -96, 7))}
+        streamed = b''.join(stream_route_json(route_data, chunk_points=3))
+        self.assertEqual(json.loads(streamed), json.loads(dumps(route_data)))
+        self.assertEqual(json.loads(b''.join(stream_route_json({'totalDistance': 1.0}))), {'totalDistance': 1.0})
+
+    def test_stream_parameter_returns_the_same_plan(self):
+        trip = self.fixture['trip']
+        plain = self.client.post('/api/calculate-route/', trip, content_type='application/json').json()
+        response = self.client.post('/api/calculate-route/?stream=1', trip, content_type='application/json')
+        self.assertTrue(response.streaming)
+        streamed = json.loads(b''.join(response.streaming_content))
+        # Each request stores its own trip
+        self.assertNotEqual(plain.pop('tripId'), streamed.pop('tripId'))
+        self.assertEqual(streamed, plain)
+
+
+class PlanTripTests(FixtureProviderTestCase):
+    def test_route_and_logs_in_one_response(self):
+        response = self.client.post('/api/plan-trip/?exclude=routeCoordinates', self.fixture['trip'],
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        plan = response.json()
+        self.assertNotIn('routeCoordinates', plan['route'])
+        self.assertEqual(plan['eldLogs'], json.loads(dumps(generate_eld_logs(plan['route']))))
+        # The stored trip gives the same logs through generate-eld-logs
+        by_id = self.client.post('/api/generate-eld-logs/', {'tripId': plan['route']['tripId']},
+                                 content_type='application/json')
+        self.assertEqual(by_id.json(), plan['eldLogs'])
+
+    def test_plan_is_not_cached_past_an_input_that_left_its_cache(self):
+        trip = self.fixture['trip']
+        with mock.patch.object(views.route_cache, 'expires_at', return_value=None):
+            response = self.client.post('/api/plan-trip/', trip, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ETag', response)
+        self.assertEqual(views.plan_cache.stats()['entries'], 0)
+
+        self.client.post('/api/plan-trip/', trip, content_type='application/json')
+        self.assertEqual(views.plan_cache.stats()['entries'], 1)
+        # A geocode missing from both tiers counts as expired too
+        with mock.patch.object(views.geocode_cache, 'expires_at', return_value=None):
+            self.assertLessEqual(views.plan_expires_at(trip, response.json()['route']), time.time())
+
+    def test_cached_plan_keeps_each_requests_spelling(self):
+        trip = self.fixture['trip']
+        first = self.client.post('/api/plan-trip/', trip, content_type='application/json')
+        respelled = {**trip, 'pickupLocation': ' bench   PICKUP. '}
+        second = self.client.post('/api/plan-trip/', respelled, content_type='application/json')
+        self.assertEqual(views.plan_cache.stats()['hits'], 1)
+        self.assertEqual(second.json()['route']['pickupLocation'], ' bench   PICKUP. ')
+        self.assertEqual(second.json()['route']['startLocation'], trip['currentLocation'])
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        # Everything else is the cached plan
+        plan = first.json()
+        plan['route']['pickupLocation'] = ' bench   PICKUP. '
+        self.assertEqual(second.json(), plan)
+        third = self.client.post('/api/plan-trip/', trip, content_type='application/json')
+        self.assertEqual((third.content, third['ETag']), (first.content, first['ETag']))
+
+
+class InstrumentationTests(FixtureProviderTestCase):
+    def metric(self, sample):
+        """Current value of one sample line in the metrics endpoint's output"""
+        for line in self.client.get('/api/metrics/').content.decode().splitlines():
+            if line.startswith(sample + ' '):
+                return float(line.rsplit(' ', 1)[1])
+        return 0.0
+
+    def test_server_timing_and_metrics(self):
+        requests_sample = 'eldtrip_request_seconds_count{view="CalculateRouteView",method="POST",status="200"}'
+        geocodes_sample = 'eldtrip_provider_request_seconds_count{provider="nominatim",status="200"}'
+        requests_before, geocodes_before = self.metric(requests_sample), self.metric(geocodes_sample)
+
+        response = self.client.post('/api/calculate-route/', self.fixture['trip'], content_type='application/json')
+        timings = [entry.strip().split(';') for entry in response['Server-Timing'].split(',')]
+        names = [entry[0] for entry in timings]
+        for stage in ('nominatim', 'geocode', 'openrouteservice', 'route', 'hos', 'render'):
+            self.assertIn(stage, names)
+        self.assertEqual(names[-1], 'total')
+        self.assertTrue(all(entry[1].startswith('dur=') for entry in timings))
+        self.assertIn('desc="3 calls"', timings[names.index('nominatim')])
+
+        metrics = self.client.get('/api/metrics/')
+        self.assertTrue(metrics['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertEqual(self.metric(requests_sample), requests_before + 1)
+        self.assertEqual(self.metric(geocodes_sample), geocodes_before + 3)
+
+
+class TripStorageTests(TestCase):
+    def route_data(self):
+        return {
+            'totalDistance': 1100.0,
+            'drivingTime': 20.0,
+            'legDistances': [55.0, 1045.0],
+            'restStops': [{'distance': 605.0, 'duration': 10, 'reason': '10-hour rest'}],
+            'currentCycleHours': 5,
+            'routeCoordinates': RouteGeometry(np.linspace(30, 45, 50), np.full(50, -97.0)),
+        }
+
+    def test_saved_trip_loads_with_and_without_geometry(self):
+        route_data = self.route_data()
+        trip_id = save_trip(route_data)
+        summary = load_trip(trip_id)
+        self.assertNotIn('routeCoordinates', summary)
+        self.assertEqual((summary['tripId'], summary['restStops']), (trip_id, route_data['restStops']))
+        geometry = load_trip(trip_id, include_geometry=True)['routeCoordinates']
+        np.testing.assert_allclose(geometry.tolist(), route_data['routeCoordinates'].tolist(), atol=1e-6)
+        self.assertIsNone(load_trip('not-a-uuid'))
+        self.assertIsNone(load_trip('00000000-0000-0000-0000-000000000000'))
+
+    def test_eld_logs_from_a_trip_id(self):
+        route_data = self.route_data()
+        trip_id = save_trip(route_data)
+        by_id = self.client.post('/api/generate-eld-logs/', {'tripId': trip_id}, content_type='application/json')
+        self.assertEqual(by_id.status_code, 200)
+        route_data.pop('routeCoordinates')
+        self.assertEqual(by_id.json(), json.loads(dumps(generate_eld_logs(route_data))))
+        missing = self.client.post('/api/generate-eld-logs/', {'tripId': '00000000-0000-0000-0000-000000000000'},
+                                   content_type='application/json')
+        self.assertEqual(missing.status_code, 404)
+
+
+class DriverCycleTests(SimpleTestCase):
+    def test_rolling_window_and_restart(self):
+        cycle = DriverCycle()
+        for day in range(7):
+            cycle.record(day * 24 + 8, day * 24 + 18)
+        self.assertEqual(cycle.hours_used(6 * 24 + 20), 70)
+        self.assertEqual(cycle.hours_available(6 * 24 + 20), 0)
+        # 34 hours off duty after the last shift restarts the cycle
+        self.assertEqual(cycle.hours_used(7 * 24 + 4), 70)
+        self.assertEqual(cycle.hours_used(8 * 24 + 4), 0)
+        cycle.record(9 * 24 + 8, 9 * 24 + 12)
+        self.assertEqual(cycle.hours_used(9 * 24 + 20), 4)
+        self.assertEqual(cycle.last_restart, 6 * 24 + 18 + 34)
+
+    def test_period_across_midnight_and_old_days_leave_window(self):
+        cycle = DriverCycle(history_days=10)
+        cycle.record(20, 30)
+        self.assertEqual(cycle.hours_used(23.5), 3.5)
+        self.assertEqual(cycle.hours_used(31), 10)
+        for day in range(1, 30):
+            cycle.record(day * 24 + 8, day * 24 + 9)
+        self.assertEqual(cycle.hours_used(29 * 24 + 20), 8)
+
+    def test_later_on_duty_time_that_day_is_not_counted_yet(self):
+        cycle = DriverCycle()
+        cycle.record(8, 12)
+        cycle.record(14, 20)
+        self.assertEqual(cycle.hours_used(10), 2)
+        self.assertEqual(cycle.hours_used(13), 4)
+        self.assertEqual(cycle.hours_used(16), 6)
+        self.assertEqual(cycle.hours_used(23), 10)
+
+    def test_times_without_offset_are_utc(self):
+        self.assertEqual(epoch_hours('1970-01-02T00:00:00'), 24)
+        self.assertEqual(epoch_hours('1970-01-02T02:00:00+02:00'), 24)
+
+
+class CycleRegistryTests(TestCase):
+    def setUp(self):
+        # Cycle versions live in the cache, which outlives each test's rollback
+        cache.clear()
+
+    def test_periods_are_shared_between_registries(self):
+        now = epoch_hours()
+        day = (now // 24 - 2) * 24
+        CycleRegistry().record_periods('driver-1', [(day + 8, day + 12), (day + 32, day + 38)])
+        # Another process's registry, and a repeated upload, see the same history
+        CycleRegistry().record('driver-1', day + 8, day + 12)
+        self.assertEqual(DutyPeriod.objects.count(), 2)
+        status = CycleRegistry().status('driver-1', day + 40)
+        self.assertEqual((status['hoursUsed'], status['hoursAvailable']), (10, 60))
+        self.assertEqual(CycleRegistry().hours_used('driver-1', day + 10), 2)
+        self.assertEqual(CycleRegistry().hours_used('driver-2', day + 40), 0)
+
+    def test_queries_use_the_cached_cycle_until_a_write(self):
+        now = epoch_hours()
+        registry, other = CycleRegistry(), CycleRegistry()
+        registry.record('driver-1', now - 6, now - 1)
+        self.assertAlmostEqual(registry.hours_used('driver-1', now), 5)
+        with self.assertNumQueries(0):
+            self.assertAlmostEqual(registry.hours_used('driver-1', now + 1), 5)
+        # Another process's write is seen on the next query
+        other.record('driver-1', now + 2, now + 3)
+        with self.assertNumQueries(1):
+            self.assertAlmostEqual(registry.hours_used('driver-1', now + 4), 6)
+        # Earlier times leave out the periods recorded after them
+        self.assertAlmostEqual(registry.hours_used('driver-1', now + 1), 5)
+
+    def test_trip_request_uses_the_drivers_recorded_cycle(self):
+        now = epoch_hours()
+        CycleRegistry().record('driver-1', now - 6, now - 1)
+        trip_data, error = parse_trip_request({
+            'currentLocation': 'A', 'pickupLocation': 'B', 'dropoffLocation': 'C', 'driverId': 'driver-1'
+        })
+        self.assertIsNone(error)
+        # The week's hours limit the cycle, not the current shift
+        self.assertEqual(trip_data['currentCycleHours'], 0)
+        self.assertAlmostEqual(trip_data['cycleHoursAvailable'], 65)
+        self.assertNotEqual(plan_cache_key('calculate-route', trip_data),
+                            plan_cache_key('calculate-route', {**trip_data, 'cycleHoursAvailable': None}))
+
+    def test_week_of_driving_does_not_start_the_trip_with_a_rest(self):
+        now = epoch_hours()
+        day = (now // 24 - 3) * 24
+        CycleRegistry().record_periods('driver-1', [(day + 6, day + 18), (day + 30, day + 42)])
+        trip_data, _ = parse_trip_request({
+            'currentLocation': 'A', 'pickupLocation': 'B', 'dropoffLocation': 'C', 'driverId': 'driver-1'
+        })
+        geometry = RouteGeometry(np.linspace(30, 35, 501), np.full(501, -97.0))
+        rest_stops, _, _ = plan_hos_stops(geometry, np.arange(501, dtype=np.float64), [500],
+                                          current_cycle_hours=trip_data['currentCycleHours'],
+                                          cycle_hours_available=trip_data['cycleHoursAvailable'])
+        # 24 hours used: the first stop is the 30-minute break after 8 hours of driving
+        self.assertEqual([(stop['distance'], stop['duration']) for stop in rest_stops], [(440.0, 0.5)])
+
+    def test_purge_keeps_recent_periods(self):
+        now = epoch_hours()
+        CycleRegistry().record_periods('driver-1', [(now - 24 * 60, now - 24 * 60 + 5), (now - 5, now - 1)])
+        self.assertEqual(purge_old_duty_periods(), 1)
+        self.assertEqual(CycleRegistry().hours_used('driver-1', now), 4)
+
+
+class HosPlannerTests(SimpleTestCase):
+    def setUp(self):
+        # 1100 miles due north, one route point per mile: 20 hours of driving at 55 mph
+        self.geometry = RouteGeometry(np.linspace(30, 45, 1101), np.full(1101, -97.0))
+        self.cumulative_distance = np.arange(1101, dtype=np.float64)
+
+    def plan(self, leg_end_indices=(1100,), **kwargs):
+        rest_stops, fuel_stops, stop_segments = plan_hos_stops(
+            self.geometry, self.cumulative_distance, list(leg_end_indices), **kwargs)
+        self.assertEqual(len(stop_segments), len(rest_stops) + len(fuel_stops))
+        return [(stop['distance'], stop['duration']) for stop in rest_stops], [stop['distance'] for stop in fuel_stops]
+
+    def test_break_rest_and_fuel_placement(self):
+        rests, fuels = self.plan()
+        # Break after 8 hours, 10-hour rest after 11, next break 8 hours into the new shift
+        self.assertEqual(rests, [(440.0, 0.5), (605.0, 10), (1045.0, 0.5)])
+        self.assertEqual(fuels, [550.0])
+
+    def test_on_duty_stops_count_toward_the_14_hour_window(self):
+        rests, _ = self.plan(leg_end_indices=(55, 110, 165, 220, 1100))
+        # 4 on-duty hours and the break close the window after 9.5 hours of driving
+        self.assertEqual(rests, [(440.0, 0.5), (522.5, 10), (962.5, 0.5)])
+
+    def test_restart_when_the_cycle_runs_out(self):
+        rests, _ = self.plan(cycle_hours_available=5)
+        self.assertEqual(rests, [(275.0, 34), (715.0, 0.5), (880.0, 10)])
+        # Hours already driven this shift move the first break and rest forward
+        rests, _ = self.plan(current_cycle_hours=10)
+        self.assertEqual(rests, [(0.0, 0.5), (55.0, 10), (495.0, 0.5), (660.0, 10)])
+
+
+class FacilitySnapTests(SimpleTestCase):
+    def setUp(self):
+        # Due north along a meridian, about 0.69 miles between points
+        self.geometry = RouteGeometry(np.linspace(30, 45, 1501), np.full(1501, -97.0))
+        self.cumulative = self.geometry.cumulative_distances()
+
+    def plan(self, facilities, **kwargs):
+        index = FacilityIndex(facilities)
+        return plan_hos_stops(self.geometry, self.cumulative, [1500],
+                              snap=index.stop_snapper(self.geometry, self.cumulative), **kwargs)
+
+    def facility_before(self, due, miles):
+        """A truck stop the given miles before a point of the route, half a mile off it"""
+        lat = 30 + (due - miles) / self.cumulative[-1] * 15
+        return {'name': 'Truck Plaza', 'kind': 'truck_stop', 'lat': lat, 'lng': -97.01}
+
+    def test_stops_move_back_to_facilities_before_they_fall_due(self):
+        unsnapped, _, _ = plan_hos_stops(self.geometry, self.cumulative, [1500])
+        self.assertIsNone(unsnapped[0]['facility'])
+        due = unsnapped[0]['distance']  # 30-minute break after 8 hours
+
+        # 10 miles before the break, half a mile off the route
+        lat = 30 + (due - 10) / self.cumulative[-1] * 15
+        rest_stops, _, _ = self.plan([
+            {'name': 'Truck Plaza', 'kind': 'truck_stop', 'lat': lat, 'lng': -97.01},
+            {'name': 'Gas Only', 'kind': 'fuel', 'lat': lat + 0.1, 'lng': -97.0},
+        ])
+        self.assertEqual(rest_stops[0]['facility']['name'], 'Truck Plaza')
+        self.assertEqual(rest_stops[0]['coordinates'], [lat, -97.01])
+        self.assertLess(rest_stops[0]['distance'], due - 9)
+        self.assertGreater(rest_stops[0]['distance'], due - 11)
+        # The 11-hour limit still counts from the start of the shift
+        self.assertAlmostEqual(rest_stops[1]['distance'], 11 * 55, delta=0.5)
+        self.assertIsNone(rest_stops[1]['facility'])
+
+    def test_due_restart_moves_to_the_facility(self):
+        for available in (5, 8):
+            unsnapped, _, _ = plan_hos_stops(self.geometry, self.cumulative, [1500], cycle_hours_available=available)
+            restart = unsnapped[0]
+            self.assertEqual(restart['duration'], 34)
+
+            rest_stops, _, _ = self.plan([self.facility_before(restart['distance'], 10)],
+                                         cycle_hours_available=available)
+            self.assertEqual(rest_stops[0]['duration'], 34)
+            self.assertEqual(rest_stops[0]['facility']['name'], 'Truck Plaza')
+            self.assertAlmostEqual(rest_stops[0]['distance'], restart['distance'] - 10, delta=1)
+            # Only one restart, and the next shift counts from the facility
+            self.assertEqual([stop['duration'] for stop in rest_stops].count(34), 1)
+            self.assertAlmostEqual(rest_stops[1]['distance'], rest_stops[0]['distance'] + 8 * 55, delta=1)
+
+    def test_no_facility_in_window_keeps_computed_stop(self):
+        rest_stops, _, _ = self.plan([{'name': 'Far', 'kind': 'truck_stop', 'lat': 30.0, 'lng': -90.0}])
+        self.assertTrue(all(stop['facility'] is None for stop in rest_stops))
+
+
+class PlanningJobTests(TestCase):
+    def setUp(self):
+        self.calls = 0
+
+        def flaky(request):
+            self.calls += 1
+            return {'error': 'ORS timed out', 'retryable': True} if self.calls < request['failures'] + 1 else {'ok': True}
+        register_job_handler('test-flaky', flaky)
+
+    def test_error_results_are_retried_until_max_attempts(self):
+        succeeds = submit_job('test-flaky', {'failures': 1})
+        job = claim_job('worker')
+        self.assertEqual(run_job(job, 'worker'), PlanningJob.QUEUED)
+        self.assertIsNone(claim_job('worker'))  # backing off
+
+        PlanningJob.objects.update(run_after=job.run_after)
+        job = claim_job('worker')
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(run_job(job, 'worker'), PlanningJob.SUCCEEDED)
+        self.assertEqual(bytes(PlanningJob.objects.get(id=succeeds).result), b'{"ok":true}')
+
+        self.calls = 0
+        fails = submit_job('test-flaky', {'failures': 5})
+        for _ in range(3):
+            PlanningJob.objects.filter(status=PlanningJob.QUEUED).update(run_after=job.run_after)
+            run_job(claim_job('worker'), 'worker')
+        failed = PlanningJob.objects.get(id=fails)
+        self.assertEqual((failed.status, failed.attempts, failed.error), (PlanningJob.FAILED, 3, 'ORS timed out'))
+
+    def test_permanent_errors_fail_at_once(self):
+        def fail(request):
+            if request['how'] == 'result':
+                return {'error': 'Could not geocode location: nowhere'}
+            if request['how'] == 'transport':
+                raise requests.ConnectionError('connection reset')
+            raise KeyError('pickupLocation')
+        register_job_handler('test-failing', fail)
+
+        outcomes = {}
+        for how in ('result', 'invalid', 'transport'):
+            submit_job('test-failing', {'how': how})
+            job = claim_job('worker')
+            outcomes[how] = (run_job(job, 'worker'), PlanningJob.objects.get(id=job.id).error)
+        self.assertEqual(outcomes, {
+            'result': (PlanningJob.FAILED, 'Could not geocode location: nowhere'),
+            'invalid': (PlanningJob.FAILED, "'pickupLocation'"),
+            'transport': (PlanningJob.QUEUED, 'connection reset'),
+        })
+
+    def test_nominatim_outage_is_retried(self):
+        views.geocode_cache.clear()
+        self.addCleanup(views.geocode_cache.clear)
+        trip = {'currentLocation': 'Dallas, TX', 'pickupLocation': 'Tulsa, OK', 'dropoffLocation': 'Denver, CO'}
+        # Patched for the whole test: geocodes still running after a failure aren't waited for
+        nominatim_get = self.enterContext(mock.patch.object(views.nominatim, 'get'))
+        nominatim_get.side_effect = requests.ConnectionError('connection refused')
+        submit_job('calculate-route', {'trip': trip})
+        job = claim_job('worker')
+        self.assertEqual(run_job(job, 'worker'), PlanningJob.QUEUED)
+        self.assertTrue(PlanningJob.objects.get(id=job.id).error.startswith('Geocoding failed for location: '))
+
+        # An address Nominatim doesn't know fails the job
+        found = mock.Mock(status_code=200, **{'json.return_value': [{'lat': '32.8', 'lon': '-96.8'}]})
+        empty = mock.Mock(status_code=200, **{'json.return_value': []})
+        nominatim_get.side_effect = lambda path, params: empty if params['q'] == 'Nowhere' else found
+        submit_job('calculate-route', {'trip': {**trip, 'pickupLocation': 'Nowhere'}})
+        job = claim_job('worker')
+        self.assertEqual(run_job(job, 'worker'), PlanningJob.FAILED)
+        self.assertEqual(PlanningJob.objects.get(id=job.id).error, 'Could not geocode location: Nowhere')
+
+    def test_expired_lease_is_reclaimed_and_late_outcome_dropped(self):
+        submit_job('test-flaky', {'failures': 0})
+        first = claim_job('dead', lease_seconds=-1)
+        second = claim_job('alive')
+        self.assertEqual((second.id, second.attempts), (first.id, 2))
+
+        run_job(first, 'dead')
+        job = PlanningJob.objects.get(id=first.id)
+        self.assertEqual((job.status, job.lease_owner), (PlanningJob.RUNNING, 'alive'))
+        run_job(second, 'alive')
+        self.assertEqual(PlanningJob.objects.get(id=first.id).status, PlanningJob.SUCCEEDED)
@@ -0,0 +1,88 @@
+# Server-side storage of calculated trips
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+
+from .geometry import RouteGeometry, decode_polyline
+from .models import Trip
+from .routecache import compress_geometry, decompress_geometry
+
+TRIP_RETENTION_DAYS = getattr(settings, 'TRIP_RETENTION_DAYS', 7)
+# How often, at most, save_trip also purges expired trips
+TRIP_PURGE_INTERVAL = getattr(settings, 'TRIP_PURGE_INTERVAL', 3600)  # seconds
+
+GEOMETRY_FIELDS = ('routeCoordinates', 'routePolyline')
+
+_last_purge = None
+_purge_lock = threading.Lock()
+
+
+def save_trip(route_data):
+    """
+    Store a calculate_route result and return its trip ID.
+    
+    The summary (distances, times, stops) is kept as JSON and the geometry
+    as a compressed polyline, so later requests can send just the ID.
+    """
+    summary = {key: value for key, value in route_data.items() if key not in GEOMETRY_FIELDS}
+
+    geometry = route_data.get('routeCoordinates')
+    if geometry is None and route_data.get('routePolyline'):
+        geometry = RouteGeometry(*decode_polyline(route_data['routePolyline']))
+    if geometry is not None and not isinstance(geometry, RouteGeometry):
+        geometry = RouteGeometry.from_points([{'lat': lat, 'lng': lng} for lat, lng in geometry])
+
+    trip = Trip.objects.create(
+        summary=summary,
+        geometry=compress_geometry(geometry) if geometry is not None else None
+    )
+    _maybe_purge()
+    return str(trip.id)
+
+
+def load_trip(trip_id, include_geometry=False):
+    """
+    Load a stored trip.
+    
+    Returns:
+    - the trip summary dict (with 'routeCoordinates' as a RouteGeometry when
+      include_geometry is set), or None if the trip doesn't exist or expired
+    """
+    try:
+        trip = Trip.objects.filter(id=trip_id, created_at__gt=retention_cutoff()).first()
+    except Exception as e:
+        # Malformed IDs raise a ValidationError
+        print(f"Error loading trip {trip_id}: {e}")
+        return None
+    if trip is None:
+        return None
+
+    route_data = dict(trip.summary)
+    route_data['tripId'] = str(trip.id)
+    if include_geometry and trip.geometry is not None:
+        route_data['routeCoordinates'] = decompress_geometry(trip.geometry)
+    return route_data
+
+
+def retention_cutoff():
+    return datetime.now(timezone.utc) - timedelta(days=TRIP_RETENTION_DAYS)
+
+
+def purge_expired_trips():
+    """Delete trips older than the retention period, returning the number removed"""
+    deleted, _ = Trip.objects.filter(created_at__lte=retention_cutoff()).delete()
+    return deleted
+
+
+def _maybe_purge():
+    global _last_purge
+    with _purge_lock:
+        if _last_purge is not None and time.monotonic() - _last_purge < TRIP_PURGE_INTERVAL:
+            return
+        _last_purge = time.monotonic()
+    try:
+        purge_expired_trips()
+    except Exception as e:
+        print(f"Error purging expired trips: {e}")
@@ -1,10 +1,21 @@
 # filepath: e:\eld-trip-planner\eld_backend\eldtrip\urls.py
 from django.urls import path
-from .views import GeocodeView, CalculateRouteView, GenerateEldLogsView
+from .views import GeocodeView, GeocodeCacheStatsView, CalculateRouteView, BatchCalculateRouteView, MatrixView, RouteCacheStatsView, PlanTripView, PlanCacheStatsView, GenerateEldLogsView, PlanningJobListView, PlanningJobView, ProviderStatsView, DriverCycleView, MetricsView
 
 urlpatterns = [
     # path('', index, name='index'),
     path('geocode/', GeocodeView.as_view(), name='geocode'),
+    path('geocode/cache-stats/', GeocodeCacheStatsView.as_view(), name='geocode_cache_stats'),
     path('calculate-route/', CalculateRouteView.as_view(), name='calculate_route'),
+    path('calculate-route/batch/', BatchCalculateRouteView.as_view(), name='calculate_route_batch'),
+    path('calculate-route/matrix/', MatrixView.as_view(), name='calculate_route_matrix'),
+    path('calculate-route/cache-stats/', RouteCacheStatsView.as_view(), name='route_cache_stats'),
+    path('plan-trip/', PlanTripView.as_view(), name='plan_trip'),
+    path('plan-trip/cache-stats/', PlanCacheStatsView.as_view(), name='plan_cache_stats'),
+    path('jobs/', PlanningJobListView.as_view(), name='planning_jobs'),
+    path('jobs/<str:job_id>/', PlanningJobView.as_view(), name='planning_job'),
+    path('drivers/<str:driver_id>/cycle/', DriverCycleView.as_view(), name='driver_cycle'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
+    path('providers/stats/', ProviderStatsView.as_view(), name='provider_stats'),
     path('generate-eld-logs/', GenerateEldLogsView.as_view(), name='generate_eld_logs'),
 ]
\ No newline at end of file
@@ -1,36 +1,175 @@
 # filepath: e:\eld-trip-planner\eld_backend\eldtrip\views.py
 # Django views using class-based views
-import json
+import contextvars
 import math
-from datetime import datetime, timedelta
 import requests
-import random
 import time
-from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
 from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, StreamingHttpResponse
+from django.urls import reverse
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.settings import api_settings
+from .cycle import CYCLE_LIMIT_HOURS, driver_cycles, epoch_hours
+from .eldlogs import generate_eld_logs
+from .gazetteer import get_gazetteer
+from .geocache import GeocodeCache, normalize_address
+from .geometry import RouteGeometry, zoom_tolerance
+from .hos import AVERAGE_SPEED_MPH, STOP_ON_DUTY_HOURS, plan_hos_stops
+from .jobs import job_kinds, job_status, register_job_handler, submit_job
+from .instrumentation import (PROFILE_SLOW_REQUEST_MS, SamplingProfiler, render_metrics, request_seconds,
+                              request_timings, response_bytes, span)
+from .matrix import cached_matrix, fetch_ors_matrix, hos_feasible, local_matrix, matrix_blocks, matrix_json
+from .plancache import PlanCache, body_etag, etag_matches, plan_cache_key
+from .poi import POI_DATASET_PATH, get_facility_index
+from .providers import nominatim, openrouteservice
+from .renderers import FastJSONParser, FastJSONRenderer, dumps, loads
+from .road_graph import get_road_graph
+from .routecache import RouteCache
+from .trips import load_trip, save_trip
 
 # Utility functions for route calculation
 def geocode_address(address):
-    """Geocode address using OpenStreetMap Nominatim API"""
+    """
+    Geocode address using OpenStreetMap Nominatim API
+    
+    Returns:
+    - {'lat', 'lng'}, or None when Nominatim finds nothing
+    
+    Raises requests.RequestException when Nominatim can't be reached, is
+    still throttling after the retries (ProviderThrottled) or answers with
+    an error status or a malformed body, so callers can tell an outage
+    from an unknown address.
+    """
+    response = nominatim.get(
+        '/search',
+        params={'q': address, 'format': 'json', 'limit': 1}
+    )
+    response.raise_for_status()
     try:
-        headers = {
-            'User-Agent': 'eldTrip/1.0 (syedarqum1999@gmail.com)'
-        }
-        response = requests.get(
-            'https://nominatim.openstreetmap.org/search',
-            params={'q': address, 'format': 'json', 'limit': 1},
-            headers=headers
-        )
-        response.raise_for_status()
         data = response.json()
-        if data:
-            return {'lat': float(data[0]['lat']), 'lng': float(data[0]['lon'])}
-    except Exception as e:
+        if not data:
+            return None
+        return {'lat': float(data[0]['lat']), 'lng': float(data[0]['lon'])}
+    except (ValueError, LookupError, TypeError) as e:
+        raise requests.RequestException(f"Unexpected Nominatim response: {e}", response=response) from e
+
+# Shared two-tier cache in front of the Nominatim lookups
+geocode_cache = GeocodeCache(geocode_address)
+
+# 'nominatim', or 'local' to try the offline gazetteer before the cache and Nominatim
+GEOCODING_BACKEND = getattr(settings, 'GEOCODING_BACKEND', 'nominatim')
+
+def cached_geocode_address(address, cache=None):
+    """
+    Geocode address through the local gazetteer (if enabled), then the geocode cache.
+    
+    Parameters:
+    - cache: GeocodeCache to use instead of the shared one
+    """
+    if GEOCODING_BACKEND == 'local':
+        coords = get_gazetteer().lookup(address)
+        if coords is not None:
+            return coords
+    return (cache or geocode_cache).get(address)
+
+def geocode_or_error(address):
+    """cached_geocode_address, returning a provider failure instead of raising it"""
+    try:
+        return cached_geocode_address(address)
+    except requests.RequestException as e:
         print(f"Error geocoding address: {e}")
+        return e
+
+# Shared worker pool for blocking provider calls (Nominatim, ORS)
+PROVIDER_MAX_WORKERS = getattr(settings, 'PROVIDER_MAX_WORKERS', 8)
+PROVIDER_CALL_TIMEOUT = getattr(settings, 'PROVIDER_CALL_TIMEOUT', 60)  # seconds
+# Budget for all the provider calls of one plan or matrix together (geocoding, then routing)
+PLAN_DEADLINE = getattr(settings, 'PLAN_DEADLINE', PROVIDER_CALL_TIMEOUT)  # seconds
+provider_executor = ThreadPoolExecutor(max_workers=PROVIDER_MAX_WORKERS, thread_name_prefix='eldtrip-provider')
+
+def _run_in_worker(func, args):
+    try:
+        return func(*args)
+    finally:
+        # Pool threads outlive the request, so don't leave their DB connections open
+        connection.close()
+
+# Result of a provider call that timed out or was cancelled, where None is a valid result
+TIMED_OUT = object()
+
+def run_provider_calls(calls, timeout=PROVIDER_CALL_TIMEOUT, is_failure=None, deadline=None, unfinished=None):
+    """
+    Run independent provider calls concurrently on the shared worker pool.
+    
+    Parameters:
+    - calls: list of (func, args) tuples
+    - timeout: seconds to wait for all calls together
+    - is_failure: optional predicate on a result; the first failing result
+      cancels the calls that have not started yet
+    - deadline: optional time.monotonic() value to stop waiting at, when
+      sooner than timeout; lets several rounds of calls share one budget
+    - unfinished: result given for calls that timed out or were cancelled
+    
+    Returns:
+    - list of results in the order of calls, with unfinished (None by
+      default) for any call that timed out or was cancelled
+    """
+    # Each call runs in a copy of the caller's context, so its spans count towards the request
+    futures = [
+        provider_executor.submit(contextvars.copy_context().run, _run_in_worker, func, args)
+        for func, args in calls
+    ]
+    deadline = min(time.monotonic() + timeout, deadline if deadline is not None else math.inf)
+    pending = set(futures)
     
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        failed = any(
+            future.exception() is not None or (is_failure is not None and is_failure(future.result()))
+            for future in done
+        )
+        if failed:
+            break
+    
+    # Running calls can't be interrupted, but queued ones never start
+    for future in pending:
+        future.cancel()
+    
+    results = []
+    for future in futures:
+        if future.done() and not future.cancelled():
+            results.append(future.result())  # Re-raises an exception from the call
+        else:
+            results.append(unfinished)
+    return results
+
+def geocoding_error(locations, results):
+    """
+    The error for a round of geocoding calls, or None if every location was found.
+    
+    An address Nominatim doesn't know is a permanent error and is reported
+    first; provider failures and timeouts are marked retryable.
+    
+    Parameters:
+    - results: geocode_or_error results, with TIMED_OUT for unfinished calls
+    """
+    for location, coords in zip(locations, results):
+        if coords is None:
+            return {"error": f"Could not geocode location: {location}"}
+    # Calls cancelled after a failure are reported by that failure above
+    for location, coords in zip(locations, results):
+        if isinstance(coords, requests.RequestException):
+            return {"error": f"Geocoding failed for location: {location} ({coords})", "retryable": True}
+        if coords is TIMED_OUT:
+            return {"error": f"Timed out geocoding location: {location}", "retryable": True}
     return None
 
 from geopy.distance import geodesic
@@ -165,192 +304,136 @@ def generate_route_points(start, end, num_points=10):
 #         'routeCoordinates': [[coord['lat'], coord['lng']] for coord in route_coordinates]
 #     }
 
+def trip_locations(trip_data):
+    """Addresses of a trip in visiting order: current, pickup, extra stops, dropoff"""
+    extra_stops = list(trip_data.get('extraStops') or [])
+    return [trip_data['currentLocation'], trip_data['pickupLocation'], *extra_stops, trip_data['dropoffLocation']]
+
 def calculate_route(trip_data):
     """Calculate route with realistic rest stops and fuel stops"""
-    # Geocode locations
-    start_coords = geocode_address(trip_data['currentLocation'])
-    pickup_coords = geocode_address(trip_data['pickupLocation'])
-    dropoff_coords = geocode_address(trip_data['dropoffLocation'])
+    # Geocoding and routing share one deadline
+    deadline = time.monotonic() + PLAN_DEADLINE
     
-    # Get road-based routes
-    route_to_pickup = get_road_based_route(start_coords, pickup_coords)
+    # Geocode all locations concurrently
+    locations = trip_locations(trip_data)
+    with span('geocode'):
+        waypoints = run_provider_calls(
+            [(geocode_or_error, (location,)) for location in locations],
+            is_failure=lambda coords: not isinstance(coords, dict),
+            deadline=deadline,
+            unfinished=TIMED_OUT
+        )
     
-    # Check if routing was successful
-    if not route_to_pickup.get("is_road_based", False):
-        return {
-            "error": f"Could not find a valid road route from {trip_data['currentLocation']} to {trip_data['pickupLocation']}. Error: {route_to_pickup.get('error', 'Unknown error')}"
-        }
+    error = geocoding_error(locations, waypoints)
+    if error:
+        return error
+    
+    # Get the whole road-based route (current -> pickup -> extra stops -> dropoff) in one request
+    with span('route'):
+        route, = run_provider_calls([(get_waypoint_route, (waypoints,))], deadline=deadline)
+    
+    return build_route_plan(trip_data, waypoints, route)
+
+def calculate_and_save_route(trip_data):
+    """calculate_route, storing a successful result so generate-eld-logs can refer to it by ID"""
+    route_data = calculate_route(trip_data)
+    if 'error' not in route_data:
+        try:
+            with span('trip_save'):
+                route_data['tripId'] = save_trip(route_data)
+        except Exception as e:
+            print(f"Error saving trip: {e}")
+    return route_data
+
+def plan_trip(trip_data, excluded=()):
+    """
+    Calculate a route and its ELD logs.
+    
+    Parameters:
+    - trip_data: see parse_trip_request
+    - excluded: route fields to leave out of the result
+    
+    Returns:
+    - {'route', 'eldLogs'}, or the calculate_route error
+    """
+    route_data = calculate_and_save_route(trip_data)
+    if 'error' in route_data:
+        return route_data
     
-    route_pickup_to_dropoff = get_road_based_route(pickup_coords, dropoff_coords)
+    # Logs are generated from the in-process result, no re-serialization needed
+    with span('eld_logs'):
+        eld_logs = generate_eld_logs(route_data)
     
-    # Check if routing was successful
-    if not route_pickup_to_dropoff.get("is_road_based", False):
+    route_data = {key: value for key, value in route_data.items() if key not in excluded}
+    return {'route': route_data, 'eldLogs': eld_logs}
+
+# Planning work the job workers can run (see jobs.py)
+register_job_handler('calculate-route', lambda request: calculate_and_save_route(request['trip']))
+register_job_handler('plan-trip', lambda request: plan_trip(request['trip'], request.get('exclude', ())))
+
+def build_route_plan(trip_data, waypoints, route):
+    """
+    Build the calculate_route response from geocoded waypoints and the routing result.
+    
+    Parameters:
+    - trip_data: the trip request
+    - waypoints: geocoded {'lat', 'lng'} dicts in the order of trip_locations(trip_data)
+    - route: result of get_waypoint_route, or None if the request timed out
+    """
+    extra_stops = list(trip_data.get('extraStops') or [])
+    start_coords, pickup_coords, dropoff_coords = waypoints[0], waypoints[1], waypoints[-1]
+    
+    # Check if routing was successful; 'retryable' marks provider and transport failures
+    if route is None or not route.get("is_road_based", False):
+        error = route.get('error', 'Unknown error') if route is not None else 'Request timed out'
         return {
-            "error": f"Could not find a valid road route from {trip_data['pickupLocation']} to {trip_data['dropoffLocation']}. Error: {route_pickup_to_dropoff.get('error', 'Unknown error')}"
+            "error": f"Could not find a valid road route from {trip_data['currentLocation']} to {trip_data['dropoffLocation']} via {trip_data['pickupLocation']}. Error: {error}",
+            "retryable": route is None or route.get('retryable', False)
         }
     
-    # Calculate distances and times using the road-based routes
-    distance_to_pickup = route_to_pickup["distance"]
-    distance_pickup_to_dropoff = route_pickup_to_dropoff["distance"]
+    # Calculate distances and times using the road-based route; the first leg ends at pickup
+    distance_to_pickup = route["legs"][0]["distance"]
+    distance_pickup_to_dropoff = sum(leg["distance"] for leg in route["legs"][1:])
     total_distance = distance_to_pickup + distance_pickup_to_dropoff
     
     # Use fixed 55 mph average speed for all calculations
-    avg_speed = 55  # mph
+    avg_speed = AVERAGE_SPEED_MPH
     driving_time_to_pickup = distance_to_pickup / avg_speed
     driving_time_pickup_to_dropoff = distance_pickup_to_dropoff / avg_speed
     total_driving_time = driving_time_to_pickup + driving_time_pickup_to_dropoff
     
-    # Combine route points
-    route_coordinates = route_to_pickup["route_points"] + route_pickup_to_dropoff["route_points"][1:]
-    
-    # Calculate rest stops based on HOS regulations
-    restStops = []
-    fuelStops = []
-    
-    # Current cycle hours from input
-    current_cycle_hours = float(trip_data.get('currentCycleHours', 0))
-    
-    # Initialize HOS tracking variables
-    remaining_driving_hours = 11 - current_cycle_hours if current_cycle_hours < 11 else 0
-    remaining_on_duty_hours = 14 - current_cycle_hours if current_cycle_hours < 14 else 0
-    hours_since_last_break = min(current_cycle_hours, 8)  # Cap at 8 hours
-    
-    # Sampling interval for potential rest stops (approximately every 50 miles)
-    # This prevents checking every single route point and makes rest stops more realistic
-    sampling_interval = max(1, int(len(route_coordinates) / (total_distance / 50)))
-    
-    # Track distance and time for rest stop placement
-    distance_covered = 0
-    driving_time_accumulated = 0
-    last_fuel_distance = 0
-    last_rest_stop_distance = 0
-    
-    # First, calculate all distances between consecutive points
-    segment_distances = []
-    for i in range(1, len(route_coordinates)):
-        segment_distance = calculate_distance(route_coordinates[i-1], route_coordinates[i])
-        segment_distances.append(segment_distance)
-    
-    # Place stops along the route at reasonable intervals
-    current_index = 0
-    
-    # Handle the leg to pickup location
-    while current_index < len(segment_distances) and distance_covered < distance_to_pickup:
-        segment_distance = segment_distances[current_index]
-        segment_time = segment_distance / avg_speed
-        
-        distance_covered += segment_distance
-        driving_time_accumulated += segment_time
-        hours_since_last_break += segment_time
-        
-        # Only check for rest stops at reasonable intervals
-        if current_index % sampling_interval == 0 and current_index > 0:
-            current_coords = [route_coordinates[current_index+1]['lat'], route_coordinates[current_index+1]['lng']]
-            
-            # Check if we need a 30-minute break (after 8 hours of driving)
-            if hours_since_last_break >= 8 and distance_covered - last_rest_stop_distance >= 100:
-                restStops.append({
-                    'coordinates': current_coords,
-                    'duration': 0.5,
-                    'reason': "30-minute break (8-hour driving limit)",
-                    'distance': distance_covered,
-                    'location': "En route to pickup"
-                })
-                hours_since_last_break = 0
-                last_rest_stop_distance = distance_covered
-                remaining_driving_hours -= segment_time
-                remaining_on_duty_hours -= (segment_time + 0.5)  # Driving time + break time
-            
-            # Check if we need a 10-hour rest period
-            if remaining_driving_hours <= 1 or remaining_on_duty_hours <= 1:
-                restStops.append({
-                    'coordinates': current_coords,
-                    'duration': 10,
-                    'reason': "10-hour rest (11-hour driving limit)" if remaining_driving_hours <= 1 
-                              else "10-hour rest (14-hour on-duty limit)",
-                    'distance': distance_covered,
-                    'location': "En route to pickup"
-                })
-                remaining_driving_hours = 11
-                remaining_on_duty_hours = 14
-                hours_since_last_break = 0
-                last_rest_stop_distance = distance_covered
-            
-            # Check if we need a fuel stop (every 500-600 miles is more realistic)
-            if distance_covered - last_fuel_distance >= 550:
-                fuelStops.append({
-                    'coordinates': current_coords,
-                    'distance': distance_covered,
-                    'location': "En route to pickup"
-                })
-                last_fuel_distance = distance_covered
-        
-        current_index += 1
-    
-    # Add a stop at pickup location
-    pickup_index = min(current_index, len(route_coordinates) - 1)
-    pickup_coords_list = [route_coordinates[pickup_index]['lat'], route_coordinates[pickup_index]['lng']]
+    route_coordinates = route["route_points"]
+    leg_end_indices = [leg["end_index"] for leg in route["legs"]]
     
-    # Deduct 1 hour for pickup from remaining hours
-    remaining_driving_hours = max(0, remaining_driving_hours - 0)  # No driving during pickup
-    remaining_on_duty_hours = max(0, remaining_on_duty_hours - 1)  # 1 hour for pickup
-    
-    # Handle the leg from pickup to dropoff
-    while current_index < len(segment_distances):
-        segment_distance = segment_distances[current_index]
-        segment_time = segment_distance / avg_speed
-        
-        distance_covered += segment_distance
-        driving_time_accumulated += segment_time
-        hours_since_last_break += segment_time
-        
-        # Only check for rest stops at reasonable intervals
-        if current_index % sampling_interval == 0:
-            current_coords = [route_coordinates[current_index+1]['lat'], route_coordinates[current_index+1]['lng']]
-            
-            # Check if we need a 30-minute break
-            if hours_since_last_break >= 8 and distance_covered - last_rest_stop_distance >= 100:
-                restStops.append({
-                    'coordinates': current_coords,
-                    'duration': 0.5,
-                    'reason': "30-minute break (8-hour driving limit)",
-                    'distance': distance_covered,
-                    'location': "En route to dropoff"
-                })
-                hours_since_last_break = 0
-                last_rest_stop_distance = distance_covered
-                remaining_driving_hours -= segment_time
-                remaining_on_duty_hours -= (segment_time + 0.5)
-            
-            # Check if we need a 10-hour rest period
-            if remaining_driving_hours <= 1 or remaining_on_duty_hours <= 1:
-                restStops.append({
-                    'coordinates': current_coords,
-                    'duration': 10,
-                    'reason': "10-hour rest (11-hour driving limit)" if remaining_driving_hours <= 1 
-                              else "10-hour rest (14-hour on-duty limit)",
-                    'distance': distance_covered,
-                    'location': "En route to dropoff"
-                })
-                remaining_driving_hours = 11
-                remaining_on_duty_hours = 14
-                hours_since_last_break = 0
-                last_rest_stop_distance = distance_covered
-            
-            # Check if we need a fuel stop
-            if distance_covered - last_fuel_distance >= 550:
-                fuelStops.append({
-                    'coordinates': current_coords,
-                    'distance': distance_covered,
-                    'location': "En route to dropoff"
-                })
-                last_fuel_distance = distance_covered
-        
-        current_index += 1
+    # Place rest stops and fuel stops based on HOS regulations, jumping from
+    # event to event along the cumulative distance profile; with a POI
+    # dataset, each stop moves to the last suitable facility before it is due
+    with span('distances'):
+        cumulative_distance = route_coordinates.cumulative_distances()
+    facility_index = get_facility_index()
+    with span('hos'):
+        restStops, fuelStops, stop_segments = plan_hos_stops(
+            route_coordinates,
+            cumulative_distance,
+            leg_end_indices,
+            current_cycle_hours=float(trip_data.get('currentCycleHours', 0)),
+            avg_speed=avg_speed,
+            cycle_hours_available=trip_data.get('cycleHoursAvailable'),
+            snap=facility_index.stop_snapper(route_coordinates, cumulative_distance) if facility_index else None
+        )
     
-    # Calculate total trip time including rest stops and pickup/dropoff
+    # Calculate total trip time including rest stops and on-duty time at each stop
     total_rest_time = sum(stop['duration'] for stop in restStops)
-    total_trip_time = total_driving_time + total_rest_time + 2  # 1 hour each for pickup and dropoff
+    total_trip_time = total_driving_time + total_rest_time + STOP_ON_DUTY_HOURS * len(route["legs"])
+    
+    with span('geometry'):
+        route_geometry = format_route_geometry(
+            route_coordinates,
+            # Stops lie between the two ends of their segment, so keep both
+            keep=[index + offset for index in stop_segments for offset in (0, 1)] + leg_end_indices,
+            zoom=trip_data.get('simplifyZoom'),
+            geometry_format=trip_data.get('geometryFormat', 'coordinates')
+        )
     
     return {
         'startLocation': trip_data['currentLocation'],
@@ -359,188 +442,44 @@ def calculate_route(trip_data):
         'startCoordinates': [start_coords['lat'], start_coords['lng']],
         'pickupCoordinates': [pickup_coords['lat'], pickup_coords['lng']],
         'dropoffCoordinates': [dropoff_coords['lat'], dropoff_coords['lng']],
+        'extraStops': [
+            {'location': location, 'coordinates': [coords['lat'], coords['lng']]}
+            for location, coords in zip(extra_stops, waypoints[2:-1])
+        ],
         'totalDistance': total_distance,
+        'legDistances': [leg["distance"] for leg in route["legs"]],
+        'currentCycleHours': float(trip_data.get('currentCycleHours', 0)),
         'drivingTime': total_driving_time,
         'totalTripTime': total_trip_time,
         'restStops': restStops,
         'fuelStops': fuelStops,
-        'routeCoordinates': [[coord['lat'], coord['lng']] for coord in route_coordinates]
+        **route_geometry
     }
 
-def generate_eld_logs(route_data):
-    """Generate ELD logs based on the calculated route"""
-    if not route_data:
-        return None
+def format_route_geometry(route_coordinates, keep=(), zoom=None, geometry_format='coordinates'):
+    """
+    Build the geometry part of the calculate_route response.
     
-    # Calculate how many days the trip will take
-    total_days = math.ceil(route_data['totalTripTime'] / 24)
-    days = []
+    Parameters:
+    - route_coordinates: RouteGeometry of the full route
+    - keep: route point indices that must survive simplification (stops, waypoints)
+    - zoom: optional web-map zoom level; the line is simplified to about one pixel at that zoom
+    - geometry_format: 'coordinates' for [[lat, lng], ...] or 'polyline' for a Google encoded polyline
     
-    current_hour = 8  # Start at 8 AM on the first day
-    current_day = 0
-    cycle_hours_used = 0  # Track 70-hour/8-day cycle
+    Returns:
+    - dict with either 'routeCoordinates' or 'routePolyline'
+    """
+    if zoom not in (None, ''):
+        route_coordinates, _ = route_coordinates.simplified(zoom_tolerance(zoom), keep=keep)
     
-    # Track remaining times from the route calculation
-    remaining_driving_time = route_data['drivingTime']
-    remaining_resStops = route_data['restStops'].copy()
+    if geometry_format == 'polyline':
+        return {'routePolyline': route_coordinates.encode_polyline()}
     
-    # Process each day
-    while current_day < total_days:
-        date = datetime.now() + timedelta(days=current_day)
-        date_string = date.strftime('%a, %b %d')
-        
-        day_log = {
-            'date': date_string,
-            'statusBlocks': [],
-            'events': [],
-            'drivingHours': 0,
-            'onDutyHours': 0,
-            'offDutyHours': 0,
-            'cycleHoursUsed': 0
-        }
-        
-        # Start with off duty if it's the beginning of the day and not the first day
-        if current_day > 0 and current_hour == 0:
-            day_log['statusBlocks'].append({
-                'status': 'OFF',
-                'startHour': 0,
-                'endHour': 8
-            })
-            day_log['events'].append({
-                'hour': 0,
-                'description': 'Off duty (rest period)'
-            })
-            day_log['offDutyHours'] += 8
-            current_hour = 8
-        
-        # Process the day's activities
-        while current_hour < 24 and remaining_driving_time > 0 and len(day_log['statusBlocks']) < 4:  # Limit to 4 shifts per day
-            # Check if we have a rest stop
-            if (remaining_resStops and 
-                day_log['drivingHours'] + day_log['onDutyHours'] > 0 and 
-                day_log['drivingHours'] + day_log['onDutyHours'] >= remaining_resStops[0]['duration']):
-                
-                rest_stop = remaining_resStops.pop(0)
-                rest_duration = rest_stop['duration']
-                
-                # Add off duty block for the rest stop
-                day_log['statusBlocks'].append({
-                    'status': 'SB' if rest_duration >= 8 else 'OFF',  # Use sleeper berth for long breaks
-                    'startHour': current_hour,
-                    'endHour': min(current_hour + rest_duration, 24)
-                })
-                
-                day_log['events'].append({
-                    'hour': current_hour,
-                    'description': f"{rest_stop['reason']} ({rest_duration} hours)"
-                })
-                
-                if current_hour + rest_duration <= 24:
-                    day_log['offDutyHours'] += rest_duration
-                    current_hour += rest_duration
-                else:
-                    # Rest continues to next day
-                    hours_today = 24 - current_hour
-                    day_log['offDutyHours'] += hours_today
-                    current_hour = 24  # End of day
-                
-                continue
-            
-            # Handle pickup (1 hour on-duty, not driving)
-            if day_log['drivingHours'] == 0 and day_log['onDutyHours'] == 0 and current_day == 0:
-                day_log['statusBlocks'].append({
-                    'status': 'ON',
-                    'startHour': current_hour,
-                    'endHour': current_hour + 1
-                })
-                
-                day_log['events'].append({
-                    'hour': current_hour,
-                    'description': 'On duty - Pickup location'
-                })
-                
-                day_log['onDutyHours'] += 1
-                cycle_hours_used += 1
-                current_hour += 1
-                continue
-            
-            # Handle dropoff if we're near the end of driving time
-            if remaining_driving_time <= 1 and day_log['drivingHours'] > 0:
-                day_log['statusBlocks'].append({
-                    'status': 'ON',
-                    'startHour': current_hour,
-                    'endHour': current_hour + 1
-                })
-                
-                day_log['events'].append({
-                    'hour': current_hour,
-                    'description': 'On duty - Dropoff location'
-                })
-                
-                day_log['onDutyHours'] += 1
-                cycle_hours_used += 1
-                current_hour += 1
-                remaining_driving_time = 0
-                continue
-            
-            # Regular driving period
-            driving_period = min(
-                4,  # Drive in 4-hour chunks max
-                remaining_driving_time,
-                24 - current_hour
-            )
-            
-            day_log['statusBlocks'].append({
-                'status': 'D',
-                'startHour': current_hour,
-                'endHour': current_hour + driving_period
-            })
-            
-            day_log['events'].append({
-                'hour': current_hour,
-                'description': f"Driving ({driving_period:.1f} hours)"
-            })
-            
-            day_log['drivingHours'] += driving_period
-            cycle_hours_used += driving_period
-            current_hour += driving_period
-            remaining_driving_time -= driving_period
-        
-        # Fill the rest of the day with off-duty if needed
-        if current_hour < 24:
-            day_log['statusBlocks'].append({
-                'status': 'OFF',
-                'startHour': current_hour,
-                'endHour': 24
-            })
-            
-            if current_hour < 23:  # Only log if it's a significant period
-                day_log['events'].append({
-                    'hour': current_hour,
-                    'description': 'Off duty'
-                })
-            
-            day_log['offDutyHours'] += (24 - current_hour)
-            current_hour = 24
-        
-        # Update cycle hours for the day
-        day_log['cycleHoursUsed'] = cycle_hours_used
-        
-        # Add the day to our logs
-        days.append(day_log)
-        
-        # Reset for next day
-        current_hour = 0
-        current_day += 1
-    
-    return {'days': days}
-
-# import requests
-# import time
+    # Converted to [[lat, lng], ...] only when the response is rendered
+    return {'routeCoordinates': route_coordinates}
 
 def get_road_based_route(start_coords, end_coords, 
-                         api_key=settings.OPEN_ROUTE_KEY,
-                         max_retries=3):
+                         api_key=settings.OPEN_ROUTE_KEY):
     """
     Get a road-based route using OpenRouteService (ORS).
     
@@ -548,73 +487,133 @@ def get_road_based_route(start_coords, end_coords,
     - start_coords: dict with 'lat' and 'lng' keys
     - end_coords: dict with 'lat' and 'lng' keys
     - api_key: ORS API key
-    - max_retries: number of retry attempts if the request fails
     
     Returns:
     - dict with route information or error
     """
-    last_error = None
+    return get_waypoint_route([start_coords, end_coords], api_key=api_key)
+
+ORS_PROFILE = getattr(settings, 'OPEN_ROUTE_PROFILE', 'driving-car')
+# 'ors' for OpenRouteService, 'local' for the offline road graph at ROAD_GRAPH_PATH
+ROUTING_BACKEND = getattr(settings, 'ROUTING_BACKEND', 'ors')
+
+# Shared cache of routed legs, so repeated lanes skip ORS
+route_cache = RouteCache()
+
+def get_waypoint_route(waypoints,
+                       api_key=settings.OPEN_ROUTE_KEY,
+                       profile=ORS_PROFILE,
+                       cache=None):
+    """
+    Get a road-based route through several waypoints. With the 'local'
+    routing backend the offline road graph answers directly; otherwise the
+    route cache is used when every leg is cached, and a single ORS request
+    when not.
     
-    for attempt in range(max_retries):
-        try:
-            # Prepare the API request
-            coords = [[start_coords['lng'], start_coords['lat']], 
-                      [end_coords['lng'], end_coords['lat']]]
-            
-            response = requests.post(
-                "https://api.openrouteservice.org/v2/directions/driving-car/geojson",
-                json={
-                    "coordinates": coords,
-                },
-                headers={
-                    "Authorization": api_key,
-                    "Content-Type": "application/json"
-                },
-                timeout=10 + (attempt * 5)  # Increase timeout with each retry
-            )
-            # response.raise_for_status()
-            data = response.json()
-
-            # Check for errors in the response
-            if "error" in data:
-                error_code = data["error"].get("code")
-                error_message = data["error"].get("message")
-                print(f"Error {error_code}: {error_message}")
-                return {
-                    "error": f"ORS API Error {error_code}: {error_message}",
-                    "is_road_based": False
-                }
-
-            # Extract coordinates from the route
-            coordinates = data["features"][0]["geometry"]["coordinates"]
-            # Convert from [lng, lat] to [lat, lng] format
-            route_points = [{"lat": point[1], "lng": point[0]} for point in coordinates]
-
-            # Extract distance and duration
-            distance_miles = data["features"][0]["properties"]["segments"][0]["distance"] / 1609.34
-            duration_hours = data["features"][0]["properties"]["segments"][0]["duration"] / 3600
-            
-            return {
-                "route_points": route_points,
-                "distance": distance_miles,
-                "duration": duration_hours,
-                "is_road_based": True,
-                "endpoint_used": "OpenRouteService"
-            }
+    Parameters:
+    - waypoints: list of at least two dicts with 'lat' and 'lng' keys, in visiting order
+    - api_key: ORS API key
+    - profile: ORS routing profile
+    - cache: RouteCache to use instead of the shared one
+    
+    Returns:
+    - dict with route information or error. 'legs' holds one entry per
+      consecutive pair of waypoints with its distance, duration and the
+      indices of its first and last point in 'route_points'.
+    """
+    if ROUTING_BACKEND == 'local':
+        return get_road_graph().route(waypoints)
+    
+    cache = cache or route_cache
+    with span('route_cache'):
+        route = cache.get_route(waypoints, profile)
+    if route is not None:
+        return route
+    
+    route = fetch_waypoint_route(waypoints, api_key=api_key, profile=profile)
+    if route.get("is_road_based", False):
+        with span('route_cache'):
+            cache.store_route(waypoints, profile, route)
+    return route
+
+def fetch_waypoint_route(waypoints,
+                         api_key=settings.OPEN_ROUTE_KEY,
+                         profile=ORS_PROFILE):
+    """
+    Get a road-based route through several waypoints with a single ORS request.
+    
+    Retries and timeouts are handled by the shared openrouteservice client.
+    
+    Parameters:
+    - waypoints: list of at least two dicts with 'lat' and 'lng' keys, in visiting order
+    - api_key: ORS API key
+    - profile: ORS routing profile
+    
+    Returns:
+    - dict in the get_waypoint_route shape
+    """
+    try:
+        # Prepare the API request
+        coords = [[point['lng'], point['lat']] for point in waypoints]
         
-        except requests.RequestException as e:
-            last_error = str(e)
-            print(f"ORS attempt {attempt+1} failed: {e}")
-            if attempt < max_retries - 1:
-                # Exponential backoff between retries
-                backoff_time = 2 ** attempt
-                print(f"Retrying in {backoff_time} seconds...")
-                time.sleep(backoff_time)
-    
-    # If all retries fail, return error
+        response = openrouteservice.post(
+            f"/v2/directions/{profile}/geojson",
+            json={
+                "coordinates": coords,
+            },
+            headers={
+                "Authorization": api_key
+            }
+        )
+        # response.raise_for_status()
+        data = response.json()
+    except (requests.RequestException, ValueError) as e:
+        print(f"ORS request failed: {e}")
+        return {
+            "error": f"OpenRouteService request failed: {e}",
+            "is_road_based": False,
+            "retryable": True
+        }
+
+    # Check for errors in the response; rate limit responses carry a plain message
+    if "error" in data or not response.ok:
+        error = data.get("error", data)
+        if isinstance(error, dict):
+            error_code = error.get("code", response.status_code)
+            error_message = error.get("message")
+        else:
+            error_code, error_message = response.status_code, error
+        print(f"Error {error_code}: {error_message}")
+        return {
+            "error": f"ORS API Error {error_code}: {error_message}",
+            "is_road_based": False,
+            # Throttling and server errors may pass; a rejected request won't
+            "retryable": response.status_code == 429 or response.status_code >= 500
+        }
+
+    # Extract coordinates from the route into compact lat/lng arrays
+    feature = data["features"][0]
+    route_points = RouteGeometry.from_lnglat(feature["geometry"]["coordinates"])
+
+    # ORS returns one segment per leg, and the index of each waypoint in the geometry
+    segments = feature["properties"]["segments"]
+    way_points = feature["properties"].get("way_points") or [0, len(route_points) - 1]
+    legs = []
+    for i, segment in enumerate(segments):
+        legs.append({
+            "distance": segment.get("distance", 0) / 1609.34,
+            "duration": segment.get("duration", 0) / 3600,
+            "start_index": way_points[i] if i < len(way_points) else 0,
+            "end_index": way_points[i + 1] if i + 1 < len(way_points) else len(route_points) - 1,
+        })
+    
     return {
-        "error": f"All {max_retries} attempts failed with OpenRouteService: {last_error}",
-        "is_road_based": False
+        "route_points": route_points,
+        "distance": sum(leg["distance"] for leg in legs),
+        "duration": sum(leg["duration"] for leg in legs),
+        "legs": legs,
+        "is_road_based": True,
+        "endpoint_used": "OpenRouteService"
     }
 
 # Example usage
@@ -623,31 +622,586 @@ def get_road_based_route(start_coords, end_coords,
 # print(get_road_based_route(start, end, api_key="YOUR_API_KEY"))
 
 
-class CalculateRouteView(APIView):
-    def post(self, request):
+def parse_trip_request(data, query_params=None):
+    """
+    Validate a trip request body and pick out the fields calculate_route uses.
+    
+    Returns:
+    - (trip_data, None) or (None, error message)
+    """
+    query_params = query_params or {}
+    if not isinstance(data, dict):
+        return None, 'Trip must be an object'
+    
+    required_fields = ['currentLocation', 'pickupLocation', 'dropoffLocation']
+    for field in required_fields:
+        if field not in data:
+            return None, f'Missing required field: {field}'
+    
+    # A plain string would be planned as one stop per character
+    extra_stops = data.get('extraStops') or []
+    if not isinstance(extra_stops, list) or not all(isinstance(stop, str) and stop.strip() for stop in extra_stops):
+        return None, 'extraStops must be a list of addresses'
+    
+    # currentCycleHours are hours of the current shift; a driver's recorded
+    # 70-hour/8-day cycle only limits the hours available for the trip
+    cycle_hours_available = None
+    if data.get('driverId') is not None:
+        cycle_hours_available = driver_cycles.status(data['driverId'])['hoursAvailable']
+    
+    return {
+        'currentLocation': data['currentLocation'],
+        'pickupLocation': data['pickupLocation'],
+        'dropoffLocation': data['dropoffLocation'],
+        'currentCycleHours': data.get('currentCycleHours') or 0,
+        'cycleHoursAvailable': cycle_hours_available,
+        'extraStops': extra_stops,
+        'simplifyZoom': query_params.get('zoom', data.get('simplifyZoom')),
+        'geometryFormat': query_params.get('geometry', data.get('geometryFormat', 'coordinates'))
+    }, None
+
+BATCH_MAX_TRIPS = getattr(settings, 'BATCH_MAX_TRIPS', 1000)
+BATCH_MAX_CONCURRENCY = getattr(settings, 'BATCH_MAX_CONCURRENCY', 4)
+
+def plan_trip_batch(trips, max_workers=BATCH_MAX_CONCURRENCY):
+    """
+    Plan many trips, yielding (index, result) pairs as each trip finishes.
+    
+    Addresses shared across the batch are geocoded once, and trips with the
+    same waypoints share one routing request. Provider calls run on a
+    per-batch pool of max_workers threads. A trip that fails to geocode or
+    route yields an {'error': ...} result without affecting the others.
+    
+    Parameters:
+    - trips: list of trip_data dicts (see parse_trip_request)
+    - max_workers: maximum concurrent provider calls for this batch
+    """
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='eldtrip-batch') as executor:
+        geocode_futures = {}  # normalized address -> future
+        trip_geocodes = {}  # trip index -> futures for its locations, in order
+        waiting_on_geocode = {}  # geocode future -> trip indices
+        
+        for index, trip_data in enumerate(trips):
+            futures = []
+            for location in trip_locations(trip_data):
+                key = normalize_address(location)
+                if key not in geocode_futures:
+                    future = executor.submit(_run_in_worker, geocode_or_error, (location,))
+                    geocode_futures[key] = future
+                    waiting_on_geocode[future] = set()
+                waiting_on_geocode[geocode_futures[key]].add(index)
+                futures.append(geocode_futures[key])
+            trip_geocodes[index] = futures
+        
+        route_futures = {}  # rounded waypoint tuple -> future
+        waiting_on_route = {}  # route future -> [(trip index, waypoints)]
+        started = set()
+        pending = set(waiting_on_geocode)
+        
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in waiting_on_geocode:
+                    for index in sorted(waiting_on_geocode.pop(future)):
+                        futures = trip_geocodes[index]
+                        if index in started or not all(f.done() for f in futures):
+                            continue
+                        started.add(index)
+                        
+                        locations = trip_locations(trips[index])
+                        waypoints = []
+                        for location, f in zip(locations, futures):
+                            coords = f.result() if f.exception() is None else None
+                            error = geocoding_error([location], [coords])
+                            if error:
+                                yield index, error
+                                break
+                            waypoints.append(coords)
+                        else:
+                            key = tuple((round(c['lat'], 6), round(c['lng'], 6)) for c in waypoints)
+                            if key not in route_futures:
+                                route_future = executor.submit(_run_in_worker, get_waypoint_route, (waypoints,))
+                                route_futures[key] = route_future
+                                waiting_on_route[route_future] = []
+                                pending.add(route_future)
+                            waiting_on_route[route_futures[key]].append((index, waypoints))
+                else:
+                    route = future.result() if future.exception() is None else {
+                        "error": str(future.exception()),
+                        "is_road_based": False
+                    }
+                    for index, waypoints in waiting_on_route.pop(future):
+                        try:
+                            yield index, build_route_plan(trips[index], waypoints, route)
+                        except Exception as e:
+                            yield index, {"error": str(e)}
+
+MATRIX_MAX_CELLS = getattr(settings, 'MATRIX_MAX_CELLS', 10000)
+
+def parse_matrix_request(data):
+    """
+    Validate a matrix request body.
+    
+    Origins are addresses or {'location', 'driverId', 'currentCycleHours'}
+    objects; without currentCycleHours the driver's recorded cycle is used.
+    Destinations are addresses.
+    
+    Returns:
+    - ((origin locations, destination locations, cycle hours used per origin), None)
+      or (None, error message)
+    """
+    if not isinstance(data, dict):
+        return None, 'Request must be an object'
+    origins, destinations = data.get('origins'), data.get('destinations')
+    if not isinstance(origins, list) or not origins or not isinstance(destinations, list) or not destinations:
+        return None, 'Non-empty lists of origins and destinations are required'
+    if len(origins) * len(destinations) > MATRIX_MAX_CELLS:
+        return None, f'At most {MATRIX_MAX_CELLS} origin/destination pairs per matrix'
+    
+    origin_locations, cycle_hours = [], []
+    for origin in origins:
+        if isinstance(origin, dict):
+            location = origin.get('location')
+            used = origin.get('currentCycleHours')
+            if used is None:
+                driver_id = origin.get('driverId')
+                used = driver_cycles.hours_used(driver_id) if driver_id is not None else 0
+        else:
+            location, used = origin, 0
+        if not isinstance(location, str) or not location:
+            return None, 'Each origin needs a location'
+        try:
+            cycle_hours.append(float(used))
+        except (TypeError, ValueError):
+            return None, f'Invalid currentCycleHours for origin: {location}'
+        origin_locations.append(location)
+    
+    if not all(isinstance(location, str) and location for location in destinations):
+        return None, 'Destinations must be addresses'
+    return (origin_locations, destinations, cycle_hours), None
+
+def calculate_matrix(origin_locations, destination_locations, cycle_hours_used,
+                     api_key=settings.OPEN_ROUTE_KEY, profile=ORS_PROFILE):
+    """
+    Deadhead distance and driving time from every origin to every destination.
+    
+    Each distinct address is geocoded once. With the 'local' routing backend
+    the road graph answers every cell; otherwise cells are filled from the
+    route cache first and the rest are requested in bulk from the ORS
+    matrix service, in blocks that run concurrently. ORS matrix cells have
+    no geometry, so they are not added to the route cache.
+    
+    Parameters:
+    - origin_locations, destination_locations: addresses
+    - cycle_hours_used: 70-hour/8-day cycle hours already used by the driver at each origin
+    
+    Returns:
+    - response dict with dense 'distances' (miles), 'durations' (hours) and
+      'hosFeasible' matrices, one row per origin, or {'error': ...}
+    """
+    deadline = time.monotonic() + PLAN_DEADLINE
+    
+    # One geocode per distinct address across both sets
+    unique = {}
+    for location in [*origin_locations, *destination_locations]:
+        unique.setdefault(normalize_address(location), location)
+    with span('geocode'):
+        results = run_provider_calls(
+            [(geocode_or_error, (location,)) for location in unique.values()],
+            is_failure=lambda coords: not isinstance(coords, dict),
+            deadline=deadline,
+            unfinished=TIMED_OUT
+        )
+    error = geocoding_error(unique.values(), results)
+    if error:
+        return error
+    geocoded = dict(zip(unique, results))
+    origins = [geocoded[normalize_address(location)] for location in origin_locations]
+    destinations = [geocoded[normalize_address(location)] for location in destination_locations]
+    
+    errors = []
+    if ROUTING_BACKEND == 'local':
+        with span('matrix'):
+            distances, durations = local_matrix(get_road_graph(), origins, destinations)
+        cached_cells = 0
+    else:
+        with span('route_cache'):
+            distances, durations = cached_matrix(route_cache, origins, destinations, profile)
+        cached_cells = int(np.count_nonzero(~np.isnan(distances)))
+        
+        blocks = matrix_blocks(np.isnan(distances))
+        with span('matrix'):
+            results = run_provider_calls([
+                (fetch_ors_matrix, ([origins[i] for i in rows], [destinations[j] for j in cols], api_key, profile))
+                for rows, cols in blocks
+            ], deadline=deadline)
+        for (rows, cols), result in zip(blocks, results):
+            if result is None or 'error' in result:
+                errors.append(result['error'] if result is not None else 'ORS matrix request timed out')
+                continue
+            cells = np.ix_(rows, cols)
+            # Cached cells in the block keep their cached values
+            missing = np.isnan(distances[cells])
+            distances[cells] = np.where(missing, result['distances'], distances[cells])
+            durations[cells] = np.where(missing, result['durations'], durations[cells])
+    
+    cycle_hours_available = np.maximum(CYCLE_LIMIT_HOURS - np.asarray(cycle_hours_used, dtype=np.float64), 0)
+    response = {
+        'origins': [
+            {'location': location, 'coordinates': [coords['lat'], coords['lng']], 'cycleHoursAvailable': float(available)}
+            for location, coords, available in zip(origin_locations, origins, cycle_hours_available)
+        ],
+        'destinations': [
+            {'location': location, 'coordinates': [coords['lat'], coords['lng']]}
+            for location, coords in zip(destination_locations, destinations)
+        ],
+        'distances': matrix_json(distances, 2),
+        'durations': matrix_json(durations, 3),
+        'hosFeasible': hos_feasible(distances, cycle_hours_available).tolist(),
+        'cachedCells': cached_cells,
+        'routedCells': int(np.count_nonzero(~np.isnan(distances))) - cached_cells,
+    }
+    if errors:
+        response['errors'] = errors
+    return response
+
+# Rendered calculate-route and plan-trip responses, keyed by their normalized inputs
+plan_cache = PlanCache()
+# Settings that change a plan without changing its inputs
+PLAN_CACHE_CONTEXT = {
+    'routing': ROUTING_BACKEND,
+    'profile': ORS_PROFILE,
+    'geocoding': GEOCODING_BACKEND,
+    'poi': POI_DATASET_PATH,
+}
+
+def plan_expires_at(trip_data, route_data):
+    """
+    When the first of the geocode and route cache entries a plan was built from expires.
+    
+    An input that is no longer cached counts as expired now. Addresses
+    found in the local gazetteer and routes over the local road graph
+    don't expire.
+    
+    Returns:
+    - epoch seconds, or None when every input is local
+    """
+    now = time.time()
+    expiries = []
+    for location in trip_locations(trip_data):
+        if GEOCODING_BACKEND == 'local' and get_gazetteer().lookup(location) is not None:
+            continue
+        expiries.append(geocode_cache.expires_at(location))
+    if ROUTING_BACKEND != 'local':
+        points = [route_data['startCoordinates'], route_data['pickupCoordinates'],
+                  *(stop['coordinates'] for stop in route_data['extraStops']), route_data['dropoffCoordinates']]
+        expiries.append(route_cache.expires_at([{'lat': lat, 'lng': lng} for lat, lng in points], ORS_PROFILE))
+    expiries = [expiry if expiry is not None else now for expiry in expiries]
+    return min(expiries) if expiries else None
+
+def with_request_locations(kind, body, trip_data):
+    """
+    A cached plan response re-rendered with the request's own spelling of its locations.
+    
+    Parameters:
+    - body: rendered calculate-route or plan-trip response
+    - trip_data: the request, which shares the plan under its normalized addresses
+    """
+    result = loads(body)
+    route_data = result['route'] if kind == 'plan-trip' else result
+    for field, location in (('startLocation', trip_data['currentLocation']),
+                            ('pickupLocation', trip_data['pickupLocation']),
+                            ('dropoffLocation', trip_data['dropoffLocation'])):
+        if field in route_data:
+            route_data[field] = location
+    if 'extraStops' in route_data:
+        for stop, location in zip(route_data['extraStops'], trip_data.get('extraStops') or []):
+            stop['location'] = location
+    return dumps(result)
+
+def memoized_plan_response(request, kind, trip_data, excluded=()):
+    """
+    Serve a calculate-route or plan-trip response from the plan cache, or
+    plan, render and cache it.
+    
+    Responses carry a strong ETag; a GET whose If-None-Match names it gets
+    a 304 without a body. Errors are not cached. A request that spells its
+    locations differently from the cached plan gets them back as it sent
+    them, under the ETag of that body.
+    """
+    try:
+        key = plan_cache_key(kind, trip_data, excluded, PLAN_CACHE_CONTEXT)
+    except (TypeError, ValueError) as e:
+        return Response({'error': f'Invalid trip: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    locations = trip_locations(trip_data)
+    cached = plan_cache.get(key)
+    if cached is not None:
+        body, etag, cached_locations = cached
+        if cached_locations != locations:
+            with span('render'):
+                body = with_request_locations(kind, body, trip_data)
+            etag = body_etag(body)
+    else:
+        result = plan_trip(trip_data) if kind == 'plan-trip' else calculate_and_save_route(trip_data)
+        if 'error' in result:
+            return Response(result)
+        route_data = result['route'] if kind == 'plan-trip' else result
+        expires_at = plan_expires_at(trip_data, route_data)
+        
+        if excluded:
+            route_data = {field: value for field, value in route_data.items() if field not in excluded}
+            result = {**result, 'route': route_data} if kind == 'plan-trip' else route_data
+        with span('render'):
+            body = dumps(result)
+        if expires_at is not None and expires_at <= time.time():
+            # An input has already left its cache, so the next request plans again
+            etag = body_etag(body)
+        else:
+            etag = plan_cache.set(key, body, expires_at, locations)
+    
+    # Other methods must not get a 304 (RFC 9110), but still skip the planning
+    if request.method in ('GET', 'HEAD') and etag_matches(request.headers.get('If-None-Match'), etag):
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+def trip_query_data(query_params):
+    """A trip request body from GET query parameters; extraStops may repeat"""
+    data = {key: value for key, value in query_params.items() if key != 'extraStops'}
+    data['extraStops'] = query_params.getlist('extraStops')
+    return data
+
+ELDTRIP_FAST_JSON = getattr(settings, 'ELDTRIP_FAST_JSON', True)
+
+class EldTripAPIView(APIView):
+    """
+    Base view for the eldtrip API, rendering and parsing JSON with the fast codec.
+    
+    Every request is timed: its stage spans are returned in a Server-Timing
+    header and recorded in the metrics served by MetricsView. With
+    PROFILE_SLOW_REQUEST_MS set, requests are sampled by a profiler whose
+    stacks are reported when they exceed it.
+    """
+    if ELDTRIP_FAST_JSON:
+        renderer_classes = [FastJSONRenderer, *(
+            renderer for renderer in api_settings.DEFAULT_RENDERER_CLASSES if renderer.format != 'json'
+        )]
+        parser_classes = [FastJSONParser, *(
+            parser for parser in api_settings.DEFAULT_PARSER_CLASSES if parser.media_type != 'application/json'
+        )]
+    
+    def dispatch(self, request, *args, **kwargs):
+        view = type(self).__name__
+        profiler = SamplingProfiler().start() if PROFILE_SLOW_REQUEST_MS is not None else None
+        start = time.perf_counter()
+        with request_timings() as timings:
+            response = super().dispatch(request, *args, **kwargs)
+            # Render here rather than in the handler, so rendering is timed too
+            if not response.streaming and not getattr(response, 'is_rendered', True):
+                with span('render'):
+                    response.render()
+        elapsed = time.perf_counter() - start
+        
+        if profiler is not None:
+            profiler.stop()
+            if elapsed * 1000 >= PROFILE_SLOW_REQUEST_MS:
+                profiler.report(view)
+        
+        request_seconds.observe(elapsed, view=view, method=request.method, status=response.status_code)
+        if not response.streaming:
+            response_bytes.observe(len(response.content), view=view)
+        server_timing = timings.server_timing()
+        response['Server-Timing'] = f"{server_timing + ', ' if server_timing else ''}total;dur={elapsed * 1000:.1f}"
+        return response
+
+def ndjson_line(payload):
+    """Encode one NDJSON line"""
+    return dumps(payload) + b'\n'
+
+ROUTE_STREAM_CHUNK_POINTS = getattr(settings, 'ROUTE_STREAM_CHUNK_POINTS', 2000)
+
+def stream_route_json(route_data, chunk_points=ROUTE_STREAM_CHUNK_POINTS):
+    """
+    Render a calculate_route result as a JSON document in pieces.
+    
+    Summary fields (distances, times, stops) come first; routeCoordinates is
+    streamed last, chunk_points points at a time, so only one chunk of the
+    geometry is ever held as Python lists or text.
+    """
+    summary = {key: value for key, value in route_data.items() if key != 'routeCoordinates'}
+    geometry = route_data.get('routeCoordinates')
+    
+    head = dumps(summary)
+    if geometry is None:
+        yield head
+        return
+    
+    # Reopen the summary object to append the geometry array
+    yield head[:-1] + (b',' if summary else b'') + b'"routeCoordinates":['
+    for start in range(0, len(geometry), chunk_points):
+        chunk = dumps(geometry[start:start + chunk_points])[1:-1]
+        yield chunk if start == 0 else b',' + chunk
+    yield b']}'
+
+class CalculateRouteView(EldTripAPIView):
+    def get(self, request):
+        """
+        API endpoint to calculate a route from query parameters, for
+        conditional requests: If-None-Match with the ETag of an unchanged
+        plan gets a 304.
+        """
+        return self.post(request, trip_query_data(request.query_params))
+    
+    def post(self, request, data=None):
         """API endpoint to calculate a route"""
         try:
-            data = request.data
+            data = request.data if data is None else data
             
             # Validate inputs
-            required_fields = ['currentLocation', 'pickupLocation', 'dropoffLocation']
-            for field in required_fields:
-                if field not in data:
-                    return Response({'error': f'Missing required field: {field}'}, status=status.HTTP_400_BAD_REQUEST)
+            trip_data, error = parse_trip_request(data, request.query_params)
+            if error:
+                return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
             
-            # Calculate route
-            route_data = calculate_route({
-                'currentLocation': data['currentLocation'],
-                'pickupLocation': data['pickupLocation'],
-                'dropoffLocation': data['dropoffLocation'],
-                'currentCycleHours': data.get('currentCycleHours', 0)
-            })
+            # Long routes can be streamed: summary first, then the geometry in chunks
+            if request.query_params.get('stream') in ('1', 'true'):
+                # Calculate route, storing the trip so generate-eld-logs can refer to it by ID
+                route_data = calculate_and_save_route(trip_data)
+                if 'error' in route_data:
+                    return Response(route_data)
+                return StreamingHttpResponse(stream_route_json(route_data), content_type='application/json')
             
-            return Response(route_data)
+            # Identical requests are served the memoized response
+            return memoized_plan_response(request, 'calculate-route', trip_data)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class GenerateEldLogsView(APIView):
+class BatchCalculateRouteView(EldTripAPIView):
+    def post(self, request):
+        """
+        API endpoint to plan a batch of trips.
+        
+        Accepts a list of trips (or {'trips': [...]}) and streams one NDJSON
+        line per trip, in completion order: {"index", "id", "result"} or
+        {"index", "id", "error"}.
+        """
+        data = request.data
+        trips = data.get('trips') if isinstance(data, dict) else data
+        if not isinstance(trips, list) or not trips:
+            return Response({'error': 'A non-empty list of trips is required'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(trips) > BATCH_MAX_TRIPS:
+            return Response({'error': f'At most {BATCH_MAX_TRIPS} trips per batch'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        parsed = []
+        for trip in trips:
+            parsed.append(parse_trip_request(trip, request.query_params))
+        
+        valid_indices = [index for index, (trip_data, error) in enumerate(parsed) if not error]
+        valid_trips = [parsed[index][0] for index in valid_indices]
+        
+        def trip_id(index):
+            trip = trips[index]
+            return trip.get('id') if isinstance(trip, dict) else None
+        
+        def lines():
+            for index, (trip_data, error) in enumerate(parsed):
+                if error:
+                    yield ndjson_line({'index': index, 'id': trip_id(index), 'error': error})
+            
+            for position, result in plan_trip_batch(valid_trips):
+                index = valid_indices[position]
+                if 'error' in result:
+                    yield ndjson_line({'index': index, 'id': trip_id(index), 'error': result['error']})
+                else:
+                    yield ndjson_line({'index': index, 'id': trip_id(index), 'result': result})
+        
+        return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+
+class MatrixView(EldTripAPIView):
+    def post(self, request):
+        """
+        API endpoint for a many-to-many deadhead matrix, e.g. every driver to every pickup.
+        
+        Body: {'origins': [address or {'location', 'driverId', 'currentCycleHours'}, ...],
+               'destinations': [address, ...]}
+        Cells without a route are null; failed ORS blocks are listed in 'errors'.
+        """
+        try:
+            parsed, error = parse_matrix_request(request.data)
+            if error:
+                return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+            return Response(calculate_matrix(*parsed))
+        except Exception as e:
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+def excluded_fields(query_params):
+    """Route fields named in the comma-separated 'exclude' query parameter"""
+    return [field.strip() for field in query_params.get('exclude', '').split(',') if field.strip()]
+
+class PlanTripView(EldTripAPIView):
+    def get(self, request):
+        """API endpoint to plan a trip from query parameters, with conditional request support"""
+        return self.post(request, trip_query_data(request.query_params))
+    
+    def post(self, request, data=None):
+        """
+        API endpoint to calculate a route and its ELD logs in one request.
+        
+        Takes the same body as calculate-route. The optional 'exclude' query
+        parameter is a comma-separated list of route fields to leave out of
+        the response, e.g. ?exclude=routeCoordinates. Identical requests are
+        served the memoized response, with an ETag.
+        """
+        try:
+            trip_data, error = parse_trip_request(request.data if data is None else data, request.query_params)
+            if error:
+                return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+            
+            return memoized_plan_response(request, 'plan-trip', trip_data, excluded_fields(request.query_params))
+        except Exception as e:
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+class PlanningJobListView(EldTripAPIView):
+    def post(self, request):
+        """
+        API endpoint queueing a trip for the job workers instead of planning it in the request.
+        
+        Takes the calculate-route body, plus 'kind': 'calculate-route'
+        (default) or 'plan-trip', and answers 202 with the job ID; poll
+        jobs/<jobId>/ for the result.
+        """
+        kind = request.data.get('kind', 'calculate-route') if isinstance(request.data, dict) else None
+        if kind not in job_kinds():
+            return Response({'error': f"kind must be one of: {', '.join(job_kinds())}"}, status=status.HTTP_400_BAD_REQUEST)
+        trip_data, error = parse_trip_request(request.data, request.query_params)
+        if error:
+            return Response({'error': error}, status=status.HTTP_400_BAD_REQUEST)
+        
+        job_id = submit_job(kind, {'trip': trip_data, 'exclude': excluded_fields(request.query_params)})
+        location = reverse('planning_job', kwargs={'job_id': job_id})
+        return Response({'jobId': job_id, 'status': 'queued', 'location': location},
+                        status=status.HTTP_202_ACCEPTED, headers={'Location': location})
+
+class PlanningJobView(EldTripAPIView):
+    def get(self, request, job_id):
+        """
+        API endpoint polling a planning job.
+        
+        Returns its status, attempts and last error, plus 'result' (the
+        calculate-route or plan-trip response) once it has succeeded.
+        """
+        job, result = job_status(job_id)
+        if job is None:
+            return Response({'error': 'Job not found or expired'}, status=status.HTTP_404_NOT_FOUND)
+        if result is None:
+            return Response(job)
+        # The result was rendered by the worker; splice it in rather than decode and re-encode it
+        return HttpResponse(dumps(job)[:-1] + b',"result":' + result + b'}', content_type='application/json')
+
+class GenerateEldLogsView(EldTripAPIView):
     def post(self, request):
         """API endpoint to generate ELD logs"""
         try:
@@ -656,18 +1210,86 @@ class GenerateEldLogsView(APIView):
             if not route_data:
                 return Response({'error': 'Missing route data'}, status=status.HTTP_400_BAD_REQUEST)
             
+            # A stored trip can be referenced by ID instead of re-sending the whole route
+            if 'tripId' in route_data and 'totalTripTime' not in route_data:
+                route_data = load_trip(route_data['tripId'])
+                if route_data is None:
+                    return Response({'error': 'Trip not found or expired'}, status=status.HTTP_404_NOT_FOUND)
+            
             # Generate ELD logs
-            eld_logs = generate_eld_logs(route_data)
+            with span('eld_logs'):
+                eld_logs = generate_eld_logs(route_data)
             
             return Response(eld_logs)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class GeocodeView(APIView):
+class GeocodeView(EldTripAPIView):
     def post(self, request):
         """API endpoint to geocode an address"""
         address = request.data.get('address')
         if not address:
             return Response({'error': 'Address is required'}, status=status.HTTP_400_BAD_REQUEST)
-        coords = geocode_address(address)
-        return Response(coords)
\ No newline at end of file
+        try:
+            coords = cached_geocode_address(address)
+        except requests.RequestException as e:
+            print(f"Error geocoding address: {e}")
+            return Response({'error': f'Geocoding service unavailable: {e}'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response(coords)
+
+class RouteCacheStatsView(EldTripAPIView):
+    def get(self, request):
+        """API endpoint exposing route cache hit ratio and storage use"""
+        return Response(route_cache.stats())
+
+class DriverCycleView(EldTripAPIView):
+    def get(self, request, driver_id):
+        """API endpoint for a driver's 70-hour/8-day cycle position, now or at ?at=<ISO time>"""
+        try:
+            return Response(driver_cycles.status(driver_id, request.query_params.get('at')))
+        except (TypeError, ValueError) as e:
+            return Response({'error': f'Invalid time: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+
+    def post(self, request, driver_id):
+        """
+        API endpoint recording a driver's on-duty periods.
+        
+        Body: {'periods': [{'start': ISO time, 'end': ISO time}, ...]}
+        """
+        periods = request.data.get('periods') if isinstance(request.data, dict) else None
+        if not isinstance(periods, list):
+            return Response({'error': 'periods must be a list'}, status=status.HTTP_400_BAD_REQUEST)
+        # Check every period before recording any, so a bad one leaves the history unchanged
+        parsed = []
+        for period in periods:
+            try:
+                start, end = epoch_hours(period['start']), epoch_hours(period['end'])
+            except (KeyError, TypeError, ValueError) as e:
+                return Response({'error': f'Invalid period: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+            if end <= start:
+                return Response({'error': f"Period ends before it starts: {period['start']} - {period['end']}"},
+                                status=status.HTTP_400_BAD_REQUEST)
+            parsed.append((start, end))
+        driver_cycles.record_periods(driver_id, parsed)
+        return Response(driver_cycles.status(driver_id))
+
+class ProviderStatsView(EldTripAPIView):
+    def get(self, request):
+        """API endpoint exposing provider rate limiting, coalescing and queue depth counters"""
+        return Response({client.name: client.stats() for client in (nominatim, openrouteservice)})
+
+class MetricsView(EldTripAPIView):
+    def get(self, request):
+        """Prometheus endpoint with stage, request and provider metrics"""
+        return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+class PlanCacheStatsView(EldTripAPIView):
+    def get(self, request):
+        """API endpoint exposing plan cache hit ratio and storage use"""
+        return Response(plan_cache.stats())
+
+class GeocodeCacheStatsView(EldTripAPIView):
+    def get(self, request):
+        """API endpoint exposing geocode cache hit/miss counters"""
+        return Response(geocode_cache.stats())
\ No newline at end of file
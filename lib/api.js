@@ -57,6 +57,17 @@ export const generateEldLogs = async (routeData) => {
   if (!routeData) return null
 
   const url = `http://127.0.0.1:8000/api/generate-eld-logs/`
-  return apiCall(url, 'POST', routeData)
+  // The backend stores calculated trips, so only the ID needs to be sent back
+  const data = routeData.tripId ? { tripId: routeData.tripId } : routeData
+  return apiCall(url, 'POST', data)
 }
 
+// Calculate the route and generate its ELD logs in a single request
+export const planTrip = async (tripData) => {
+  const url = `http://127.0.0.1:8000/api/plan-trip/`
+  const result = await apiCall(url, 'POST', tripData)
+  if (result.error) {
+    throw new Error(result.error)
+  }
+  return result
+}